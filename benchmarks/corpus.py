@@ -0,0 +1,97 @@
+"""
+Functions timed by the runtime benchmark, each with the arguments to call it with.
+"""
+
+
+def numeric_loop(n):
+    total = 0
+    step = 2
+    for i in range(n):
+        scaled = i * step
+        if scaled % 3:
+            total += scaled
+        else:
+            total -= 1
+    return total
+
+
+def while_loop(n):
+    i = 0
+    acc = 0.0
+    while i < n:
+        x = i * 0.5
+        acc = acc + x * x
+        i += 1
+    return acc
+
+
+def tail_sum(n, acc):
+    if n == 0:
+        return acc
+    return tail_sum(n - 1, acc + n)
+
+
+def tail_gcd(a, b):
+    if b == 0:
+        return a
+    return tail_gcd(b, a % b)
+
+
+def constants(n):
+    kib = 1 << 10
+    mib = kib * kib
+    limit = 60 * 60 * 24
+    names = ("a", "b", "c")
+    result = 0
+    for i in range(n):
+        unused = mib + limit
+        if i in (1, 2, 3):
+            result += kib
+        result += len(names) + limit // 3600
+    return result
+
+
+def closures(n):
+    offset = 3
+
+    def add(x):
+        return x + offset
+
+    def twice(x):
+        y = add(x)
+        return add(y)
+
+    total = 0
+    for i in range(n):
+        total += twice(i)
+    return total
+
+
+def string_building(n):
+    sep = ", "
+    parts = []
+    for i in range(n):
+        label = "item"
+        parts.append(label + str(i))
+    return sep.join(parts)
+
+
+def dead_code(n):
+    result = 0
+    for i in range(n):
+        tmp = i + 1
+        other = tmp * 2
+        result += tmp
+    return result
+
+
+CASES = [
+    (numeric_loop, (1000, )),
+    (while_loop, (1000, )),
+    (tail_sum, (200, 0)),
+    (tail_gcd, (832040, 514229)),
+    (constants, (1000, )),
+    (closures, (1000, )),
+    (string_building, (200, )),
+    (dead_code, (1000, )),
+]
@@ -0,0 +1,256 @@
+"""
+Benchmarks for the optimizer, run with `python benchmarks/run.py`.
+
+Measures the runtime of the functions in `corpus.py` with and without the
+optimizer, how many instructions per second `optimize_code` gets through on
+large generated modules, and the import time of a generated package with
+`enable()` on and off. `--json` writes the results for comparing runs.
+"""
+# Stdlib
+from argparse import ArgumentParser
+import datetime
+from dis import get_instructions
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+import timeit
+from types import CodeType, FunctionType
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Project Internals
+from bytecode_optimizer import __version__  # noqa: E402
+from bytecode_optimizer._optimizer import flags_key, memo, optimize_code  # noqa: E402
+import corpus  # noqa: E402
+
+SYNTHETIC_FUNCTION = '''
+def function_{n}(a, b, *args):
+    scale = {n} * 2
+    total = 0
+    unused = a
+    for i in range(a):
+        value = i * scale
+        if value % 3 == 0:
+            total += value
+        elif b:
+            total -= {n}
+        else:
+            continue
+    while b > 0:
+        b -= 1
+        if b == 7:
+            break
+    try:
+        total //= b
+    except ZeroDivisionError:
+        total = -1
+    label = "function" + "_{n}"
+    return [total, label, len(args), (1, 2) + (3, )]
+
+
+class Class_{n}:
+    limit = 1 << 8
+
+    def method(self, x):
+        y = x
+        return self.limit + y
+'''
+
+
+def copy_function(func: FunctionType) -> FunctionType:
+    copy = FunctionType(func.__code__, func.__globals__, func.__name__,
+                        func.__defaults__, func.__closure__)
+    copy.__kwdefaults__ = func.__kwdefaults__
+    return copy
+
+
+def best_of(func: Callable[[], Any], number: int, repeat: int) -> float:
+    # Seconds per call, using the fastest repetition as the least noisy one
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def optimized_corpus() -> Dict[str, Any]:
+    # Tail calls are only converted when the module defining the functions is optimized
+    with open(corpus.__file__) as fp:
+        source = fp.read()
+    namespace = {"__name__": "corpus"}
+    exec(optimize_code(compile(source, corpus.__file__, "exec")), namespace)
+    return namespace
+
+
+def bench_runtime(number: int, repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    namespace = optimized_corpus()
+    for func, args in corpus.CASES:
+        plain = copy_function(func)
+        optimized = namespace[func.__name__]
+        expected = plain(*args)
+        if optimized(*args) != expected:
+            raise AssertionError(f"{func.__name__} returns a different result when optimized")
+        before = best_of(lambda: plain(*args), number, repeat)
+        after = best_of(lambda: optimized(*args), number, repeat)
+        results.append({
+            "name": func.__name__,
+            "unoptimized": before,
+            "optimized": after,
+            "speedup": before / after,
+        })
+    return results
+
+
+def iter_code(code: CodeType) -> Iterator[CodeType]:
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            yield from iter_code(const)
+
+
+def synthetic_source(functions: int) -> str:
+    return "".join(SYNTHETIC_FUNCTION.format(n=n) for n in range(functions))
+
+
+def bench_throughput(sizes: List[int], repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    for size in sizes:
+        code = compile(synthetic_source(size), f"<synthetic {size}>", "exec")
+        instructions = sum(len(list(get_instructions(c))) for c in iter_code(code))
+        times = []
+        for _ in range(repeat):
+            # Every repetition has to optimize from scratch
+            memo.clear()
+            start = perf_counter()
+            optimize_code(code)
+            times.append(perf_counter() - start)
+        results.append({
+            "functions": size,
+            "instructions": instructions,
+            "time": min(times),
+            "instructions_per_second": instructions / min(times),
+        })
+    return results
+
+
+def write_package(directory: str, modules: int):
+    package = os.path.join(directory, "benchpkg")
+    os.makedirs(package)
+    imports = "".join(f"from benchpkg import module_{n}\n" for n in range(modules))
+    with open(os.path.join(package, "__init__.py"), "w") as fp:
+        fp.write(imports)
+    for n in range(modules):
+        with open(os.path.join(package, f"module_{n}.py"), "w") as fp:
+            fp.write(synthetic_source(10))
+
+
+def time_import(directory: str, enable: bool, cached: bool) -> float:
+    if not cached:
+        shutil.rmtree(os.path.join(directory, "benchpkg", "__pycache__"), ignore_errors=True)
+    script = (
+        "import sys, time\n"
+        f"sys.path[:0] = [{ROOT!r}, {directory!r}]\n"
+        "from bytecode_optimizer import enable\n"
+        + ("enable()\n" if enable else "")
+        + "start = time.perf_counter()\n"
+        "import benchpkg\n"
+        "print(time.perf_counter() - start)\n")
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    # -B keeps cold runs cold, warm runs read the cache written beforehand
+    args = [sys.executable] + ([] if cached else ["-B"]) + ["-c", script]
+    output = subprocess.run(args, stdout=subprocess.PIPE, env=env, check=True,
+                            universal_newlines=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def bench_import(modules: int, repeat: int) -> Dict[str, float]:
+    results = {}
+    directory = tempfile.mkdtemp(prefix="bco-bench-")
+    try:
+        write_package(directory, modules)
+        for enable in (False, True):
+            for cached in (False, True):
+                if cached:
+                    # Fill the cache for this mode first
+                    shutil.rmtree(os.path.join(directory, "benchpkg", "__pycache__"),
+                                  ignore_errors=True)
+                    time_import(directory, enable, True)
+                key = ("enabled" if enable else "disabled") + ("_cached" if cached else "_cold")
+                results[key] = min(time_import(directory, enable, cached) for _ in range(repeat))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def report(results: Dict[str, Any]):
+    if "runtime" in results:
+        print(f"{'function':<20}{'unoptimized':>14}{'optimized':>14}{'speedup':>10}")
+        for row in results["runtime"]:
+            print(f"{row['name']:<20}{row['unoptimized'] * 1e6:>12.2f}us"
+                  f"{row['optimized'] * 1e6:>12.2f}us{row['speedup']:>9.2f}x")
+        print()
+    if "throughput" in results:
+        print(f"{'functions':<12}{'instructions':>14}{'time':>12}{'instr/s':>14}")
+        for row in results["throughput"]:
+            print(f"{row['functions']:<12}{row['instructions']:>14}{row['time']:>11.3f}s"
+                  f"{row['instructions_per_second']:>14.0f}")
+        print()
+    if "import" in results:
+        for name, seconds in results["import"].items():
+            print(f"import {name:<18}{seconds * 1e3:>10.1f}ms")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = ArgumentParser(prog="benchmarks/run.py")
+    parser.add_argument("-b", "--benchmark", action="append", dest="benchmarks",
+                        choices=["runtime", "throughput", "import"],
+                        help="benchmark to run, can be repeated, defaults to all of them")
+    parser.add_argument("-n", "--number", type=int, default=1000,
+                        help="calls per timing in the runtime benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="repetitions of every measurement, the best one is kept")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200],
+                        help="number of generated functions per throughput module")
+    parser.add_argument("--modules", type=int, default=20,
+                        help="number of modules in the import time package")
+    parser.add_argument("--json", metavar="PATH",
+                        help="write the results as JSON, `-` for stdout")
+    args = parser.parse_args(argv)
+    selected = args.benchmarks or ["runtime", "throughput", "import"]
+
+    results = {
+        "meta": {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "optimizer": __version__,
+            "flags": dict(flags_key()),
+            "number": args.number,
+            "repeat": args.repeat,
+        },
+    }
+    if "runtime" in selected:
+        results["runtime"] = bench_runtime(args.number, args.repeat)
+    if "throughput" in selected:
+        results["throughput"] = bench_throughput(args.sizes, args.repeat)
+    if "import" in selected:
+        results["import"] = bench_import(args.modules, args.repeat)
+
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        report(results)
+        if args.json:
+            with open(args.json, "w") as fp:
+                json.dump(results, fp, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
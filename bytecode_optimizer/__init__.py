@@ -1,16 +1,32 @@
 # Stdlib
+from functools import partial
 from types import FunctionType
+from typing import Optional
 
 # Project Internals
 from bytecode_optimizer._import_loader import enable
-from bytecode_optimizer._optimizer import Flags, optimize_code
+from bytecode_optimizer._optimizer import __version__, Flags, optimize_code, passes
+from bytecode_optimizer._policy import Policy
+from bytecode_optimizer._profile import Profile, Recorder
+from bytecode_optimizer._stats import stats
 
-__all__ = ("enable", "optimized", "Flags")
+__all__ = ("enable", "optimized", "Flags", "passes", "stats", "Policy", "Profile", "Recorder")
 
 
-def optimized(func: FunctionType) -> FunctionType:
+def optimized(func: Optional[FunctionType] = None, *,
+              hoist_loads: Optional[bool] = None) -> FunctionType:
+    """
+    Optimize `func` in place, used as `@optimized` or `@optimized(hoist_loads=True)`.
+
+    Options override the matching `Flags` for this function only.
+    """
+    if func is None:
+        return partial(optimized, hoist_loads=hoist_loads)
+    flags = Flags
+    if hoist_loads is not None:
+        flags = type("Flags", (Flags, ), {"HOIST_LOADS": hoist_loads})
     code = func.__code__
-    for _ in range(Flags.OPTIMIZE_ITERATIONS):
-        code = optimize_code(code)
+    with stats.module(func.__module__):
+        code = optimize_code(code, flags)
     func.__code__ = code
     return func
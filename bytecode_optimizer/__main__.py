@@ -0,0 +1,8 @@
+# Stdlib
+import sys
+
+# Project Internals
+from bytecode_optimizer._compile import main
+
+if __name__ == "__main__":
+    sys.exit(main())
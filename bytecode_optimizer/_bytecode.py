@@ -0,0 +1,507 @@
+# Stdlib
+from dis import findlinestarts, hasfree, hasjabs, hasjrel, opmap, opname
+from inspect import CO_VARARGS, CO_VARKEYWORDS
+import sys
+from types import CodeType
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    from opcode import _inline_cache_entries
+except ImportError:
+    _inline_cache_entries = ()
+
+Op = Tuple[int, int, int]
+# Line, end line, column and end column of an instruction, only the line before 3.11
+Location = Tuple[Optional[int], Optional[int], Optional[int], Optional[int]]
+NO_LOCATION = (None, None, None, None)
+
+PY310 = sys.version_info >= (3, 10)
+PY311 = sys.version_info >= (3, 11)
+PY312 = sys.version_info >= (3, 12)
+
+EXTENDED_ARG = opmap["EXTENDED_ARG"]
+JUMP_OPS = frozenset((*hasjabs, *hasjrel))
+# Jump arguments count bytes before 3.10 and instructions since
+JUMP_UNIT = 2 if PY310 else 1
+# Cache entries following each instruction, zeroed in `co_code`, since 3.11
+CACHE_ENTRIES = [0] * 256
+for _opcode, _count in (_inline_cache_entries.items() if isinstance(_inline_cache_entries, dict)
+                        else enumerate(_inline_cache_entries)):
+    CACHE_ENTRIES[_opcode] = _count
+
+# Relative jumps only go one way since 3.11. Passes only see the forward
+# variants and the assembler picks the direction from where the target ends up;
+# before that, absolute jumps are used to go backwards
+BACKWARD_JUMPS = {
+    opmap[name.replace("BACKWARD", "FORWARD")]: opmap[name]
+    for name in opmap if "_BACKWARD" in name and name.replace("BACKWARD", "FORWARD") in opmap
+} if PY311 else {opmap["JUMP_FORWARD"]: opmap["JUMP_ABSOLUTE"]}
+FORWARD_JUMPS = {backward: forward for forward, backward in BACKWARD_JUMPS.items()
+                 if backward in hasjrel}
+COUNTS_BACKWARD = frozenset(opmap[name] for name in opmap if "JUMP_BACKWARD" in name)
+
+# The unconditional and conditional jumps passes can point anywhere
+JUMP = opmap.get("JUMP_ABSOLUTE", opmap["JUMP_FORWARD"])
+POP_JUMP_IF_FALSE = opmap.get("POP_JUMP_IF_FALSE", opmap.get("POP_JUMP_FORWARD_IF_FALSE"))
+POP_JUMP_IF_TRUE = opmap.get("POP_JUMP_IF_TRUE", opmap.get("POP_JUMP_FORWARD_IF_TRUE"))
+
+# Calls take a NULL below the callable since 3.11, and announce themselves with
+# PRECALL in 3.11 only
+CALL = opmap.get("CALL_FUNCTION", opmap.get("CALL"))
+PRECALL = opmap.get("PRECALL")
+RESUME = opmap.get("RESUME")
+
+# Since 3.11 the stack is shuffled with COPY and SWAP
+DUP_TOP = (opmap["DUP_TOP"], 0) if "DUP_TOP" in opmap else (opmap["COPY"], 1)
+SWAP_TOP = (opmap["ROT_TWO"], 0) if "ROT_TWO" in opmap else (opmap["SWAP"], 2)
+
+# Since 3.11 flags are packed into the low bits of some arguments; passes see
+# the plain index and the pseudo instructions 3.12 uses for the flags instead
+PUSH_NULL = opmap.get("PUSH_NULL")
+LOAD_GLOBAL = opmap["LOAD_GLOBAL"]
+LOAD_ATTR = opmap["LOAD_ATTR"]
+LOAD_METHOD = opmap.get("LOAD_METHOD")
+COMPARE_OP = opmap["COMPARE_OP"]
+SUPER_ATTRS = {
+    opmap[name]: flags
+    for name, flags in (("LOAD_ZERO_SUPER_ATTR", 0), ("LOAD_ZERO_SUPER_METHOD", 1),
+                        ("LOAD_SUPER_ATTR", 2), ("LOAD_SUPER_METHOD", 3))
+} if PY312 else {}
+SUPER_FLAGS = {flags: opcode for opcode, flags in SUPER_ATTRS.items()}
+# Branch masks 3.12 stores below the comparison, indexed by comparison
+COMPARE_MASKS = (2, 10, 8, 7, 4, 12) if PY312 else ()
+
+# Positional fields of CodeType before `code.replace()` was added in 3.8
+CODE_FIELDS = ("co_argcount", "co_kwonlyargcount", "co_nlocals", "co_stacksize", "co_flags",
+               "co_code", "co_consts", "co_names", "co_varnames", "co_filename", "co_name",
+               "co_firstlineno", "co_lnotab", "co_freevars", "co_cellvars")
+
+
+class ExceptionEntry(NamedTuple):
+    """
+    A range of instructions protected by a handler, since 3.11.
+
+    `start` and `end` are byte offsets, `target` is the offset of the handler,
+    or its label once in a control-flow graph.
+    """
+    start: int
+    end: int
+    target: int
+    depth: int
+    lasti: bool
+
+
+class Handler(NamedTuple):
+    target: int  # position of the first instruction of the handler
+    depth: int
+    lasti: bool
+
+
+class Assembly(NamedTuple):
+    code: bytes
+    exception_table: bytes
+    # Byte offset of every instruction passed to `assemble`
+    offsets: List[int]
+
+
+def replace(code: CodeType, **changes: Any) -> CodeType:
+    # Fields this interpreter doesn't have are ignored, `co_linetable` is the
+    # table from `write_line_table`, which is `co_lnotab` before 3.10
+    if not PY310 and "co_linetable" in changes:
+        changes["co_lnotab"] = changes.pop("co_linetable")
+    changes = {name: value for name, value in changes.items() if hasattr(code, name)}
+    if hasattr(code, "replace"):
+        return code.replace(**changes)
+    fields = {name: changes.get(name, getattr(code, name)) for name in CODE_FIELDS}
+    return CodeType(*fields.values())
+
+
+def line_table(code: CodeType) -> bytes:
+    return code.co_linetable if PY310 else code.co_lnotab
+
+
+def source_locations(code: CodeType) -> List[Location]:
+    # The location of every code unit of `code`
+    units = len(code.co_code) // 2
+    if PY311:
+        return list(code.co_positions())
+    locations = [NO_LOCATION] * units
+    if PY310:
+        for start, end, line in code.co_lines():
+            locations[start // 2:end // 2] = [(line, line, None, None)] * ((end - start) // 2)
+        return locations
+    line = code.co_firstlineno
+    starts = dict(findlinestarts(code))
+    for i in range(units):
+        line = starts.get(2 * i, line)
+        locations[i] = (line, line, None, None)
+    return locations
+
+
+def write_line_table(ops: List[Op], offsets: List[int], size: int,
+                     code: CodeType) -> bytes:
+    """
+    The line table for assembled `ops`, in the format of this interpreter.
+
+    `offsets` are where each of `ops` ended up, as in `Assembly`, and `size`
+    the length of the new bytecode. Every instruction keeps the location of
+    the instruction of `code` at its original offset.
+    """
+    locations = source_locations(code)
+    # Runs of bytes sharing a location
+    runs = []
+    for i, op in enumerate(ops):
+        end = offsets[i + 1] if i + 1 < len(ops) else size
+        if end == offsets[i]:
+            continue
+        location = locations[op[2] // 2] if op[2] // 2 < len(locations) else NO_LOCATION
+        if runs and runs[-1][1] == location:
+            runs[-1][0] += end - offsets[i]
+        else:
+            runs.append([end - offsets[i], location])
+    if PY311:
+        return write_locations(runs, code.co_firstlineno)
+    if PY310:
+        return write_line_ranges(runs, code.co_firstlineno)
+    return write_lnotab(runs, code.co_firstlineno)
+
+
+def write_lnotab(runs: List[list], line: int) -> bytes:
+    # Pairs of unsigned byte and signed line increments, one per new line
+    table = bytearray()
+    offset = 0
+    start = 0
+    for length, (new_line, *_) in runs:
+        if new_line is not None and new_line != line:
+            byte_delta = offset - start
+            line_delta = new_line - line
+            while byte_delta > 255:
+                table += bytes((255, 0))
+                byte_delta -= 255
+            while line_delta > 127:
+                table += bytes((byte_delta, 127))
+                byte_delta = 0
+                line_delta -= 127
+            while line_delta < -128:
+                table += bytes((byte_delta, 0x80))
+                byte_delta = 0
+                line_delta += 128
+            table += bytes((byte_delta, line_delta & 0xFF))
+            line = new_line
+            start = offset
+        offset += length
+    return bytes(table)
+
+
+def write_line_ranges(runs: List[list], line: int) -> bytes:
+    # 3.10: pairs of byte length and signed line increment, -128 for no line
+    table = bytearray()
+    for length, (new_line, *_) in runs:
+        if new_line is None:
+            line_delta = -128
+        else:
+            line_delta = new_line - line
+            line = new_line
+            while line_delta > 127:
+                table += bytes((0, 127))
+                line_delta -= 127
+            while line_delta < -127:
+                table += bytes((0, -127 & 0xFF))
+                line_delta += 127
+        while length > 254:
+            table += bytes((254, line_delta & 0xFF))
+            line_delta = -128 if new_line is None else 0
+            length -= 254
+        table += bytes((length, line_delta & 0xFF))
+    return bytes(table)
+
+
+def write_locations(runs: List[list], line: int) -> bytes:
+    # 3.11+: entries of up to 8 code units, with either no location or the
+    # long form of a signed line increment, end line, column and end column
+    table = bytearray()
+
+    def write(value: int):
+        while value >= 64:
+            table.append(64 | value & 63)
+            value >>= 6
+        table.append(value)
+
+    for length, (new_line, end_line, column, end_column) in runs:
+        units = length // 2
+        while units:
+            chunk = min(units, 8)
+            units -= chunk
+            if new_line is None:
+                table.append(0x80 | 15 << 3 | chunk - 1)
+                continue
+            table.append(0x80 | 14 << 3 | chunk - 1)
+            delta = new_line - line
+            write(delta << 1 if delta >= 0 else -delta << 1 | 1)
+            write(end_line - new_line if end_line is not None else 0)
+            write(column + 1 if column is not None else 0)
+            write(end_column + 1 if end_column is not None else 0)
+            line = new_line
+    return bytes(table)
+
+
+def exception_table(code: CodeType) -> bytes:
+    return getattr(code, "co_exceptiontable", b"")
+
+
+def argument_count(code: CodeType) -> int:
+    # The locals filled in from the arguments, including *args and **kwargs
+    return (code.co_argcount + code.co_kwonlyargcount + bool(code.co_flags & CO_VARARGS)
+            + bool(code.co_flags & CO_VARKEYWORDS))
+
+
+def call_ops(argc: int, offset: int) -> List[Op]:
+    # Call what is below the `argc` topmost values
+    if PRECALL is not None:
+        return [(PRECALL, argc, offset), (CALL, argc, offset)]
+    return [(CALL, argc, offset)]
+
+
+def cell_slots(varnames: Sequence[str], cellvars: Sequence[str],
+               freevars: Sequence[str]) -> Optional[List[int]]:
+    """
+    Where each cell and free variable lives in the frame since 3.11, in the
+    order older versions index them in.
+
+    Cells and free variables come after the locals, except for cells of
+    arguments, which share the slot of the argument.
+    """
+    if not PY311:
+        return None
+    slots = []
+    extra = len(varnames)
+    for name in cellvars:
+        if name in varnames:
+            slots.append(list(varnames).index(name))
+        else:
+            slots.append(extra)
+            extra += 1
+    return slots + list(range(extra, extra + len(freevars)))
+
+
+def is_backward(opcode: int, position: int, target: int) -> bool:
+    return target <= position and opcode not in hasjabs
+
+
+def can_jump_backward(opcode: int) -> bool:
+    return opcode in hasjabs or opcode in BACKWARD_JUMPS or opcode in COUNTS_BACKWARD
+
+
+def exception_entries(code: CodeType) -> List[ExceptionEntry]:
+    table = exception_table(code)
+    entries = []
+    i = 0
+
+    def read() -> int:
+        nonlocal i
+        value = table[i] & 63
+        while table[i] & 64:
+            i += 1
+            value = (value << 6) | (table[i] & 63)
+        i += 1
+        return value
+
+    while i < len(table):
+        start = read() * 2
+        end = start + read() * 2
+        target = read() * 2
+        depth_lasti = read()
+        entries.append(ExceptionEntry(start, end, target, depth_lasti >> 1, bool(depth_lasti & 1)))
+    return entries
+
+
+def write_exception_entries(entries: List[ExceptionEntry]) -> bytes:
+    table = bytearray()
+
+    def write(value: int, first: bool = False):
+        chunks = [value & 63]
+        value >>= 6
+        while value:
+            chunks.append(value & 63 | 64)
+            value >>= 6
+        chunks.reverse()
+        if first:
+            chunks[0] |= 128
+        table.extend(chunks)
+
+    for entry in entries:
+        write(entry.start // 2, first=True)
+        write((entry.end - entry.start) // 2)
+        write(entry.target // 2)
+        write(entry.depth << 1 | entry.lasti)
+    return bytes(table)
+
+
+def disassemble(code: CodeType) -> List[Op]:
+    """
+    The instructions of `code` as (opcode, argument, offset) tuples.
+
+    EXTENDED_ARG is folded into the argument of the instruction it extends and
+    cache entries are dropped. Jumps have the offset of their target as argument,
+    and flags newer versions pack into arguments are split off, so passes see
+    the same arguments on every version.
+    """
+    raw = code.co_code
+    cells = cell_slots(code.co_varnames, code.co_cellvars, code.co_freevars)
+    cell_indices = {slot: i for i, slot in enumerate(cells or ())}
+    ops = []
+    arg = 0
+    start = 0
+    i = 0
+    while i < len(raw):
+        opcode = raw[i]
+        arg |= raw[i + 1]
+        i += 2
+        if opcode == EXTENDED_ARG:
+            arg <<= 8
+            continue
+        i += 2 * CACHE_ENTRIES[opcode]
+        if opcode in JUMP_OPS:
+            if opcode in hasjabs:
+                arg *= JUMP_UNIT
+            elif opcode in COUNTS_BACKWARD:
+                arg = i - arg * JUMP_UNIT
+            else:
+                arg = i + arg * JUMP_UNIT
+            opcode = FORWARD_JUMPS.get(opcode, opcode)
+        elif opcode in hasfree and cells is not None:
+            arg = cell_indices[arg]
+        elif PY311 and opcode == LOAD_GLOBAL:
+            if arg & 1:
+                ops.append((PUSH_NULL, 0, start))
+            arg >>= 1
+        elif PY312 and opcode == LOAD_ATTR:
+            opcode = LOAD_METHOD if arg & 1 else LOAD_ATTR
+            arg >>= 1
+        elif opcode in SUPER_ATTRS:
+            opcode = SUPER_FLAGS[arg & 3]
+            arg >>= 2
+        elif PY312 and opcode == COMPARE_OP:
+            arg >>= 4
+        ops.append((opcode, arg, start))
+        arg = 0
+        start = i
+    return ops
+
+
+def encode(op: Op, cells: Optional[Sequence[int]] = None) -> Tuple[int, int]:
+    # The opcode and argument `op` has in `co_code`, except for jumps
+    opcode, arg = op[0], op[1]
+    if opcode in hasfree and cells is not None:
+        return opcode, cells[arg]
+    if PY311 and opcode == LOAD_GLOBAL:
+        return opcode, arg << 1
+    if PY312 and opcode in (LOAD_ATTR, LOAD_METHOD):
+        return LOAD_ATTR, arg << 1 | (opcode == LOAD_METHOD)
+    if opcode in SUPER_ATTRS:
+        return opmap["LOAD_SUPER_ATTR"], arg << 2 | SUPER_ATTRS[opcode]
+    if PY312 and opcode == COMPARE_OP:
+        return opcode, arg << 4 | COMPARE_MASKS[arg]
+    return opcode, arg
+
+
+def extended_args(arg: int) -> int:
+    count = 0
+    while arg > 0xFF:
+        arg >>= 8
+        count += 1
+    return count
+
+
+def assemble(ops: List[Op], handlers: Optional[Sequence[Optional[Handler]]] = None,
+             cells: Optional[Sequence[int]] = None) -> Assembly:
+    """
+    Encode `ops`, whose jumps have the position of their target as argument.
+
+    `handlers` gives the exception handler of every instruction since 3.11,
+    `cells` the slots from `cell_slots`.
+    """
+    handlers = handlers or [None] * len(ops)
+    targets = {op[1] for op in ops if op[0] in JUMP_OPS}
+    targets.update(handler.target for handler in handlers if handler is not None)
+
+    # Merge PUSH_NULL back into the LOAD_GLOBAL it was split from
+    instructions = []
+    positions = []
+    for i, op in enumerate(ops):
+        if (op[0] == LOAD_GLOBAL and i not in targets and PY311 and i
+                and ops[i - 1][0] == PUSH_NULL and handlers[i - 1] == handlers[i]
+                and instructions[-1][0] == PUSH_NULL):
+            instructions[-1] = [LOAD_GLOBAL, op[1] << 1 | 1, None, handlers[i]]
+            positions.append(len(instructions) - 1)
+            continue
+        positions.append(len(instructions))
+        if op[0] in JUMP_OPS:
+            instructions.append([op[0], op[1], op[1], handlers[i]])
+        else:
+            instructions.append([*encode(op, cells), None, handlers[i]])
+    for i, instruction in enumerate(instructions):
+        target = instruction[2]
+        if target is None:
+            continue
+        target = instruction[2] = positions[target] if target < len(ops) else len(instructions)
+        opcode = instruction[0]
+        backward = is_backward(opcode, i, target)
+        if backward and opcode in BACKWARD_JUMPS:
+            instruction[0] = BACKWARD_JUMPS[opcode]
+        elif not backward and opcode in FORWARD_JUMPS:
+            instruction[0] = FORWARD_JUMPS[opcode]
+        elif backward != (instruction[0] in COUNTS_BACKWARD) and instruction[0] in hasjrel:
+            raise ValueError(f"{opname[opcode]} can't jump to position {target} from {i}")
+
+    # Jump arguments depend on the size of everything in between, which grows
+    # with every EXTENDED_ARG they need; sizes only grow, so this settles
+    sizes = [1 + (extended_args(instruction[1]) if instruction[2] is None else 0)
+             + CACHE_ENTRIES[instruction[0]] for instruction in instructions]
+    while True:
+        offsets = [0]
+        for size in sizes:
+            offsets.append(offsets[-1] + 2 * size)
+        changed = False
+        for i, instruction in enumerate(instructions):
+            target = instruction[2]
+            if target is None:
+                continue
+            opcode = instruction[0]
+            if opcode in hasjabs:
+                arg = offsets[target] // JUMP_UNIT
+            elif opcode in COUNTS_BACKWARD:
+                arg = (offsets[i + 1] - offsets[target]) // JUMP_UNIT
+            else:
+                arg = (offsets[target] - offsets[i + 1]) // JUMP_UNIT
+            instruction[1] = arg
+            size = 1 + extended_args(arg) + CACHE_ENTRIES[opcode]
+            if size > sizes[i]:
+                sizes[i] = size
+                changed = True
+        if not changed:
+            break
+
+    code = bytearray()
+    for instruction, size in zip(instructions, sizes):
+        opcode, arg = instruction[0], instruction[1]
+        prefixes = size - 1 - CACHE_ENTRIES[opcode]
+        for shift in range(prefixes, 0, -1):
+            code += bytes((EXTENDED_ARG, arg >> (8 * shift) & 0xFF))
+        code += bytes((opcode, arg & 0xFF))
+        code += bytes(2 * CACHE_ENTRIES[opcode])
+
+    entries = []
+    for i, instruction in enumerate(instructions):
+        handler = instruction[3]
+        if handler is None:
+            continue
+        target = offsets[positions[handler.target]]
+        if entries and entries[-1].end == offsets[i] and entries[-1][2:] == (
+                target, handler.depth, handler.lasti):
+            entries[-1] = entries[-1]._replace(end=offsets[i + 1])
+        else:
+            entries.append(ExceptionEntry(offsets[i], offsets[i + 1], target, handler.depth,
+                                          handler.lasti))
+    return Assembly(bytes(code), write_exception_entries(entries),
+                    [offsets[position] for position in positions])
@@ -0,0 +1,549 @@
+# Stdlib
+from bisect import bisect_left, bisect_right
+from collections import deque
+from dis import HAVE_ARGUMENT, opmap, stack_effect
+import sys
+from types import CodeType
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+# Project Internals
+from bytecode_optimizer._bytecode import (JUMP_OPS, ExceptionEntry, Handler, Op, assemble,
+                                          disassemble, encode, exception_entries)
+from bytecode_optimizer._flags import Flags
+
+UNCONDITIONAL_JUMPS = frozenset(
+    opmap[name] for name in ("JUMP_ABSOLUTE", "JUMP_FORWARD", "JUMP_BACKWARD",
+                             "JUMP_BACKWARD_NO_INTERRUPT", "CONTINUE_LOOP", "BREAK_LOOP")
+    if name in opmap)
+EXITS = frozenset(
+    opmap[name] for name in ("RETURN_VALUE", "RETURN_CONST", "RAISE_VARARGS", "RERAISE")
+    if name in opmap)
+
+# 3.12 also names pseudo instructions of its compiler like this, they never end up in code
+EXCEPTION_SETUPS = frozenset(
+    opmap[name] for name in ("SETUP_EXCEPT", "SETUP_FINALLY", "SETUP_WITH", "SETUP_ASYNC_WITH")
+    if opmap.get(name, 256) < 256)
+
+# Instructions reading a local, 3.12 adds checked loads and the ones of inlined comprehensions
+LOCAL_LOADS = frozenset(
+    opmap[name] for name in ("LOAD_FAST", "LOAD_FAST_CHECK", "LOAD_FAST_AND_CLEAR", "DELETE_FAST")
+    if name in opmap)
+
+BREAK_LOOP = opmap.get("BREAK_LOOP")
+CONTINUE_LOOP = opmap.get("CONTINUE_LOOP")
+SETUP_LOOP = opmap.get("SETUP_LOOP")
+
+# Before 3.8 `stack_effect` only gives the largest effect of an instruction,
+# these are the ones that differ when jumping or when no exception is raised
+STACK_EFFECT_JUMP = sys.version_info >= (3, 8)
+JUMP_EFFECTS = {
+    opmap[name]: effect
+    for name, effect in (("FOR_ITER", -1), ("JUMP_IF_TRUE_OR_POP", 0), ("JUMP_IF_FALSE_OR_POP", 0),
+                         ("SETUP_EXCEPT", 6), ("SETUP_FINALLY", 6), ("SETUP_WITH", 6),
+                         ("SETUP_ASYNC_WITH", 5))
+    if name in opmap
+}
+FALLTHROUGH_EFFECTS = {
+    opmap[name]: effect
+    for name, effect in (("FOR_ITER", 1), ("JUMP_IF_TRUE_OR_POP", -1),
+                         ("JUMP_IF_FALSE_OR_POP", -1), ("SETUP_EXCEPT", 0), ("SETUP_FINALLY", 0),
+                         ("SETUP_WITH", 1), ("SETUP_ASYNC_WITH", 0), ("END_FINALLY", -1),
+                         ("WITH_CLEANUP_START", 1), ("WITH_CLEANUP_FINISH", -2))
+    if name in opmap
+}
+
+# Generators start by popping the value the first `send()` pushed, or since 3.11
+# by discarding what creating the generator left behind
+START_EFFECTS = {opmap[name]: effect for name, effect in (("GEN_START", 0), ("RETURN_GENERATOR", 1))
+                 if name in opmap}
+
+
+def const_key(value: Any) -> Any:
+    # Like the compiler, 1, 1.0, True and 0.0, -0.0 must not share a constant
+    if isinstance(value, tuple):
+        return type(value), tuple(const_key(item) for item in value)
+    if isinstance(value, frozenset):
+        return type(value), frozenset(const_key(item) for item in value)
+    if isinstance(value, (float, complex)):
+        return type(value), repr(value)
+    return type(value), value
+
+
+def add_const(consts: List[Any], value: Any, indices: Dict[Any, int] = None) -> int:
+    """
+    Return the index of `value` in `consts`, adding it if needed.
+
+    `indices` can cache the keys of `consts` between calls.
+    """
+    if indices is None:
+        indices = {}
+    if not indices:
+        for i, const in enumerate(consts):
+            indices.setdefault(const_key(const), i)
+    key = const_key(value)
+    if key not in indices:
+        indices[key] = len(consts)
+        consts.append(value)
+    return indices[key]
+
+
+def get_stack_effect(op: Op, jump: Optional[bool] = None) -> int:
+    """
+    The stack effect of `op`, the largest one unless `jump` picks a branch.
+    """
+    opcode, arg = encode(op)
+    if jump is not None:
+        if not STACK_EFFECT_JUMP:
+            effects = JUMP_EFFECTS if jump else FALLTHROUGH_EFFECTS
+            if opcode in effects:
+                return effects[opcode]
+        else:
+            try:
+                return stack_effect(opcode, arg if opcode >= HAVE_ARGUMENT else None, jump=jump)
+            except ValueError:
+                pass
+    try:
+        return stack_effect(opcode, arg)
+    except ValueError:
+        try:
+            return stack_effect(opcode)
+        except ValueError:
+            return 1
+
+
+def branch_effect(op: Op, jump: bool) -> int:
+    """
+    The stack effect of `op` when it jumps or not, counted like the compiler
+    does: other instructions have the same effect either way.
+    """
+    if op[0] in START_EFFECTS:
+        return START_EFFECTS[op[0]]
+    return get_stack_effect(op, jump=jump if op[0] in JUMP_OPS else None)
+
+
+def is_jump(op: Op) -> bool:
+    return op[0] in JUMP_OPS or op[0] == BREAK_LOOP
+
+
+def falls_through(op: Op) -> bool:
+    return op[0] not in UNCONDITIONAL_JUMPS and op[0] not in EXITS
+
+
+class OffsetIndex:
+    """
+    Maps byte offsets to positions in a list of instructions ordered by offset.
+
+    An offset that no longer starts an instruction, because that instruction was
+    removed, resolves to the instruction after it, same as a jump to it would.
+    """
+    __slots__ = ("offsets", "positions")
+
+    def __init__(self, ops: List[Op]):
+        self.offsets = [op[2] for op in ops]
+        self.positions = {}
+        for i, offset in enumerate(self.offsets):
+            self.positions.setdefault(offset, i)
+
+    def __getitem__(self, offset: int) -> int:
+        try:
+            return self.positions[offset]
+        except KeyError:
+            return bisect_left(self.offsets, offset)
+
+
+class BasicBlock:
+    """
+    A straight-line run of instructions.
+
+    Jumps only ever appear as the last instruction of a block, and their argument
+    is the label of the block they jump to instead of a byte offset.
+    """
+    __slots__ = ("label", "ops")
+
+    def __init__(self, label: int, ops: List[Op]):
+        self.label = label
+        self.ops = ops
+
+    def __iter__(self) -> Iterator[Op]:
+        return iter(self.ops)
+
+    def __repr__(self) -> str:
+        return f"<BasicBlock {self.label} ({len(self.ops)} ops)>"
+
+    @property
+    def jump(self) -> Optional[Op]:
+        if self.ops and is_jump(self.ops[-1]):
+            return self.ops[-1]
+        return None
+
+    @property
+    def falls_through(self) -> bool:
+        return not self.ops or falls_through(self.ops[-1])
+
+
+class ControlFlowGraph:
+    """
+    The basic blocks of a single code object, in layout order.
+
+    Labels are the byte offsets of the first instruction of each block in the
+    original code object; blocks created later get fresh labels from `new_label`.
+    The third item of every instruction is kept as the offset it originally
+    came from.
+    """
+
+    def __init__(self, code: CodeType, blocks: List[BasicBlock], index: OffsetIndex,
+                 exceptions: Sequence[ExceptionEntry] = ()):
+        self.code = code
+        self.blocks = blocks
+        self.index = index
+        # Since 3.11, handlers are looked up by the original offset of an instruction
+        self.exceptions = list(exceptions)
+        self._exception_starts = [entry.start for entry in self.exceptions]
+        self.consts = list(code.co_consts)
+        self._const_indices = {}
+        self.names = list(code.co_names)
+        self.varnames = list(code.co_varnames)
+        self.labels = {block.label: block for block in blocks}
+        self._next_label = max(len(code.co_code), *self.labels)
+        # The flags the passes run with, set by the pass manager
+        self.flags = Flags
+
+    @classmethod
+    def from_code(cls, code: CodeType) -> "ControlFlowGraph":
+        return cls.from_ops(disassemble(code), code)
+
+    @classmethod
+    def from_ops(cls, ops: List[Op], code: CodeType) -> "ControlFlowGraph":
+        # Resolve every jump to the position of the instruction it targets
+        index = OffsetIndex(ops)
+        targets = {}
+        loops = []
+        for i, op in enumerate(ops):
+            while loops and ops[loops[-1]][2] <= op[2]:
+                loops.pop()
+            if op[0] in JUMP_OPS:
+                targets[i] = index[op[1]]
+            elif op[0] == BREAK_LOOP:
+                # Implicitly jumps to the end of the innermost loop; the 3.7 peephole
+                # optimizer can leave one behind in dead code without its loop
+                targets[i] = loops[-1] if loops else i
+            if op[0] == SETUP_LOOP:
+                loops.append(targets[i])
+
+        exceptions = exception_entries(code)
+        leaders = set(targets.values())
+        leaders.update(index[entry.target] for entry in exceptions)
+        leaders.add(0)
+        for i, op in enumerate(ops):
+            if i in targets or not falls_through(op):
+                leaders.add(i + 1)
+
+        # Blocks are labelled with their original offset where it is unique
+        labels = {}
+        used = set()
+        spare = max(index.offsets, default=0)
+        for i in sorted(leaders):
+            if i == len(ops):
+                break
+            label = ops[i][2]
+            if label in used:
+                spare += 1
+                label = spare
+            labels[i] = label
+            used.add(label)
+
+        blocks = []
+        for i, op in enumerate(ops):
+            if i in labels:
+                blocks.append(BasicBlock(labels[i], []))
+            if i in targets:
+                op = (op[0], labels[targets[i]], op[2])
+            blocks[-1].ops.append(op)
+        exceptions = [entry._replace(target=labels[index[entry.target]]) for entry in exceptions]
+        return cls(code, blocks, index, exceptions)
+
+    def __iter__(self) -> Iterator[BasicBlock]:
+        return iter(self.blocks)
+
+    @property
+    def entry(self) -> BasicBlock:
+        return self.blocks[0]
+
+    @property
+    def ops(self) -> List[Op]:
+        return [op for block in self.blocks for op in block.ops]
+
+    def new_label(self) -> int:
+        self._next_label += 1
+        return self._next_label
+
+    def successors(self) -> Dict[int, List[BasicBlock]]:
+        edges = {}
+        for i, block in enumerate(self.blocks):
+            following = []
+            jump = block.jump
+            if jump is not None:
+                following.append(self.labels[jump[1]])
+            if block.falls_through and i + 1 < len(self.blocks):
+                following.append(self.blocks[i + 1])
+            edges[block.label] = following
+        return edges
+
+    def predecessors(self) -> Dict[int, List[BasicBlock]]:
+        edges = {block.label: [] for block in self.blocks}
+        successors = self.successors()
+        for block in self.blocks:
+            for following in successors[block.label]:
+                edges[following.label].append(block)
+        return edges
+
+    def reachable(self) -> Set[int]:
+        # Labels of the blocks the entry can reach, raising included
+        successors = self.successors()
+        handlers = self.handlers()
+        labels = {self.entry.label}
+        pending = [self.entry]
+        while pending:
+            label = pending.pop().label
+            for following in successors[label] + handlers[label]:
+                if following.label not in labels:
+                    labels.add(following.label)
+                    pending.append(following)
+        return labels
+
+    def handlers(self) -> Dict[int, List[BasicBlock]]:
+        """
+        The exception handlers each block may transfer to when it raises.
+
+        A handler protects everything laid out between its SETUP_* instruction
+        and the handler itself, or since 3.11 the instructions the exception
+        table lists for it.
+        """
+        positions = {block.label: i for i, block in enumerate(self.blocks)}
+        protected = {block.label: [] for block in self.blocks}
+        if self.exceptions:
+            for block in self.blocks:
+                for label in dict.fromkeys(entry.target for entry in map(self.handler, block.ops)
+                                           if entry is not None):
+                    protected[block.label].append(self.labels[label])
+        for i, block in enumerate(self.blocks):
+            jump = block.jump
+            if jump is None or jump[0] not in EXCEPTION_SETUPS:
+                continue
+            handler = self.labels[jump[1]]
+            for inner in self.blocks[i + 1:positions[handler.label]]:
+                protected[inner.label].append(handler)
+        return protected
+
+    def handler(self, op: Op) -> Optional[ExceptionEntry]:
+        # The exception table entry covering `op`, by the offset it came from
+        i = bisect_right(self._exception_starts, op[2]) - 1
+        if i >= 0 and op[2] < self.exceptions[i].end:
+            return self.exceptions[i]
+        return None
+
+    def insert(self, position: int, ops: List[Op], label: Optional[int] = None) -> BasicBlock:
+        block = BasicBlock(self.new_label() if label is None else label, ops)
+        self.blocks.insert(position, block)
+        self.labels[block.label] = block
+        return block
+
+    def remove(self, blocks: List[BasicBlock]):
+        removed = {block.label for block in blocks}
+        self.blocks = [block for block in self.blocks if block.label not in removed]
+        for label in removed:
+            del self.labels[label]
+
+    def add_const(self, value: Any) -> int:
+        return add_const(self.consts, value, self._const_indices)
+
+    def add_name(self, name: str) -> int:
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+    def add_local(self, name: str) -> int:
+        # Passes name their locals like `.len`, which no real variable can be called
+        if name not in self.varnames:
+            self.varnames.append(name)
+        return self.varnames.index(name)
+
+
+def block_positions(cfg: ControlFlowGraph) -> Dict[int, int]:
+    # Where the first instruction of every block ends up once laid out
+    positions = {}
+    count = 0
+    for block in cfg:
+        positions[block.label] = count
+        count += len(block.ops)
+    return positions
+
+
+def fix_jumps(cfg: ControlFlowGraph) -> List[Op]:
+    """
+    Lay out the blocks, with the position of their target as argument of jumps.
+    """
+    positions = block_positions(cfg)
+    ops = cfg.ops
+    for i, op in enumerate(ops):
+        if op[0] in JUMP_OPS:
+            ops[i] = (op[0], positions[op[1]], op[2])
+        elif op[0] == BREAK_LOOP:
+            ops[i] = (op[0], 0, op[2])
+    return ops
+
+
+def fix_handlers(cfg: ControlFlowGraph) -> List[Optional[Handler]]:
+    # The exception handler of every instruction `fix_jumps` lays out
+    if not cfg.exceptions:
+        return []
+    positions = block_positions(cfg)
+    handlers = []
+    for op in cfg.ops:
+        entry = cfg.handler(op)
+        handlers.append(None if entry is None else Handler(positions[entry.target], entry.depth,
+                                                           entry.lasti))
+    return handlers
+
+
+def stack_depths(cfg: ControlFlowGraph) -> Dict[int, Optional[int]]:
+    """
+    The value stack depth at the start of every block the entry reaches without
+    an exception being raised.
+
+    Exception handlers and the blocks only they lead to are left out, blocks
+    reached with different depths get None.
+    """
+    depths = {cfg.entry.label: 0}
+    positions = {block.label: i for i, block in enumerate(cfg.blocks)}
+    pending = [cfg.entry]
+    while pending:
+        block = pending.pop()
+        depth = depths[block.label]
+        edges = []
+        jump = block.jump
+        if depth is not None:
+            for op in block.ops[:-1] if jump is not None else block.ops:
+                depth += get_stack_effect(op, jump=False)
+        if jump is not None:
+            # Handlers start with the exception pushed, BREAK_LOOP and CONTINUE_LOOP
+            # unwind the stack; their targets are reached with the right depth
+            # from SETUP_LOOP and the loop itself
+            if jump[0] not in EXCEPTION_SETUPS and jump[0] not in (BREAK_LOOP, CONTINUE_LOOP):
+                edges.append((jump[1], None if depth is None else
+                              depth + get_stack_effect(jump, jump=True)))
+            if depth is not None:
+                depth += get_stack_effect(jump, jump=False)
+        position = positions[block.label] + 1
+        if block.falls_through and position < len(cfg.blocks):
+            edges.append((cfg.blocks[position].label, depth))
+        for label, depth in edges:
+            if depth is not None and depth < 0:
+                depth = None
+            if label not in depths:
+                depths[label] = depth
+            elif depths[label] is not None and depths[label] != depth:
+                depths[label] = None
+            else:
+                continue
+            pending.append(cfg.labels[label])
+    return depths
+
+
+def max_stack_depth(cfg: ControlFlowGraph) -> int:
+    """
+    The deepest the value stack gets on any path from the entry, which is the
+    `co_stacksize` the code needs.
+
+    Jumps, falling through and raising into a handler each get their own stack
+    effect. Where paths meet with different depths the largest one counts, like
+    in the compiler, which before 3.9 enters finally blocks that way. Like the
+    compiler, jumping back doesn't raise the depth of a block already reached:
+    before 3.8 only the largest effects are known, which can add up around a
+    loop, and it would never settle.
+    """
+    positions = {block.label: i for i, block in enumerate(cfg.blocks)}
+    depths = {cfg.entry.label: 0}
+    pending = [cfg.entry]
+    largest = 0
+
+    def reach(label: int, depth: int):
+        if label in depths and positions[label] <= positions[block.label]:
+            return
+        if depth > depths.get(label, -1):
+            depths[label] = depth
+            pending.append(cfg.labels[label])
+
+    while pending:
+        block = pending.pop()
+        depth = depths[block.label]
+        largest = max(largest, depth)
+        for op in block.ops:
+            entry = cfg.handler(op) if cfg.exceptions else None
+            if entry is not None:
+                # The exception, and the offset it was raised at, are pushed for the handler
+                reach(entry.target, entry.depth + entry.lasti + 1)
+            if is_jump(op) and op[0] not in (BREAK_LOOP, CONTINUE_LOOP):
+                # Loops are unwound to the depth SETUP_LOOP had, which reaches the same blocks
+                reach(op[1], depth + branch_effect(op, True))
+            depth += branch_effect(op, False)
+            largest = max(largest, depth)
+        position = positions[block.label] + 1
+        if block.falls_through and position < len(cfg.blocks):
+            reach(cfg.blocks[position].label, depth)
+    return largest
+
+
+def liveness(cfg: ControlFlowGraph) -> Tuple[Dict[int, int], Dict[int, int]]:
+    """
+    Backward liveness of fast locals, as bitsets indexed by local number.
+
+    Returns the variables live at the end of each block, and the variables that
+    stay live throughout each block because a handler protecting it reads them.
+    """
+    store_op = opmap["STORE_FAST"]
+    gen = {}
+    kill = {}
+    for block in cfg:
+        used = stored = 0
+        for op in reversed(block.ops):
+            if op[0] == store_op:
+                used &= ~(1 << op[1])
+                stored |= 1 << op[1]
+            elif op[0] in LOCAL_LOADS:
+                used |= 1 << op[1]
+        gen[block.label] = used
+        kill[block.label] = stored
+
+    successors = cfg.successors()
+    handlers = cfg.handlers()
+    predecessors = {block.label: [] for block in cfg}
+    for block in cfg:
+        for following in successors[block.label] + handlers[block.label]:
+            predecessors[following.label].append(block)
+
+    live_in = dict.fromkeys(gen, 0)
+    live_out = dict.fromkeys(gen, 0)
+    live_exc = dict.fromkeys(gen, 0)
+    pending = deque(reversed(cfg.blocks))
+    queued = set(gen)
+    while pending:
+        block = pending.popleft()
+        label = block.label
+        queued.discard(label)
+        out = 0
+        for following in successors[label]:
+            out |= live_in[following.label]
+        exc = 0
+        for handler in handlers[label]:
+            exc |= live_in[handler.label]
+        live_out[label] = out
+        live_exc[label] = exc
+        new = gen[label] | (out & ~kill[label]) | exc
+        if new != live_in[label]:
+            live_in[label] = new
+            for previous in predecessors[label]:
+                if previous.label not in queued:
+                    queued.add(previous.label)
+                    pending.append(previous)
+    return live_out, live_exc
@@ -0,0 +1,121 @@
+# Stdlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import cache_from_source
+import os
+import sys
+from typing import Iterator, List, Optional, Tuple
+
+# Project Internals
+from bytecode_optimizer._fuzz import fuzz
+from bytecode_optimizer._import_loader import (ByteOptimizerLoader, CACHE_OPTIMIZATION,
+                                               read_cache, write_cache)
+from bytecode_optimizer._profile import use_profile
+
+
+def module_name(path: str) -> str:
+    # Walk up through the enclosing packages, like the import system would find it
+    directory, filename = os.path.split(os.path.abspath(path))
+    parts = [] if filename == "__init__.py" else [filename[:-3]]
+    while os.path.isfile(os.path.join(directory, "__init__.py")):
+        directory, package = os.path.split(directory)
+        parts.insert(0, package)
+    return ".".join(parts)
+
+
+def find_sources(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__" and not d.startswith("."))
+            for filename in sorted(files):
+                if filename.endswith(".py"):
+                    yield os.path.join(root, filename)
+
+
+def compile_file(path: str, force: bool = False) -> Tuple[str, str]:
+    """
+    Write the cache `enable()` would create for `path` and return a status for it.
+    """
+    # Code and profiles refer to files by the absolute path the import system finds them at
+    source = os.path.abspath(path)
+    module = module_name(source)
+    policy = ByteOptimizerLoader.policy
+    flags = policy.flags(module)
+    optimized = policy.should_optimize(module)
+    try:
+        bytecode_path = cache_from_source(source, optimization=CACHE_OPTIMIZATION)
+        st = os.stat(source)
+        if not force and read_cache(bytecode_path, int(st.st_mtime), st.st_size, flags,
+                                    optimized) is not None:
+            return path, "up to date"
+
+        loader = ByteOptimizerLoader(module, source)
+        data = loader.get_data(module)
+        code = loader.source_to_code(data, source, flags=flags)
+        write_cache(bytecode_path, code, int(st.st_mtime), st.st_size, flags, optimized)
+    except Exception as e:  # pylint: disable=broad-except
+        return path, f"failed: {type(e).__name__}: {e}"
+    return path, "optimized" if policy.should_optimize(module, data) else "compiled"
+
+
+def compile_paths(paths: List[str], workers: Optional[int] = None, force: bool = False,
+                  quiet: bool = False, profile: Optional[str] = None) -> bool:
+    sources = list(find_sources(paths))
+    success = True
+    # Workers load the profile themselves, they may not share this process' Flags
+    with ProcessPoolExecutor(max_workers=workers or None,
+                             initializer=use_profile if profile is not None else None,
+                             initargs=(profile, )) as executor:
+        for path, status in executor.map(compile_file, sources, [force] * len(sources),
+                                         chunksize=8):
+            if status.startswith("failed"):
+                success = False
+                print(f"{path}: {status}", file=sys.stderr)
+            elif not quiet:
+                print(f"{path}: {status}")
+    return success
+
+
+def fuzz_main(count: int, seed: int) -> int:
+    mismatches = fuzz(count, seed)
+    for mismatch in mismatches:
+        print(f"seed {mismatch.seed}, f{mismatch.args}: expected {mismatch.expected}, "
+              f"got {mismatch.actual}\n{mismatch.source}")
+    print(f"{len(mismatches)} mismatches in {count} functions")
+    return 1 if mismatches else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = ArgumentParser(prog="python -m bytecode_optimizer")
+    commands = parser.add_subparsers(dest="command")
+    compile_parser = commands.add_parser(
+        "compile", help="optimize every module in a source tree ahead of time")
+    compile_parser.add_argument("paths", nargs="+", metavar="path",
+                                help="files or directories to compile")
+    compile_parser.add_argument("-j", "--workers", type=int, default=0,
+                                help="number of worker processes, defaults to the CPU count")
+    compile_parser.add_argument("-f", "--force", action="store_true",
+                                help="rewrite caches that are up to date")
+    compile_parser.add_argument("-q", "--quiet", action="store_true",
+                                help="only report errors")
+    compile_parser.add_argument("-p", "--profile", metavar="PATH",
+                                help="profile of a training run, optimizes hot code harder "
+                                "and cold code less")
+    fuzz_parser = commands.add_parser(
+        "fuzz", help="compare random functions as compiled and optimized")
+    fuzz_parser.add_argument("-n", "--count", type=int, default=1000,
+                             help="number of functions to check")
+    fuzz_parser.add_argument("-s", "--seed", type=int, default=0,
+                             help="seed of the first function")
+    args = parser.parse_args(argv)
+
+    if args.command == "fuzz":
+        return fuzz_main(args.count, args.seed)
+    if args.command != "compile":
+        parser.print_help()
+        return 2
+    return 0 if compile_paths(args.paths, args.workers, args.force, args.quiet,
+                              args.profile) else 1
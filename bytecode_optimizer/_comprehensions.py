@@ -0,0 +1,280 @@
+# Stdlib
+from dis import hasconst, hasfree, haslocal, hasname, opmap
+from inspect import (CO_ASYNC_GENERATOR, CO_COROUTINE, CO_GENERATOR, CO_ITERABLE_COROUTINE,
+                     CO_OPTIMIZED)
+from types import CodeType
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+# Project Internals
+from bytecode_optimizer._bytecode import (JUMP, PRECALL, RESUME, SWAP_TOP, argument_count, call_ops,
+                                          disassemble, exception_entries)
+from bytecode_optimizer._cfg import (EXCEPTION_SETUPS, SETUP_LOOP, BasicBlock, ControlFlowGraph,
+                                     Op, get_stack_effect)
+from bytecode_optimizer._passes import original_name
+from bytecode_optimizer._stats import stats
+from bytecode_optimizer._tco import line_number
+
+# The container each kind of comprehension builds; generator expressions run
+# lazily, so they stay functions
+BUILDS = {
+    "<listcomp>": opmap["BUILD_LIST"],
+    "<setcomp>": opmap["BUILD_SET"],
+    "<dictcomp>": opmap["BUILD_MAP"],
+}
+# Asynchronous comprehensions, or ones that yield before 3.8, are not plain loops
+UNSUPPORTED_FLAGS = CO_GENERATOR | CO_COROUTINE | CO_ITERABLE_COROUTINE | CO_ASYNC_GENERATOR
+# Saving the call matters less the more the comprehension does
+MAX_INLINED_OPS = 200
+
+# Set up the frame of the comprehension since 3.11, the enclosing one already is
+PROLOGUE_OPS = frozenset(opmap[name] for name in ("RESUME", "COPY_FREE_VARS") if name in opmap)
+BUILD_TUPLE = opmap["BUILD_TUPLE"]
+DELETE_DEREF = opmap["DELETE_DEREF"]
+GET_ITER = opmap["GET_ITER"]
+LOAD_CLOSURE = opmap["LOAD_CLOSURE"]
+LOAD_CONST = opmap["LOAD_CONST"]
+LOAD_FAST = opmap["LOAD_FAST"]
+MAKE_FUNCTION = opmap["MAKE_FUNCTION"]
+RETURN_VALUE = opmap["RETURN_VALUE"]
+STORE_DEREF = opmap["STORE_DEREF"]
+# Comprehensions are called with their iterator, since 3.11 passed like `self`
+COMPREHENSION_CALL = [op[:2] for op in call_ops(0 if PRECALL is not None else 1, 0)]
+# Before 3.11 the qualified name is loaded between the code and MAKE_FUNCTION
+MAKE_POSITION = 2 if RESUME is None else 1
+
+
+class Comprehension(NamedTuple):
+    block: BasicBlock
+    start: int  # position of the first instruction making the function
+    load: int  # of the instruction loading its code
+    call: Optional[int]  # of the instructions calling it, None if it isn't called right away
+    index: int  # of its code in the enclosing constants
+    code: CodeType
+    cells: List[int]  # of the enclosing function, for each of its free variables
+
+
+def find_comprehensions(cfg: ControlFlowGraph) -> Iterator[Comprehension]:
+    for block in cfg:
+        ops = block.ops
+        for i, op in enumerate(ops):
+            if op[0] != LOAD_CONST:
+                continue
+            code = cfg.consts[op[1]]
+            if not isinstance(code, CodeType) or original_name(code.co_name) not in BUILDS:
+                continue
+            # Free variables are passed as a tuple of the cells they refer to
+            size = len(code.co_freevars)
+            closure = ops[i - size - 1:i] if i > size else []
+            if size and [op[:2] for op in closure[-1:]] == [(BUILD_TUPLE, size)] and all(
+                    load[0] == LOAD_CLOSURE for load in closure[:-1]):
+                start, cells = i - size - 1, [load[1] for load in closure[:-1]]
+            else:
+                start, cells = i, []
+            call = find_call(ops, i, 8 if cells else 0)
+            yield Comprehension(block, start, i, call, op[1], code, cells)
+
+
+def find_call(ops: List[Op], load: int, flags: int) -> Optional[int]:
+    # The function is made from just its code, name and closure, and is called
+    # with the iterator of what follows before anything else happens to it
+    make = load + MAKE_POSITION
+    if (make >= len(ops) or ops[make][:2] != (MAKE_FUNCTION, flags)
+            or ops[make - 1][0] != LOAD_CONST):
+        return None
+    depth = 1
+    for i in range(make + 1, len(ops)):
+        op = ops[i]
+        end = i + 1 + len(COMPREHENSION_CALL)
+        if (op[0] == GET_ITER and depth == 2
+                and [call[:2] for call in ops[i + 1:end]] == COMPREHENSION_CALL):
+            return i + 1
+        depth += get_stack_effect(op, jump=False)
+        if depth < 1:
+            return None
+    return None
+
+
+def unsupported(code: CodeType) -> Optional[str]:
+    # Why a comprehension can't be inlined, or None if it can
+    if code.co_flags & UNSUPPORTED_FLAGS:
+        return "asynchronous or a generator"
+    if code.co_cellvars:
+        return "has variables used by code nested in it"
+    ops = disassemble(code)
+    if len(ops) > MAX_INLINED_OPS:
+        return "too large"
+    if exception_entries(code) or any(op[0] in EXCEPTION_SETUPS or op[0] == SETUP_LOOP
+                                      for op in ops):
+        return "sets up blocks of its own"
+    start = next(i for i, op in enumerate(ops) if op[0] not in PROLOGUE_OPS)
+    prologue = [(BUILDS[original_name(code.co_name)], 0), (LOAD_FAST, 0)]
+    if [op[:2] for op in ops[start:start + 2]] != prologue or any(
+            op[0] in haslocal and op[1] == 0 for op in ops[start + 2:]):
+        return "doesn't start like a comprehension"
+    return None
+
+
+def deletes_cells(code: CodeType) -> bool:
+    # Whether `code` or anything nested in it may empty a cell with `del`
+    return any(op[0] == DELETE_DEREF for op in disassemble(code)) or any(
+        deletes_cells(const) for const in code.co_consts if isinstance(const, CodeType))
+
+
+def bound_cells(cfg: ControlFlowGraph) -> Dict[int, int]:
+    """
+    The cells of the function's own variables that certainly hold a value
+    where each block starts, as bitsets indexed like the free instructions.
+
+    Code nested in the function can only empty them with `del`, if it does
+    none are considered bound after the start.
+    """
+    code = cfg.code
+    arguments = code.co_varnames[:argument_count(code)]
+    entry = sum(1 << i for i, name in enumerate(code.co_cellvars) if name in arguments)
+    everything = (1 << len(code.co_cellvars)) - 1
+    gen = {}
+    kill = {}
+    emptied = {}
+    for block in cfg:
+        gen[block.label] = kill[block.label] = emptied[block.label] = 0
+        for op in block.ops:
+            if op[0] == STORE_DEREF:
+                gen[block.label] |= 1 << op[1]
+                kill[block.label] &= ~(1 << op[1])
+            elif op[0] == DELETE_DEREF:
+                gen[block.label] &= ~(1 << op[1])
+                kill[block.label] |= 1 << op[1]
+                emptied[block.label] |= 1 << op[1]
+    if any(deletes_cells(const) for const in cfg.consts if isinstance(const, CodeType)):
+        everything = entry = 0
+
+    successors = cfg.successors()
+    handlers = cfg.handlers()
+    bound_in = dict.fromkeys(gen, everything)
+    bound_in[cfg.entry.label] = entry
+    pending = list(cfg.blocks)
+    while pending:
+        block = pending.pop()
+        label = block.label
+        bound = bound_in[label]
+        # A handler may run anywhere in the block, before it stores anything
+        edges = [(following, (bound & ~kill[label]) | gen[label])
+                 for following in successors[label]]
+        edges += [(handler, bound & ~emptied[label]) for handler in handlers[label]]
+        for following, value in edges:
+            new = bound_in[following.label] & value
+            if new != bound_in[following.label]:
+                bound_in[following.label] = new
+                pending.append(following)
+    return bound_in
+
+
+def inline(cfg: ControlFlowGraph, comprehension: Comprehension):
+    """
+    Replace the call of `comprehension` with a copy of its loop, which runs
+    with the iterator and builds the container on the enclosing stack.
+    """
+    block, start, load, call, index, code, cells = comprehension
+    offset = block.ops[call][2]
+    nested = ControlFlowGraph.from_code(code)
+    labels = {nested_block.label: cfg.new_label() for nested_block in nested}
+    after = cfg.new_label()
+    # Its iterator stays on the stack instead of going through `.0`
+    slots = [None] + [cfg.add_local(f".{index}.{name}") for name in code.co_varnames[1:]]
+    blocks = []
+    for nested_block in nested:
+        jump = nested_block.jump
+        ops = []
+        for op in nested_block.ops:
+            arg = op[1]
+            if op[0] in PROLOGUE_OPS:
+                continue
+            if op[0] == RETURN_VALUE:
+                # The container is left on the stack where the call would have put it
+                ops.append((JUMP, after, offset))
+                continue
+            if op[0] == LOAD_FAST and arg == 0:
+                ops.append((*SWAP_TOP, offset))
+                continue
+            if op is jump:
+                arg = labels[arg]
+            elif op[0] in hasconst:
+                arg = cfg.add_const(nested.consts[arg])
+            elif op[0] in hasname:
+                arg = cfg.add_name(nested.names[arg])
+            elif op[0] in haslocal:
+                arg = slots[arg]
+            elif op[0] in hasfree:
+                # Reads and writes go to the cells the closure would have held
+                arg = cells[arg]
+            # Errors in the loop are reported at the comprehension
+            ops.append((op[0], arg, offset))
+        blocks.append(BasicBlock(labels[nested_block.label], ops))
+
+    ops = block.ops
+    block.ops = ops[:start] + ops[load + MAKE_POSITION + 1:call]
+    position = cfg.blocks.index(block) + 1
+    for new_block in blocks + [BasicBlock(after, ops[call + len(COMPREHENSION_CALL):])]:
+        cfg.insert(position, new_block.ops, new_block.label)
+        position += 1
+
+
+def unbound(cfg: ControlFlowGraph, comprehension: Comprehension) -> bool:
+    # Whether a cell of the function it reads may be empty. The comprehension
+    # would raise NameError for it, inlined it would raise UnboundLocalError
+    own = [cell for cell in comprehension.cells if cell < len(cfg.code.co_cellvars)]
+    if not own:
+        return False
+    bound = bound_cells(cfg)[comprehension.block.label]
+    for op in comprehension.block.ops[:comprehension.start]:
+        if op[0] == STORE_DEREF:
+            bound |= 1 << op[1]
+        elif op[0] == DELETE_DEREF:
+            bound &= ~(1 << op[1])
+    return any(not bound & 1 << cell for cell in own)
+
+
+def report(cfg: ControlFlowGraph, comprehension: Comprehension, status: str):
+    code = cfg.code
+    line = line_number(code, comprehension.block.ops[comprehension.load][2])
+    kind = original_name(comprehension.code.co_name)
+    function = original_name(code.co_name)
+    if cfg.flags.DEBUG:
+        print(f"{code.co_filename}:{line}: {kind} in {function}: {status}")
+    if cfg.flags.COLLECT_STATS:
+        stats.comprehension(code.co_filename, function, line, kind, status)
+
+
+def inline_comprehensions(cfg: ControlFlowGraph) -> int:
+    """
+    Copy the list, set and dict comprehensions of a function into it, saving
+    a function call and a frame each time one runs.
+
+    Comprehensions with variables of their own used by nested code are left
+    alone, as are ones reading a variable of the function that may not be
+    assigned yet; their loop variables become locals of the function that
+    nothing else uses. Python 3.12 already inlines them itself.
+    """
+    if not cfg.code.co_flags & CO_OPTIMIZED:
+        # Module and class bodies keep their variables in a dict
+        return 0
+    inlined = 0
+    skipped = set()
+    while True:
+        for comprehension in find_comprehensions(cfg):
+            if comprehension.index in skipped:
+                continue
+            status = unsupported(comprehension.code)
+            if status is None and comprehension.call is None:
+                status = "not called where it is made"
+            if status is None and unbound(cfg, comprehension):
+                status = "uses a variable that may not be assigned yet"
+            report(cfg, comprehension, status or "inlined")
+            if status is None:
+                break
+            skipped.add(comprehension.index)
+        else:
+            return inlined
+        # Inlining moves the instructions after it, so look for the next one again
+        inline(cfg, comprehension)
+        inlined += 1
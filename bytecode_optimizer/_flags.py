@@ -0,0 +1,72 @@
+# Stdlib
+from functools import lru_cache
+from typing import Any, Mapping, Optional, Tuple
+
+
+class Flags:
+    DEBUG = False
+    REMOVE_UNUSED_VARS = True
+    TAIL_CALL_OPTIMIZATION = True
+    OPTIMIZE_ACCESSORS = True
+    OPTIMIZE_NAMES = True
+    OPTIMIZE_JUMPS = True
+    # Opt-in, hoisted loads no longer see globals rebound while a loop runs
+    HOIST_LOADS = False
+    # Opt-in, inlined comprehensions no longer show up as frames of their own
+    INLINE_COMPREHENSIONS = False
+    # Upper bound on rounds over the passes, they usually settle sooner
+    OPTIMIZE_ITERATIONS = 10
+    COLLECT_STATS = False
+    # Number of optimized code objects kept for reuse, 0 disables the memo
+    MEMO_SIZE = 1024
+    # A `Profile` from a training run, code that ran at least PROFILE_HOT_COUNT
+    # times, counting loop iterations, is optimized harder and the rest less
+    PROFILE = None
+    PROFILE_HOT_COUNT = 1000
+    # Optimize imported functions once they were called this many times
+    # instead of at import, 0 optimizes everything up front
+    LAZY_CALLS = 0
+    # Check optimized code before using it, and keep the original if it is broken
+    VERIFY = True
+    # Names of the passes to run, None runs every registered pass
+    PASSES = None
+
+
+def flags_key(flags: type = Flags) -> Tuple[Tuple[str, Any], ...]:
+    # Every flag that can change the generated bytecode
+    return tuple((k, getattr(flags, k)) for k in sorted(dir(flags))
+                 if k.isupper() and k not in ("DEBUG", "COLLECT_STATS", "MEMO_SIZE"))
+
+
+class FrozenFlags(type):
+    """
+    The type of snapshots, whose flags can't be changed once taken.
+    """
+
+    def __setattr__(cls, name: str, value: Any):
+        raise AttributeError(f"Can't set {name} on a snapshot of the flags, set it on Flags")
+
+    def __delattr__(cls, name: str):
+        raise AttributeError(f"Can't delete {name} from a snapshot of the flags")
+
+
+def snapshot(flags: type = Flags, overrides: Optional[Mapping[str, Any]] = None) -> type:
+    """
+    The current value of every flag in `flags`, changed by `overrides`, as a
+    subclass of it that can't be changed. Code optimized with a snapshot sees
+    the same flags throughout, even while other threads change `Flags`.
+    """
+    if isinstance(flags, FrozenFlags) and not overrides:
+        return flags
+    values = {k: getattr(flags, k) for k in dir(flags) if k.isupper()}
+    values.update(overrides or {})
+    try:
+        return _snapshot(flags, tuple(sorted(values.items())))
+    except TypeError:
+        # Unhashable flag values can't be cached
+        return FrozenFlags(flags.__name__, (flags, ), values)
+
+
+@lru_cache(maxsize=64)
+def _snapshot(flags: type, values: Tuple[Tuple[str, Any], ...]) -> type:
+    return FrozenFlags(flags.__name__, (flags, ), dict(values))
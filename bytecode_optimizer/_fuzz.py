@@ -0,0 +1,183 @@
+# Stdlib
+from random import Random
+from types import CodeType
+from typing import Any, List, NamedTuple, Tuple
+import warnings
+
+# Project Internals
+from bytecode_optimizer._flags import Flags
+from bytecode_optimizer._optimizer import optimize_code
+
+ARGUMENTS = ((0, 0), (1, 2), (3, -1), (-2, 5), (7, 3))
+VARIABLES = ("x", "y", "z", "w")
+BINARY = ("+", "-", "*", "//", "%", "&", "|", "^")
+COMPARE = ("<", "<=", "==", "!=", ">", ">=")
+EXCEPTIONS = ("ZeroDivisionError", "IndexError", "NameError", "ArithmeticError", "Exception")
+
+
+class FunctionGenerator:
+    """
+    Writes the source of a random function `f(a, b)` from integer arithmetic,
+    branches, bounded loops, exception handling, comprehensions and recursion.
+
+    Everything it writes terminates quickly, but may raise.
+    """
+
+    def __init__(self, rng: Random):
+        self.rng = rng
+        self.lines = []  # type: List[str]
+        self.loops = 0
+        self.counters = 0
+
+    def source(self) -> str:
+        self.lines = ["def f(a, b):"]
+        for i, variable in enumerate(VARIABLES):
+            if self.rng.random() < 0.9:
+                self.line(1, f"{variable} = {i}")
+        self.block(1, 6)
+        self.line(1, f"return {self.expr(2)}")
+        return "\n".join(self.lines) + "\n"
+
+    def line(self, indent: int, text: str):
+        self.lines.append("    " * indent + text)
+
+    def name(self) -> str:
+        # Locals may be unbound and `missing` is never defined, which must raise the same way
+        if self.rng.random() < 0.02:
+            return "missing"
+        return self.rng.choice(VARIABLES + ("a", "b"))
+
+    def expr(self, depth: int) -> str:
+        rng = self.rng
+        choice = rng.randrange(12 if depth > 0 else 3)
+        if choice == 0:
+            return str(rng.randint(-3, 10))
+        if choice in (1, 2):
+            return self.name()
+        sub = depth - 1
+        if choice in (3, 4, 5):
+            return f"({self.expr(sub)} {rng.choice(BINARY)} {self.expr(sub)})"
+        if choice == 6:
+            return f"({self.expr(sub)} {rng.choice(COMPARE)} {self.expr(sub)})"
+        if choice == 7:
+            return f"({self.expr(sub)} {rng.choice(('and', 'or'))} {self.expr(sub)})"
+        if choice == 8:
+            return f"({self.expr(sub)} if {self.expr(sub)} else {self.expr(sub)})"
+        if choice == 9:
+            return f"({self.expr(sub)}, {self.expr(sub)}, {self.expr(sub)})[{self.expr(sub)}]"
+        if choice == 10:
+            return (f"sum([{self.expr(sub)} for {rng.choice(VARIABLES)} in range(3)"
+                    f" if {self.expr(sub)}])")
+        return f"{rng.choice(('abs', 'len', 'str', 'min', 'max'))}(({self.expr(sub)}, ))"
+
+    def block(self, indent: int, size: int):
+        for _ in range(self.rng.randint(1, size)):
+            self.statement(indent)
+
+    def statement(self, indent: int):
+        rng = self.rng
+        choice = rng.randrange(12 if indent < 4 else 6)
+        if choice == 6 and rng.random() < 0.3:
+            self.line(indent, f"del {rng.choice(VARIABLES)}")
+        elif choice in (0, 1, 2, 6):
+            self.line(indent, f"{rng.choice(VARIABLES)} = {self.expr(2)}")
+        elif choice == 3:
+            self.line(indent, f"{rng.choice(VARIABLES)} {rng.choice(BINARY)}= {self.expr(1)}")
+        elif choice == 4:
+            # Has to evaluate even though the value is thrown away
+            self.line(indent, self.expr(1))
+        elif choice == 5:
+            if self.loops and rng.random() < 0.5:
+                self.line(indent, rng.choice(("break", "continue")))
+            else:
+                self.line(indent, f"return {self.expr(2)}")
+        elif choice in (7, 8):
+            self.line(indent, f"if {self.expr(2)}:")
+            self.block(indent + 1, 3)
+            if rng.random() < 0.5:
+                self.line(indent, "else:")
+                self.block(indent + 1, 3)
+        elif choice == 9:
+            self.loop(indent)
+        elif choice == 10:
+            self.line(indent, "try:")
+            self.block(indent + 1, 3)
+            self.line(indent, f"except {rng.choice(EXCEPTIONS)}:")
+            self.block(indent + 1, 2)
+            if rng.random() < 0.3:
+                self.line(indent, "finally:")
+                self.line(indent + 1, f"{rng.choice(VARIABLES)} = {self.expr(1)}")
+        else:
+            # Recursion that stops, a tail call where the optimizer can see it
+            self.line(indent, "if 0 < a < 6:")
+            self.line(indent + 1, f"return f(a - 1, {self.expr(1)})")
+
+    def loop(self, indent: int):
+        self.loops += 1
+        if self.rng.random() < 0.5:
+            self.line(indent, f"for {self.rng.choice(VARIABLES)} in range({self.expr(1)} % 4):")
+            self.block(indent + 1, 3)
+        else:
+            # The counter goes up before anything can `continue`
+            counter = f"i{self.counters}"
+            self.counters += 1
+            self.line(indent, f"{counter} = 0")
+            self.line(indent, f"while {counter} < 3:")
+            self.line(indent + 1, f"{counter} += 1")
+            self.block(indent + 1, 3)
+        self.loops -= 1
+
+
+class Mismatch(NamedTuple):
+    seed: int
+    source: str
+    args: Tuple[int, int]
+    expected: Any
+    actual: Any
+
+
+def outcome(func, args: Tuple[int, int]) -> Tuple[Any, ...]:
+    try:
+        return "return", func(*args)
+    except Exception as e:  # pylint: disable=broad-except
+        return "raise", type(e), e.args
+
+
+def check(seed: int, flags: type = Flags) -> List[Mismatch]:
+    """
+    Run the function generated from `seed` as compiled and optimized with
+    `flags`, and return every call where the two disagree.
+    """
+    source = FunctionGenerator(Random(seed)).source()
+    code = compile(source, f"<fuzz {seed}>", "exec")
+    try:
+        with warnings.catch_warnings():
+            # Code the verifier refused counts as a failure here
+            warnings.simplefilter("error", RuntimeWarning)
+            optimized = optimize_code(code, flags)
+    except Exception as e:  # pylint: disable=broad-except
+        return [Mismatch(seed, source, (), "optimized", f"{type(e).__name__}: {e}")]
+
+    expected, actual = run(code), run(optimized)
+    return [Mismatch(seed, source, args, *results)
+            for args, results in zip(ARGUMENTS, zip(expected, actual))
+            if results[0] != results[1]]
+
+
+def run(code: CodeType) -> List[Tuple[Any, ...]]:
+    namespace = {}
+    exec(code, namespace)  # pylint: disable=exec-used
+    return [outcome(namespace["f"], args) for args in ARGUMENTS]
+
+
+def fuzz(count: int, seed: int = 0, flags: type = Flags) -> List[Mismatch]:
+    """
+    Check `count` generated functions, starting from `seed`.
+
+    A crash takes the interpreter down with it; the seeds are consecutive, so
+    running a smaller range narrows it down to the function that caused it.
+    """
+    mismatches = []
+    for i in range(seed, seed + count):
+        mismatches += check(i, flags)
+    return mismatches
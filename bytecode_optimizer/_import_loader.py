@@ -1,13 +1,89 @@
 # Stdlib
-import dis
-from importlib._bootstrap_external import FileFinder, SourceLoader
+from hashlib import sha1
+import _imp
+from importlib._bootstrap_external import FileFinder, SourceLoader, _write_atomic
+from importlib.util import MAGIC_NUMBER, cache_from_source
+import marshal
+import os
 import sys
+import sysconfig
+from types import CodeType
+from typing import Optional
 
 # Project Internals
-from bytecode_optimizer._optimizer import optimize_code, Flags
+from bytecode_optimizer._optimizer import __version__, Flags, optimize_code, flags_key, passes
+from bytecode_optimizer._lazy import install, instrument
+from bytecode_optimizer._policy import Policy
+from bytecode_optimizer._profile import use_profile
+from bytecode_optimizer._stats import stats
+
+# Cached files are stored next to the regular ones as `<name>.<tag>.opt-bco.pyc`
+CACHE_OPTIMIZATION = "bco"
+
+
+def cache_key(flags: type = Flags, optimized: bool = True) -> bytes:
+    # Optimized bytecode depends on the optimizer itself, the flags and passes it ran with,
+    # whether the policy optimizes the module at all, and on -O, which strips asserts and
+    # docstrings before the optimizer sees the code
+    active = [pass_.name for pass_ in passes.active(flags)]
+    key = (__version__, flags_key(flags), active, optimized, sys.flags.optimize)
+    return sha1(repr(key).encode()).digest()
+
+
+def read_cache(path: str, mtime: int, size: int, flags: type = Flags,
+               optimized: bool = True) -> Optional[CodeType]:
+    try:
+        with open(path, "rb") as fp:
+            data = fp.read()
+    except OSError:
+        return None
+    header = MAGIC_NUMBER + cache_key(flags, optimized) + _pack_stats(mtime, size)
+    if data[:len(header)] != header:
+        return None
+    try:
+        code = marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return None
+    return code if isinstance(code, CodeType) else None
+
+
+def write_cache(path: str, code: CodeType, mtime: int, size: int, flags: type = Flags,
+                optimized: bool = True):
+    header = MAGIC_NUMBER + cache_key(flags, optimized) + _pack_stats(mtime, size)
+    data = header + marshal.dumps(code)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_atomic(path, data)
+    except OSError:
+        # Read-only locations simply don't get a cache, same as regular .pyc files
+        pass
+
+
+def is_stdlib(path: str) -> bool:
+    paths = sysconfig.get_paths()
+    return (_within(path, paths, "stdlib", "platstdlib")
+            and not _within(path, paths, "purelib", "platlib"))
+
+
+def _within(path: str, paths: dict, *keys: str) -> bool:
+    path = os.path.normcase(os.path.abspath(path))
+    for key in keys:
+        if key not in paths:
+            continue
+        directory = os.path.normcase(os.path.abspath(paths[key]))
+        if path == directory or path.startswith(directory.rstrip(os.sep) + os.sep):
+            return True
+    return False
+
+
+def _pack_stats(mtime: int, size: int) -> bytes:
+    return (mtime & 0xFFFFFFFF).to_bytes(4, "little") + (size & 0xFFFFFFFF).to_bytes(4, "little")
 
 
 class ByteOptimizerLoader(SourceLoader):
+    # Which modules to optimize and how, set by `enable()`
+    policy = Policy()
+
     def __init__(self, *args):
         self.module, self.path = args
 
@@ -18,28 +94,65 @@ class ByteOptimizerLoader(SourceLoader):
         with open(self.path, "rb") as fp:
             return fp.read()
 
-    def source_to_code(self, data, path='<string>', **_):
+    def get_code(self, fullname):
+        try:
+            bytecode_path = cache_from_source(self.path, optimization=CACHE_OPTIMIZATION)
+        except NotImplementedError:
+            bytecode_path = None
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
+
+        # Other threads may change the flags meanwhile, the whole import uses one snapshot
+        flags = self.policy.flags(self.module)
+        # Modules marked `# no-optimize` are covered by the source's size and mtime
+        optimized = self.policy.should_optimize(self.module)
+        if flags.LAZY_CALLS:
+            # Instrumented code calls the trampoline, whether it comes from the cache or not
+            install(self.policy)
+        if bytecode_path is not None and st is not None:
+            code = read_cache(bytecode_path, int(st.st_mtime), st.st_size, flags, optimized)
+            if code is not None:
+                # The cache may have been written for a copy of the file elsewhere
+                _imp._fix_co_filename(code, self.path)
+                return code
+
+        code = self.source_to_code(self.get_data(fullname), self.path, flags=flags)
+        if not sys.dont_write_bytecode and bytecode_path is not None and st is not None:
+            write_cache(bytecode_path, code, int(st.st_mtime), st.st_size, flags, optimized)
+        return code
+
+    def source_to_code(self, data, path='<string>', *, flags: Optional[type] = None, **_):
         code = SourceLoader.source_to_code(self, data, path)
-        # is_site_package_or_local = ("python" not in self.path or "site-packages" in self.path)
-        excluded_modules = ("six", )
-        if b"# no-optimize" not in data and not self.module.startswith(
-                "_") and self.module not in excluded_modules:
-            # Don't optimize python internals or files marked
-            # with `# no-optimize` anywhere in the file
-            for _ in range(Flags.OPTIMIZE_ITERATIONS):
-                code = optimize_code(code)
+        if self.policy.should_optimize(self.module, data):
+            flags = flags or self.policy.flags(self.module)
+            if flags.LAZY_CALLS:
+                return instrument(code)
+            with stats.module(self.module):
+                code = optimize_code(code, flags)
         return code
 
     @classmethod
-    def enable(cls):
+    def enable(cls, policy: Optional[Policy] = None):
+        if policy is not None:
+            cls.policy = policy
         loader_opts = [cls, [".py"]]
         sys.path_hooks.insert(0, FileFinder.path_hook(loader_opts))
         for k, v in sys.path_importer_cache.copy().items():
-            if isinstance(v, FileFinder) and ("python3" not in v.path
-                                              or "site-packages" in v.path):
+            if isinstance(v, FileFinder) and not is_stdlib(v.path):
                 # Don't modify stdlib
                 del sys.path_importer_cache[k]
 
 
-def enable():
-    ByteOptimizerLoader.enable()
+def enable(profile: Optional[str] = None, policy: Optional[Policy] = None):
+    """
+    Optimize modules imported from now on, guided by the profile file at
+    `profile` if given, see `Recorder`.
+
+    `policy` decides which modules are optimized and with which flags, by
+    default everything but modules starting with an underscore and `six`.
+    """
+    if profile is not None:
+        use_profile(profile)
+    ByteOptimizerLoader.enable(policy)
@@ -0,0 +1,104 @@
+# Stdlib
+import builtins
+from dis import opmap
+import gc
+from inspect import CO_OPTIMIZED
+import sys
+from types import CodeType, FunctionType
+from typing import Dict, Optional
+
+# Project Internals
+from bytecode_optimizer._bytecode import (PUSH_NULL, RESUME, assemble, call_ops, cell_slots,
+                                          replace, write_line_table)
+from bytecode_optimizer._cfg import ControlFlowGraph, fix_handlers, fix_jumps, max_stack_depth
+from bytecode_optimizer._optimizer import optimize_code
+from bytecode_optimizer._policy import Policy
+from bytecode_optimizer._stats import stats
+
+# Looked up through the builtins by every function that isn't optimized yet
+TRAMPOLINE = "__bytecode_optimizer_lazy__"
+# Comprehensions are optimized with the function they are in, each run makes a
+# new function object so there is nothing to swap
+COMPREHENSIONS = ("<listcomp>", "<setcomp>", "<dictcomp>", "<genexpr>")
+
+
+def instrument(code: CodeType) -> CodeType:
+    """
+    Make every function in `code` call the trampoline with its original code
+    when it starts, until the trampoline replaces it with the optimized code.
+    """
+    consts = tuple(instrument(const) if isinstance(const, CodeType) else const
+                   for const in code.co_consts)
+    if not code.co_flags & CO_OPTIMIZED or code.co_name in COMPREHENSIONS:
+        return replace(code, co_consts=consts)
+    original = code
+    cfg = ControlFlowGraph.from_code(replace(code, co_consts=consts))
+    ops = cfg.entry.ops
+    # Since 3.11 cells and generators are set up before RESUME
+    start = next((i + 1 for i, op in enumerate(ops) if op[0] == RESUME), 0)
+    offset = ops[max(start - 1, 0)][2]
+    prologue = [(opmap["LOAD_GLOBAL"], cfg.add_name(TRAMPOLINE), offset),
+                (opmap["LOAD_CONST"], cfg.add_const(original), offset),
+                *call_ops(1, offset), (opmap["POP_TOP"], 0, offset)]
+    if PUSH_NULL is not None:
+        prologue.insert(0, (PUSH_NULL, 0, offset))
+    if start:
+        ops[start:start] = prologue
+    else:
+        # The first instruction may start a loop, which must not run this again
+        cfg.insert(0, prologue)
+
+    ops = fix_jumps(cfg)
+    assembly = assemble(ops, fix_handlers(cfg),
+                        cell_slots(code.co_varnames, code.co_cellvars, code.co_freevars))
+    return replace(cfg.code, co_code=assembly.code, co_consts=tuple(cfg.consts),
+                   co_names=tuple(cfg.names), co_stacksize=max_stack_depth(cfg),
+                   co_exceptiontable=assembly.exception_table,
+                   co_linetable=write_line_table(ops, assembly.offsets, len(assembly.code),
+                                                 code))
+
+
+class Trampoline:
+    """
+    Counts the calls of instrumented functions, and once one reached
+    `Flags.LAZY_CALLS` calls, optimizes it with the flags `policy` gives its module.
+    """
+
+    def __init__(self, policy: Policy):
+        self.policy = policy
+        self.calls = {}  # type: Dict[CodeType, int]
+        self.flags = {}  # type: Dict[CodeType, type]
+        self.optimized = {}  # type: Dict[CodeType, CodeType]
+
+    def __call__(self, original: CodeType):
+        calls = self.calls[original] = self.calls.get(original, 0) + 1
+        frame = sys._getframe(1)
+        module = frame.f_globals.get("__name__")
+        flags = self.flags.get(original)
+        if flags is None:
+            flags = self.flags[original] = self.policy.flags(module)
+        # Functions created after the swap still run the instrumented code,
+        # searching for them again every so often keeps that cheap
+        if calls % max(flags.LAZY_CALLS, 1):
+            return
+        instrumented = frame.f_code
+        functions = [
+            referrer for referrer in gc.get_referrers(instrumented)
+            if isinstance(referrer, FunctionType) and referrer.__code__ is instrumented
+        ]
+        if not functions:
+            return
+        code = self.optimized.get(original)
+        if code is None:
+            with stats.module(module):
+                code = self.optimized[original] = optimize_code(original, flags)
+        for func in functions:
+            func.__code__ = code
+
+
+def install(policy: Optional[Policy] = None):
+    trampoline = getattr(builtins, TRAMPOLINE, None)
+    if trampoline is None:
+        setattr(builtins, TRAMPOLINE, Trampoline(policy or Policy()))
+    elif policy is not None:
+        trampoline.policy = policy
@@ -0,0 +1,85 @@
+# Stdlib
+from collections import OrderedDict
+import threading
+from types import CodeType
+from typing import Any, Hashable, Optional, Tuple
+
+# Project Internals
+from bytecode_optimizer._bytecode import exception_table, line_table, replace
+from bytecode_optimizer._cfg import const_key
+
+
+def code_key(code: CodeType, base_lineno: Optional[int] = None) -> Tuple[Any, ...]:
+    """
+    A key identifying `code` by its contents, ignoring where it was defined.
+
+    The file, first line and name of the outer code object are left out so
+    identical code from other places shares a key; nested code objects keep
+    their name and line relative to the outer one.
+    """
+    location = () if base_lineno is None else (code.co_name, code.co_firstlineno - base_lineno)
+    return location + (
+        code.co_argcount, getattr(code, "co_posonlyargcount", 0), code.co_kwonlyargcount,
+        code.co_nlocals, code.co_flags, code.co_code,
+        tuple(
+            code_key(const, code.co_firstlineno) if isinstance(const, CodeType) else
+            const_key(const) for const in code.co_consts),
+        code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars, line_table(code),
+        exception_table(code))
+
+
+def restamp(code: CodeType, filename: str, firstlineno: int, name: str,
+            qualname: Optional[str] = None) -> CodeType:
+    # Move a cached result, and the code nested in it, to where `code` was defined
+    old_qualname = getattr(code, "co_qualname", None)
+    qualname = qualname or old_qualname
+    if (code.co_filename, code.co_firstlineno, code.co_name, old_qualname) == (
+            filename, firstlineno, name, qualname):
+        return code
+    offset = firstlineno - code.co_firstlineno
+    consts = tuple(
+        restamp(const, filename, const.co_firstlineno + offset, const.co_name,
+                nested_qualname(const, old_qualname, qualname))
+        if isinstance(const, CodeType) else const for const in code.co_consts)
+    return replace(code, co_consts=consts, co_filename=filename, co_name=name,
+                   co_firstlineno=firstlineno, co_qualname=qualname)
+
+
+def nested_qualname(code: CodeType, old_prefix: Optional[str],
+                    new_prefix: Optional[str]) -> Optional[str]:
+    # Since 3.11 code knows its qualified name, which starts with that of the enclosing code
+    qualname = getattr(code, "co_qualname", None)
+    if qualname is None or old_prefix is None or not qualname.startswith(old_prefix + "."):
+        return qualname
+    return new_prefix + qualname[len(old_prefix):]
+
+
+class CodeMemo:
+    """
+    A bounded LRU mapping of code objects to their optimized versions.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[CodeType]:
+        with self._lock:
+            code = self._entries.get(key)
+            if code is not None:
+                self._entries.move_to_end(key)
+            return code
+
+    def put(self, key: Hashable, code: CodeType, maxsize: int):
+        with self._lock:
+            self._entries[key] = code
+            self._entries.move_to_end(key)
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,204 +1,298 @@
 # Stdlib
-from dis import dis, opmap, hasjabs, hasjrel, hasname, hasconst, haslocal, stack_effect
+from collections import Counter
+from dis import dis, opmap, hasname, hasconst, haslocal
+from inspect import CO_OPTIMIZED
 import operator
-from struct import pack
+from time import perf_counter
 from types import CodeType
-from typing import T, Any, List, Tuple, Sequence, Generator
-
-
-class Flags:
-    DEBUG = False
-    REMOVE_UNUSED_VARS = True
-    TAIL_CALL_OPTIMIZATION = True
-    OPTIMIZE_ACCESSORS = True
-    OPTIMIZE_NAMES = True
-    OPTIMIZE_ITERATIONS = 3
-
-
-def debug(*args):
-    if Flags.DEBUG:
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+import warnings
+
+try:
+    from opcode import _nb_ops
+except ImportError:
+    _nb_ops = ()
+
+# Project Internals
+from bytecode_optimizer._bytecode import (DUP_TOP, JUMP, LOAD_METHOD, POP_JUMP_IF_FALSE,
+                                          POP_JUMP_IF_TRUE, PUSH_NULL, SWAP_TOP,
+                                          argument_count, can_jump_backward, cell_slots,
+                                          replace, write_line_table)
+from bytecode_optimizer._cfg import (LOCAL_LOADS, BasicBlock, ControlFlowGraph, Op, add_const,
+                                     assemble, fix_handlers, fix_jumps, max_stack_depth,
+                                     liveness)
+from bytecode_optimizer._comprehensions import inline_comprehensions
+from bytecode_optimizer._flags import Flags, flags_key, snapshot
+from bytecode_optimizer._memo import CodeMemo, code_key, restamp
+from bytecode_optimizer._passes import PassManager, original_name
+from bytecode_optimizer._patterns import Rule, apply_rules
+from bytecode_optimizer._profile import profile_flags
+from bytecode_optimizer._stats import stats
+from bytecode_optimizer._tco import optimize_tail_calls
+from bytecode_optimizer._verify import VerificationError, verify
+
+__version__ = "0.1.2"
+
+
+NOT_FOLDED = object()
+# Limits on the constants folding may create
+MAX_INT_SIZE = 128  # bits
+MAX_STR_SIZE = 4096
+MAX_COLLECTION_SIZE = 256
+
+OPERATORS = (
+    ("POWER", operator.pow), ("MULTIPLY", operator.mul),
+    ("MATRIX_MULTIPLY", operator.matmul), ("FLOOR_DIVIDE", operator.floordiv),
+    ("TRUE_DIVIDE", operator.truediv), ("MODULO", operator.mod),
+    ("ADD", operator.add), ("SUBTRACT", operator.sub),
+    ("LSHIFT", operator.lshift), ("RSHIFT", operator.rshift),
+    ("AND", operator.and_), ("XOR", operator.xor), ("OR", operator.or_),
+    ("SUBSCR", operator.getitem))
+BINARY_OPERATORS = {
+    opmap[prefix + name]: func
+    for name, func in OPERATORS
+    for prefix in ("BINARY_", "INPLACE_") if prefix + name in opmap
+}
+# Since 3.11 a single BINARY_OP takes the operator as argument
+BINARY_OP = opmap.get("BINARY_OP")
+BINARY_OP_OPERATORS = {
+    i: func
+    for i, (slot, _) in enumerate(_nb_ops)
+    for name, func in OPERATORS
+    if slot.replace("INPLACE_", "") == "NB_" + name.replace("MODULO", "REMAINDER")
+}
+UNARY_OPERATORS = {
+    opmap[name]: func
+    for name, func in (("UNARY_POSITIVE", operator.pos), ("UNARY_NEGATIVE", operator.neg),
+                       ("UNARY_NOT", operator.not_), ("UNARY_INVERT", operator.invert))
+    if name in opmap
+}
+# Indexed by COMPARE_OP argument, `is` and exception matching are never folded
+COMPARE_OPERATORS = (operator.lt, operator.le, operator.eq, operator.ne,
+                     operator.gt, operator.ge, lambda a, b: a in b,
+                     lambda a, b: a not in b)
+CONTAINS_OP = opmap.get("CONTAINS_OP")
+
+PLAIN_JUMPS = tuple(opmap[name] for name in ("JUMP_ABSOLUTE", "JUMP_FORWARD") if name in opmap)
+# Jumps that can be pointed straight at the end of a jump chain
+THREADED_JUMPS = frozenset((*PLAIN_JUMPS, POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE, *(
+    opmap[name] for name in ("JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP") if name in opmap)))
+CALL_METHOD = opmap.get("CALL_METHOD")
+LOAD_FAST_AND_CLEAR = opmap.get("LOAD_FAST_AND_CLEAR")
+RETURNS = tuple(opmap[name] for name in ("RETURN_VALUE", "RETURN_CONST") if name in opmap)
+
+# Pushes that can't raise or have any other effect, so can be dropped together
+# with a POP_TOP; LOAD_FAST raises for unbound locals before 3.12 added LOAD_FAST_CHECK
+PURE_PUSHES = frozenset(opmap[name] for name in (
+    "LOAD_CONST", "LOAD_CLOSURE", "DUP_TOP", "COPY", "PUSH_NULL", "LOAD_ASSERTION_ERROR",
+    *(("LOAD_FAST", ) if "LOAD_FAST_CHECK" in opmap else ())) if name in opmap)
+# Building an empty container can't fail either
+EMPTY_BUILDS = frozenset(opmap[name] for name in ("BUILD_TUPLE", "BUILD_LIST", "BUILD_SET",
+                                                   "BUILD_MAP"))
+
+INVERTED_JUMPS = {
+    POP_JUMP_IF_FALSE: POP_JUMP_IF_TRUE,
+    POP_JUMP_IF_TRUE: POP_JUMP_IF_FALSE,
+}
+
+
+def debug(flags: type, *args):
+    if flags.DEBUG:
         print(*args)
 
 
-def dump(ops: List[Tuple[int, int, int]]):
-    if Flags.DEBUG:
+def dump(flags: type, ops: List[Op]):
+    if flags.DEBUG:
         print("-" * 50)
-        dis(b"".join(pack("BB", op[0], op[1]) for op in ops))
-
-
-def iter_size(it: Sequence[T],
-              size: int) -> Generator[Sequence[T], None, None]:
-    index = 0
-    while index < len(it) - size:
-        yield it[index:index + size]
-        index += 1
-
-
-def is_name_used_upper(name: str, code: CodeType) -> bool:
-    return name not in code.co_varnames
-
-
-def remove_unused_variables(ops: List[Tuple[int, int, int]],
-                            code: CodeType) -> List[Tuple[int, int, int]]:
-    found = True
-    continuefrom = 0
-    while found:
-        copy_ops = ops[continuefrom:]
-        found = False
-        stored = None
-        stored_index = 0
-        for i, op in enumerate(copy_ops):
-            i = i + continuefrom
-            if stored is None and op[0] in (opmap["STORE_FAST"],
-                                            opmap["STORE_NAME"]):
-                if op[0] == opmap["STORE_FAST"]:
-                    if not is_name_used_upper(code.co_varnames[op[1]], code):
-                        debug(f"Checking: {op}")
-                        stored = op
-                        stored_index = i
-                elif op[0] == opmap["STORE_NAME"]:
-                    if not is_name_used_upper(code.co_names[op[1]], code):
-                        debug(f"Checking: {op}")
-                        stored = op
-                        stored_index = i
-
-            elif stored and op[0] in (*haslocal, *hasname):
-                if op[1] == stored[1]:
-                    if op[0] == stored[0]:  # Same store
-                        debug(f"Found overriding store {op} for {stored}")
-                        # Useless variable
-                        ops[stored_index] = (opmap["POP_TOP"], 0, stored[2])
-                        continuefrom = stored_index + 1
-                        found = True
-                        break
-                    if ((op[0] in haslocal
-                         and stored[0] == opmap["STORE_FAST"])
-                            or (op[0] in hasname
-                                and stored[0] == opmap["STORE_NAME"])):
-                        debug(f"Found load {op} for {stored}")
-                        # variable is used
-                        continuefrom = stored_index + 1
-                        found = True
-                        break
-        else:
-            if stored:
-                debug(f"Removing op {stored}")
-                ops[stored_index] = (opmap["POP_TOP"], 0, stored[2])
-                continuefrom = stored_index + 1
-                found = True
-
-    return ops
-
-
-def clean_pop_top(ops: List[Tuple[int, int, int]]
-                  ) -> List[Tuple[int, int, int]]:
-    changed = True
-    while changed:
-        changed = False
-        for i, (first, second) in enumerate(zip(ops[:-1], ops[1:])):
-            try:
-                effect = stack_effect(first[0], first[1])
-            except ValueError:
-                try:
-                    effect = stack_effect(first[0])
-                except ValueError:
-                    effect = 1
-            if effect == 1 and second[0] == opmap["POP_TOP"]:
-                del ops[i + 1]
-                del ops[i]
-                changed = True
-                break
-
-    return ops
-
-
-def inline_single_use_variables(ops: List[Tuple[int, int, int]]
-                                ) -> List[Tuple[int, int, int]]:
-    changed = True
-    while changed:
-        changed = False
-        for i, new_ops in enumerate(iter_size(ops, 2)):
-            if new_ops[0][0] in (opmap["LOAD_NAME"], opmap["LOAD_CONST"],
-                                 opmap["LOAD_FAST"]
-                                 ) and new_ops[1][0] == opmap["STORE_FAST"]:
-                load, store = new_ops
-                counter = 0
-                s = (0, None)
-                for j, op in enumerate(ops[i + 2:]):
-                    if op[0] == opmap["LOAD_FAST"] and op[1] == store[1]:
-                        s = (i + j + 2, op)
-                        counter += 1
-                if counter == 1:
-                    ops[s[0]] = (load[0], load[1], s[1][2])
-                    changed = True
-    return ops
-
-
-def optimize_accessors(ops: List[Tuple[int, int, int]]
-                       ) -> List[Tuple[int, int, int]]:
-    changed = True
-    while changed:
-        changed = False
-        for i, (first, second) in enumerate(zip(ops[:-1], ops[1:])):
-            if first[1] == second[1]:
-                if (first[0], second[0]) in ((opmap["STORE_FAST"],
-                                              opmap["LOAD_FAST"]),
-                                             (opmap["STORE_NAME"],
-                                              opmap["LOAD_NAME"])):
-                    if not any(arg[:2] == second[:2] for arg in ops[i + 2:]):
-                        # Make sure the fast isn't accessed a second time
-                        del ops[i + 1]
-                        del ops[i]
-                        changed = True
-                        break
-    return ops
-
-
-def get_stack_size(ops: List[Tuple[int, int, int]]) -> int:
-    stack = 0
-    max_stack = 0
-    for op in ops:
-        try:
-            stack += stack_effect(op[0], op[1])
-        except ValueError:
-            try:
-                stack += stack_effect(op[0])
-            except ValueError:
-                stack += 1
-        max_stack = max(max_stack, stack)
-    return max_stack
-
-
-def fix_jumps(ops: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
-    for i, op in enumerate(ops):
-        if op[0] in hasjabs:
-            target = [x for x in ops if x[2] >= op[1]
-                      ][0]  # if not exists, jump to next instruction
-            ops[i] = (op[0], ops.index(target) * 2, op[2])
-        elif op[0] in hasjrel:
-            target = [x for x in ops if x[2] >= op[1] + op[2]
-                      ][0]  # if not exists, jump to next instruction
-            ops[i] = (op[0], (ops.index(target) - ops.index(op)) * 2, op[2])
-    return ops
+        dis(assemble(ops).code)
+
+
+def count_locals(cfg: ControlFlowGraph) -> Tuple[Counter, Counter]:
+    loads = Counter()
+    stores = Counter()
+    for block in cfg:
+        for op in block:
+            if op[0] in LOCAL_LOADS:
+                loads[op[1]] += 1
+            elif op[0] == opmap["STORE_FAST"]:
+                stores[op[1]] += 1
+    return loads, stores
+
+
+def remove_unused_variables(cfg: ControlFlowGraph) -> int:
+    live_out, live_exc = liveness(cfg)
+    # Since 3.12 comprehensions save and restore their variables in place, and what is restored
+    # can be NULL, which only STORE_FAST accepts
+    restored = {op[1] for op in cfg.ops if op[0] == LOAD_FAST_AND_CLEAR}
+    removed = 0
+    for block in cfg:
+        exc = live_exc[block.label]
+        live = live_out[block.label] | exc
+        ops = block.ops
+        kept = []
+        i = len(ops) - 1
+        while i >= 0:
+            op = ops[i]
+            if op[0] == opmap["STORE_FAST"]:
+                bit = 1 << op[1]
+                if not live & bit and op[1] not in restored:
+                    debug(cfg.flags, f"Removing op {op}")
+                    removed += 1
+                    if i and is_pure_push(ops[i - 1]):
+                        # The stored value was only loaded to be stored
+                        i -= 2
+                        continue
+                    op = (opmap["POP_TOP"], 0, op[2])
+                live = (live & ~bit) | exc
+            elif op[0] in LOCAL_LOADS:
+                live |= 1 << op[1]
+            kept.append(op)
+            i -= 1
+        kept.reverse()
+        block.ops = kept
+    return removed
+
+
+def is_pure_push(op: Op) -> bool:
+    return op[0] in PURE_PUSHES or op[0] in EMPTY_BUILDS and op[1] == 0
+
+
+def drop_pure_push(cfg: ControlFlowGraph, ops: List[Op]) -> Optional[List[Op]]:
+    return [] if is_pure_push(ops[0]) else None
+
+
+def duplicate_load(cfg: ControlFlowGraph, ops: List[Op]) -> Optional[List[Op]]:
+    if ops[0][1] != ops[1][1]:
+        return None
+    return [ops[0], (*DUP_TOP, ops[1][2])]
+
+
+def build_tuple(cfg: ControlFlowGraph, ops: List[Op]) -> Optional[List[Op]]:
+    # Only iterated or searched, nothing can tell it isn't a list
+    return [(opmap["BUILD_TUPLE"], ops[0][1], ops[0][2]), ops[1]]
+
+
+def invert_jump(cfg: ControlFlowGraph, ops: List[Op]) -> Optional[List[Op]]:
+    return [(INVERTED_JUMPS[ops[1][0]], ops[1][1], ops[1][2])]
+
+
+def duplicate_const(cfg: ControlFlowGraph, ops: List[Op]) -> Optional[List[Op]]:
+    # Loading it again is as cheap, and lets constant folding see both
+    if ops[1][:2] != DUP_TOP:
+        return None
+    return [ops[0], (ops[0][0], ops[0][1], ops[1][2])]
+
+
+def swap_unpacked(cfg: ControlFlowGraph, ops: List[Op]) -> Optional[List[Op]]:
+    if ops[0][1] != ops[1][1] or ops[0][1] > 2:
+        return None
+    return [] if ops[0][1] < 2 else [(*SWAP_TOP, ops[1][2])]
+
+
+def cancel_swaps(cfg: ControlFlowGraph, ops: List[Op]) -> Optional[List[Op]]:
+    return [] if ops[0][1] == ops[1][1] else None
+
+
+# Peepholes applied by `peephole` in a single scan, see `Rule`
+PEEPHOLE_RULES = (
+    Rule("drop_pure_push", (PURE_PUSHES | EMPTY_BUILDS, "POP_TOP"), drop_pure_push,
+         ("REMOVE_UNUSED_VARS", "OPTIMIZE_ACCESSORS")),
+    Rule("duplicate_load", ("LOAD_FAST", "LOAD_FAST"), duplicate_load, ("OPTIMIZE_ACCESSORS", )),
+    Rule("duplicate_const", ("LOAD_CONST", DUP_TOP[0]), duplicate_const,
+         ("OPTIMIZE_ACCESSORS", )),
+    Rule("iterate_tuple", ("BUILD_LIST", "GET_ITER"), build_tuple, ("OPTIMIZE_ACCESSORS", )),
+    Rule("contains_tuple", ("BUILD_LIST", "CONTAINS_OP"), build_tuple, ("OPTIMIZE_ACCESSORS", )),
+    Rule("invert_not", ("UNARY_NOT", tuple(INVERTED_JUMPS)), invert_jump, ("OPTIMIZE_JUMPS", )),
+    Rule("swap_unpacked", ("BUILD_TUPLE", "UNPACK_SEQUENCE"), swap_unpacked,
+         ("OPTIMIZE_ACCESSORS", )),
+    Rule("cancel_swaps", (("ROT_TWO", "SWAP"), ("ROT_TWO", "SWAP")), cancel_swaps,
+         ("OPTIMIZE_ACCESSORS", )),
+)
+
+
+def peephole(cfg: ControlFlowGraph) -> int:
+    return apply_rules(cfg, PEEPHOLE_RULES)
+
+
+def inline_single_use_variables(cfg: ControlFlowGraph) -> int:
+    loads, stores = count_locals(cfg)
+    load_sites = {}
+    for block in cfg:
+        for i, op in enumerate(block.ops):
+            if op[0] == opmap["LOAD_FAST"]:
+                load_sites[op[1]] = (block, i)
+
+    inlined = 0
+    for block in cfg:
+        ops = block.ops
+        for i, (load, store) in enumerate(zip(ops[:-1], ops[1:])):
+            if load[0] not in (opmap["LOAD_NAME"], opmap["LOAD_CONST"],
+                               opmap["LOAD_FAST"]
+                               ) or store[0] != opmap["STORE_FAST"]:
+                continue
+            if loads[store[1]] != 1 or stores[store[1]] != 1:
+                continue
+            site, j = load_sites.get(store[1], (None, 0))
+            if site is not block or j <= i + 1:
+                continue
+            if load[0] == opmap["LOAD_FAST"] and any(
+                    op[0] in (opmap["STORE_FAST"], opmap["DELETE_FAST"])
+                    and op[1] == load[1] for op in ops[i + 2:j]):
+                # The loaded variable changes before it would be used
+                continue
+            if load[0] == opmap["LOAD_NAME"] and any(
+                    op[0] not in (opmap["LOAD_CONST"], opmap["LOAD_FAST"])
+                    for op in ops[i + 2:j]):
+                continue
+            ops[j] = (load[0], load[1], ops[j][2])
+            loads[store[1]] -= 1
+            if load[0] == opmap["LOAD_FAST"]:
+                loads[load[1]] += 1
+                load_sites[load[1]] = (block, j)
+            inlined += 1
+    return inlined
+
+
+def optimize_accessors(cfg: ControlFlowGraph) -> int:
+    loads, _ = count_locals(cfg)
+    removed = 0
+    for block in cfg:
+        ops = []
+        for op in block:
+            if (op[0] == opmap["LOAD_FAST"] and ops
+                    and ops[-1][:2] == (opmap["STORE_FAST"], op[1])
+                    and loads[op[1]] == 1):
+                # Make sure the fast isn't accessed a second time
+                ops.pop()
+                removed += 2
+            else:
+                ops.append(op)
+        block.ops = ops
+    return removed
 
 
 def optimize_names(
-        opcodes: List[Tuple[int, int, int]], code: CodeType
+        opcodes: List[Op], code: CodeType
 ) -> Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[Any, ...]]:
     accessed_names = []
-    accessed_varnames = []
-    for i in range(code.co_argcount + code.co_kwonlyargcount):
-        accessed_varnames.append(code.co_varnames[i])
+    accessed_varnames = list(code.co_varnames[:argument_count(code)])
     accessed_consts = []
+    accessed_const_keys = {}
+    const_indices = {}
+    if code.co_flags & CO_OPTIMIZED and code.co_consts:
+        # Functions take their docstring from the first constant, or None if it isn't one
+        const_indices[0] = add_const(accessed_consts, code.co_consts[0], accessed_const_keys)
     for op in opcodes:
         if op[0] in hasname and code.co_names[op[1]] not in accessed_names:
             accessed_names.append(code.co_names[op[1]])
         elif op[0] in haslocal and code.co_varnames[
                 op[1]] not in accessed_varnames:
             accessed_varnames.append(code.co_varnames[op[1]])
-        elif op[0] in hasconst and code.co_consts[
-                op[1]] not in accessed_consts:
-            accessed_consts.append(code.co_consts[op[1]])
+        elif op[0] in hasconst and op[1] not in const_indices:
+            # Equal constants of different types (1, 1.0, True) stay apart
+            const_indices[op[1]] = add_const(accessed_consts,
+                                             code.co_consts[op[1]],
+                                             accessed_const_keys)
 
     for i, op in enumerate(opcodes):
         if op[0] in hasname:
@@ -209,217 +303,449 @@ def optimize_names(
                           accessed_varnames.index(code.co_varnames[op[1]]),
                           op[2])
         elif op[0] in hasconst:
-            opcodes[i] = (op[0], accessed_consts.index(code.co_consts[op[1]]),
-                          op[2])
+            opcodes[i] = (op[0], const_indices[op[1]], op[2])
 
     return tuple(accessed_names), tuple(accessed_varnames), tuple(
         accessed_consts)
 
 
-def optimize_tco(ops: List[Tuple[int, int, int]],
-                 code: CodeType) -> List[Tuple[int, int, int]]:
-    ops_copy = ops[:]
-    changed = True
-    name = code.co_name if "<optimized>" not in code.co_name else code.co_name[
-        12:]
-
-    while changed:
-        changed = False
-        for i, new_ops in enumerate(iter_size(ops_copy, 3)):
-            if new_ops[0][0] in (opmap["LOAD_DEREF"], opmap["LOAD_GLOBAL"]):
-                names = code.co_names if new_ops[0][0] == opmap[
-                    "LOAD_GLOBAL"] else list(code.co_freevars) + list(
-                        code.co_cellvars)
-                if names[new_ops[0][1]] == name:
-                    for j, (op,
-                            op2) in enumerate(iter_size(ops_copy[i + 3:], 2)):
-                        if op[0] == opmap["CALL_FUNCTION"] and op2[0] == opmap[
-                                "RETURN_VALUE"]:
-                            nargs = op[1]
-                            added_ops = []
-                            for k in reversed(range(nargs)):
-                                added_ops.append(
-                                    (opmap["STORE_FAST"], k, op[2]))
-                            added_ops.append(
-                                (opmap["JUMP_ABSOLUTE"], 0, op2[2]))
-                            ops_copy[i + j + 3:i + j + 5] = added_ops
-                            changed = True
-                            break
-
-    return ops_copy
-
-
-def nested_tco(ops: List[Tuple[int, int, int]],
-               code: CodeType) -> Tuple[Any, ...]:
-    consts = list(code.co_consts)
-
-    for i, new_ops in enumerate(iter_size(ops, 4)):
-        if new_ops[0][0] == opmap["MAKE_FUNCTION"]:
-            for op in ops[i + 4:]:
-                if op[0] == opmap["STORE_NAME"] and op[1] == new_ops[3][1]:
-                    # dont optimize
-                    break
+def fold_binary(func: Callable[[Any, Any], Any], left: Any, right: Any) -> Any:
+    # Refuse anything that could take long or produce a huge constant before
+    # computing it, e.g. `"a" * 10 ** 9`
+    if func in (operator.mul, operator.pow, operator.lshift) and not (
+            isinstance(left, (int, float, complex))
+            and isinstance(right, (int, float, complex))):
+        if func is not operator.mul:
+            return NOT_FOLDED
+        count, sized = (left, right) if isinstance(left, int) else (right, left)
+        if not isinstance(count, int) or not isinstance(sized, (str, bytes, tuple)) or (
+                count > 0 and len(sized) * count > MAX_STR_SIZE):
+            return NOT_FOLDED
+    elif func is operator.mul and isinstance(left, int) and isinstance(right, int):
+        if left.bit_length() + right.bit_length() > MAX_INT_SIZE:
+            return NOT_FOLDED
+    elif func is operator.pow and isinstance(left, int) and isinstance(right, int):
+        if right > 0 and left.bit_length() * right > MAX_INT_SIZE:
+            return NOT_FOLDED
+    elif func is operator.lshift and isinstance(left, int) and isinstance(right, int):
+        if right > MAX_INT_SIZE or left.bit_length() + right > MAX_INT_SIZE:
+            return NOT_FOLDED
+    elif func is operator.mod and isinstance(left, (str, bytes)):
+        # %-formatting can pad to any width
+        return NOT_FOLDED
+    elif isinstance(left, (str, bytes, tuple)) and isinstance(right, (str, bytes, tuple)):
+        if len(left) + len(right) > MAX_STR_SIZE:
+            return NOT_FOLDED
+    return fold(func, left, right)
+
+
+def fold(func: Callable[..., Any], *args: Any) -> Any:
+    try:
+        value = func(*args)
+    except Exception:  # pylint: disable=broad-except
+        # Leave it to raise at runtime
+        return NOT_FOLDED
+    return value if within_budget(value) else NOT_FOLDED
+
+
+def within_budget(value: Any) -> bool:
+    if isinstance(value, int):
+        return value.bit_length() <= MAX_INT_SIZE
+    if isinstance(value, (str, bytes)):
+        return len(value) <= MAX_STR_SIZE
+    if isinstance(value, (tuple, frozenset)):
+        return len(value) <= MAX_COLLECTION_SIZE and all(
+            within_budget(item) for item in value)
+    return isinstance(value, (float, complex, type(None), type(Ellipsis)))
+
+
+def fix_const_ops(cfg: ControlFlowGraph) -> int:
+    predecessors = cfg.predecessors()
+    handlers = {
+        handler.label
+        for protecting in cfg.handlers().values() for handler in protecting
+    }
+    known_after = {}
+    folded = 0
+    for block in cfg:
+        # Locals known to hold a constant, carried over from a block that is
+        # the only way in
+        previous = predecessors[block.label]
+        if len(previous) == 1 and block.label not in handlers:
+            known = dict(known_after.get(previous[0].label, {}))
+        else:
+            known = {}
+
+        ops = []
+        for op in block:
+            if op[0] == opmap["LOAD_FAST"] and op[1] in known:
+                ops.append((opmap["LOAD_CONST"], known[op[1]], op[2]))
+                folded += 1
+                continue
+            if op[0] == opmap["STORE_FAST"]:
+                if ops and ops[-1][0] == opmap["LOAD_CONST"]:
+                    known[op[1]] = ops[-1][1]
+                else:
+                    known.pop(op[1], None)
+            elif op[0] == opmap["DELETE_FAST"]:
+                known.pop(op[1], None)
+
+            value = NOT_FOLDED
+            func = None
+            if op[0] in BINARY_OPERATORS:
+                func = BINARY_OPERATORS[op[0]]
+            elif op[0] == BINARY_OP:
+                func = BINARY_OP_OPERATORS.get(op[1])
+            elif op[0] == opmap["COMPARE_OP"] and op[1] < len(
+                    COMPARE_OPERATORS):
+                func = COMPARE_OPERATORS[op[1]]
+            elif op[0] == CONTAINS_OP:
+                func = COMPARE_OPERATORS[6 + op[1]]
+
+            if op[0] in UNARY_OPERATORS and ops and ops[-1][0] == opmap[
+                    "LOAD_CONST"]:
+                value = fold(UNARY_OPERATORS[op[0]], cfg.consts[ops[-1][1]])
+                consumed = 1
+            elif func is not None and len(ops) >= 2 and ops[-2][0] == ops[
+                    -1][0] == opmap["LOAD_CONST"]:
+                value = fold_binary(func, cfg.consts[ops[-2][1]],
+                                    cfg.consts[ops[-1][1]])
+                consumed = 2
+            elif op[0] == opmap["BUILD_TUPLE"] and len(ops) >= op[1] and all(
+                    load[0] == opmap["LOAD_CONST"]
+                    for load in ops[len(ops) - op[1]:]):
+                value = fold(tuple, [
+                    cfg.consts[load[1]] for load in ops[len(ops) - op[1]:]
+                ])
+                consumed = op[1]
+
+            if value is not NOT_FOLDED:
+                del ops[len(ops) - consumed:]
+                ops.append((opmap["LOAD_CONST"], cfg.add_const(value), op[2]))
+                folded += 1
+            else:
+                ops.append(op)
+
+        if len(ops) >= 2 and ops[-2][0] == opmap["LOAD_CONST"] and ops[-1][
+                0] in (POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE):
+            const, jump = ops[-2:]
+            if bool(cfg.consts[const[1]]) == (jump[0] == POP_JUMP_IF_TRUE):
+                # Jump
+                ops[-2:] = [(JUMP, jump[1], jump[2])]
             else:
-                # optimize
-                new_code = consts[ops[i - 2][1]]
-                opcodes = [
-                    *zip(new_code.co_code[::2], new_code.co_code[1::2],
-                         range(0, int(len(new_code.co_code)), 2))
-                ]
-                opcodes = optimize_tco(opcodes, new_code)
-                co_code = b"".join(pack("BB", op[0], op[1]) for op in opcodes)
-                code = CodeType(new_code.co_argcount,
-                                new_code.co_kwonlyargcount,
-                                new_code.co_nlocals, new_code.co_stacksize,
-                                new_code.co_flags, co_code, new_code.co_consts,
-                                new_code.co_names, new_code.co_varnames,
-                                new_code.co_filename, new_code.co_name,
-                                new_code.co_firstlineno, new_code.co_lnotab,
-                                new_code.co_freevars, new_code.co_cellvars)
-                consts[ops[i - 2][1]] = code
-    return tuple(consts)
-
-
-def fix_const_ops(ops: List[Tuple[int, int, int]], code: CodeType
-                  ) -> Tuple[List[Tuple[int, int, int]], Tuple[Any, ...]]:
-    consts = list(code.co_consts)
+                # No jump
+                ops[-2:] = []
+            folded += 1
+        block.ops = ops
+        known_after[block.label] = known
+
+    return folded
+
+
+def jump_target(cfg: ControlFlowGraph, label: int, positions: Dict[int, int]) -> int:
+    # Follow blocks that only jump elsewhere, or are empty, to where they end up
+    seen = set()
+    while label not in seen:
+        seen.add(label)
+        block = cfg.labels[label]
+        if len(block.ops) == 1 and block.ops[0][0] in PLAIN_JUMPS:
+            label = block.ops[0][1]
+        elif not block.ops and positions[label] + 1 < len(cfg.blocks):
+            label = cfg.blocks[positions[label] + 1].label
+        else:
+            break
+    return label
+
+
+def optimize_jumps(cfg: ControlFlowGraph) -> int:
+    rewrites = 0
+    positions = {block.label: i for i, block in enumerate(cfg.blocks)}
+    for i, block in enumerate(cfg.blocks):
+        jump = block.jump
+        if jump is None or jump[0] not in THREADED_JUMPS:
+            continue
+        target = jump_target(cfg, jump[1], positions)
+        if target != jump[1] and (positions[target] > i or can_jump_backward(jump[0])):
+            # The assembler turns jumps around where needed, only some can
+            jump = block.ops[-1] = (jump[0], target, jump[2])
+            rewrites += 1
+        target = jump[1]
+        if jump[0] not in PLAIN_JUMPS:
+            continue
+        ops = cfg.labels[target].ops
+        if positions[target] == i + 1:
+            del block.ops[-1]
+            rewrites += 1
+        elif ops and ops[-1][0] in RETURNS and (
+                len(ops) == 1 or len(ops) == 2 and ops[0][0] in (opmap["LOAD_CONST"],
+                                                                 opmap["LOAD_FAST"])):
+            # Returning is as cheap as jumping to the return
+            block.ops[-1:] = ops
+            rewrites += 1
+
+    # `if x: jump a; b:` becomes `if not x: a` when nothing else reaches b
+    predecessors = cfg.predecessors()
+    skipped = []
+    positions = {block.label: i for i, block in enumerate(cfg.blocks)}
+    for i, (block, skip, after) in enumerate(zip(cfg.blocks, cfg.blocks[1:], cfg.blocks[2:])):
+        jump = block.jump
+        if (jump is not None and jump[0] in INVERTED_JUMPS and jump[1] == after.label
+                and len(skip.ops) == 1 and skip.ops[0][0] in PLAIN_JUMPS
+                and predecessors[skip.label] == [block]
+                and (positions[skip.ops[0][1]] > i or can_jump_backward(jump[0]))):
+            block.ops[-1] = (INVERTED_JUMPS[jump[0]], skip.ops[0][1], jump[2])
+            skipped.append(skip)
+    cfg.remove(skipped)
+    return rewrites + len(skipped)
+
+
+def remove_after_return(cfg: ControlFlowGraph) -> int:
+    # Drop every block that can't be reached from the entry
+    reachable = cfg.reachable()
+    removed = [block for block in cfg if block.label not in reachable]
+    cfg.remove(removed)
+    return sum(len(block.ops) for block in removed)
+
+
+def find_loops(cfg: ControlFlowGraph) -> List[Tuple[int, int]]:
+    # The first and last block position of every loop, outermost first
+    positions = {block.label: i for i, block in enumerate(cfg.blocks)}
+    ends = {}
+    for i, block in enumerate(cfg.blocks):
+        jump = block.jump
+        if jump is not None and positions[jump[1]] <= i:
+            header = positions[jump[1]]
+            ends[header] = max(ends.get(header, i), i)
+    return sorted(ends.items(), key=lambda loop: loop[0] - loop[1])
+
+
+def find_call(ops: List[Op], start: int) -> Optional[int]:
+    # The CALL_METHOD belonging to the LOAD_METHOD before `start`
+    depth = 0
+    for i in range(start, len(ops)):
+        if ops[i][0] == LOAD_METHOD:
+            depth += 1
+        elif ops[i][0] == CALL_METHOD:
+            if not depth:
+                return i
+            depth -= 1
+    return None
+
+
+def every_iteration(cfg: ControlFlowGraph, blocks: List[BasicBlock]) -> Set[int]:
+    # Labels of the loop blocks that run on every iteration, those dominating each jump back
+    header = blocks[0].label
+    inside = {block.label for block in blocks}
+    successors = cfg.successors()
+    handlers = cfg.handlers()
+    predecessors = {label: [] for label in inside}
+    for block in blocks:
+        for following in successors[block.label] + handlers[block.label]:
+            if following.label in inside and following.label != header:
+                predecessors[following.label].append(block.label)
+    dominators = {label: set(inside) for label in inside}
+    dominators[header] = {header}
     changed = True
     while changed:
         changed = False
-        for i, new_ops in enumerate(iter_size(ops, 3)):
-            c1, c2, op = new_ops
-            if c1[0] == c2[0] == opmap["LOAD_CONST"]:
-                c1v, c2v = consts[c1[1]], consts[c2[1]]
-                opname = [k for k, v in opmap.items() if v == op[0]][0]
-                if opname.startswith("INPLACE") or opname.startswith("BINARY"):
-                    func_name = opname.split("_", 1)[1].replace("_",
-                                                                "").lower()
-                    value = getattr(operator, func_name)(c1v, c2v)
-                    if value not in consts:
-                        consts.append(value)
-                    changed = True
-                    ops[i:i + 3] = [(opmap["LOAD_CONST"], consts.index(value),
-                                     op[2])]
-                    break
-                if op[0] == opmap["COMPARE_OP"]:
-                    try:
-                        f = [
-                            operator.lt, operator.le, operator.eq, operator.ne,
-                            operator.gt, operator.ge
-                        ][op[1]]
-                    except IndexError:
-                        continue
-                    else:
-                        value = f(c1v, c2v)
-                        if value not in consts:
-                            consts.append(value)
-                        changed = True
-                        ops[i:i + 3] = [(opmap["LOAD_CONST"],
-                                         consts.index(value), op[2])]
-                        break
-            elif c1[0] == opmap["LOAD_CONST"] and c2[0] in (
-                    114, 115):  # POP_JUMP_IF_X
+        for block in blocks[1:]:
+            new = set(inside)
+            for previous in predecessors[block.label]:
+                new &= dominators[previous]
+            new.add(block.label)
+            if new != dominators[block.label]:
+                dominators[block.label] = new
                 changed = True
-                if consts[c1[1]] ^ c2[0] == opmap["POP_JUMP_IF_TRUE"]:
-                    # No jump
-                    ops[i:i + 2] = []
-                else:
-                    # Jump
-                    target = [x for x in ops if x[2] >= c2[1]][0]
-                    pos = ops.index(target)
-                    ops[i:pos] = []
-
-    return ops, tuple(consts)
-
-
-def remove_after_return(ops: List[Tuple[int, int, int]]
-                        ) -> List[Tuple[int, int, int]]:
-    for i, op in enumerate(ops):
-        if op[0] == opmap["RETURN_VALUE"]:
-            for op_ in ops[:i]:
-                if op_[0] in hasjabs:
-                    target = [x for x in ops if x[2] >= op_[1]][0]
-                elif op_[0] in hasjrel:
-                    target = [x for x in ops if x[2] >= op_[1] + op_[2]][0]
-                else:
+    latches = [block.label for block in blocks
+               if block.jump is not None and block.jump[1] == header]
+    return set.intersection(*(dominators[label] for label in latches))
+
+
+def hoist_loop(cfg: ControlFlowGraph, header: int, end: int, rebound: Set[str]) -> int:
+    blocks = cfg.blocks[header:end + 1]
+    inside = {block.label for block in blocks}
+    predecessors = cfg.predecessors()
+    for previous, handlers in cfg.handlers().items():
+        for handler in handlers:
+            predecessors[handler.label].append(cfg.labels[previous])
+    # The loop must only be entered by falling into its first block. Since 3.12 handlers
+    # jump back from the end of the function, the range they jump into is no loop at all
+    entries = [cfg.blocks[header - 1]] if header and cfg.blocks[header - 1].falls_through else []
+    for block in blocks:
+        outside = [previous for previous in predecessors[block.label]
+                   if previous.label not in inside]
+        if outside != (entries if block is blocks[0] else []):
+            return 0
+
+    names = cfg.names
+    # A method looked up under a condition may not exist when the condition is false
+    always = every_iteration(cfg, blocks)
+    stored = {op[1] for block in blocks for op in block
+              if op[0] in (opmap["STORE_FAST"], opmap["DELETE_FAST"])}
+    slots = {}
+    preheader = []
+    offset = blocks[0].ops[0][2] if blocks[0].ops else 0
+    for block in blocks:
+        ops = block.ops
+        calls = set()
+        rewritten = []
+        for i, op in enumerate(ops):
+            if op[0] == opmap["LOAD_GLOBAL"] and names[op[1]] not in rebound:
+                key = op[:2]
+                if key not in slots:
+                    slots[key] = cfg.add_local("." + names[op[1]])
+                    preheader += [op[:2] + (offset, ), (opmap["STORE_FAST"], slots[key], offset)]
+                rewritten.append((opmap["LOAD_FAST"], slots[key], op[2]))
+            elif (op[0] == LOAD_METHOD and block.label in always and rewritten
+                  and rewritten[-1][0] == opmap["LOAD_FAST"] and rewritten[-1][1] not in stored):
+                # Since 3.11 a NULL in place of `self` makes the call use the bound
+                # method as is, before that CALL_METHOD becomes CALL_FUNCTION
+                call = find_call(ops, i + 1) if CALL_METHOD is not None else None
+                if call is None and CALL_METHOD is not None:
+                    rewritten.append(op)
                     continue
-                if target[2] > op[2]:
-                    break
+                instance = rewritten.pop()
+                key = (instance[1], op[1])
+                if key not in slots:
+                    slots[key] = cfg.add_local(f".{cfg.varnames[instance[1]]}.{names[op[1]]}")
+                    preheader += [
+                        instance[:2] + (offset, ),
+                        (opmap["LOAD_ATTR"], op[1], offset),
+                        (opmap["STORE_FAST"], slots[key], offset),
+                    ]
+                if call is None:
+                    rewritten.append((PUSH_NULL, 0, instance[2]))
+                else:
+                    calls.add(call)
+                rewritten.append((opmap["LOAD_FAST"], slots[key], instance[2]))
+            elif i in calls:
+                # The bound method is called like any other function
+                rewritten.append((opmap["CALL_FUNCTION"], op[1], op[2]))
             else:
-                ops[i + 1:] = []
-    return ops
-
-
-def optimize_code(code: CodeType) -> CodeType:
-    co_argcount = None
-    co_kwonlyargcount = None
-    co_nlocals = None
-    co_flags = None
-    co_filename = None
-    co_names = None
-    co_varnames = None
-    co_name = "<optimized> " + code.co_name if not code.co_name.startswith(
-        "<") else "<optimized " + code.co_name[1:]
-    co_firstlineno = None
-    co_lnotab = None
-    co_freevars = None
-    co_cellvars = None
-
-    opcodes = [
-        *zip(code.co_code[::2], code.co_code[1::2],
-             range(0, int(len(code.co_code)), 2))
-    ]
+                rewritten.append(op)
+        block.ops = rewritten
+    if preheader:
+        cfg.insert(header, preheader)
+    return len(preheader) // 2
+
+
+def hoist_loads(cfg: ControlFlowGraph) -> int:
+    """
+    Load globals, builtins and methods of unchanged locals once before a loop
+    instead of on every iteration, like `append = out.append` by hand.
+
+    The hoisted values are looked up before the loop runs, so a global rebound
+    elsewhere during the loop is not seen by it.
+    """
+    code = cfg.code
+    if not code.co_flags & CO_OPTIMIZED:
+        # Module and class bodies look names up in a namespace they may change
+        return 0
+    rebound = {
+        cfg.names[op[1]] for op in cfg.ops
+        if op[0] in (opmap["STORE_GLOBAL"], opmap["DELETE_GLOBAL"])
+    }
+    hoisted = 0
+    done = set()
+    while True:
+        for header, end in find_loops(cfg):
+            label = cfg.blocks[header].label
+            if label not in done:
+                done.add(label)
+                hoisted += hoist_loop(cfg, header, end, rebound)
+                # Inserting a block moves every later loop
+                break
+        else:
+            return hoisted
+
+
+def optimized_name(name: str) -> str:
+    if name.startswith("<optimized"):
+        return name
+    return "<optimized> " + name if not name.startswith("<") else "<optimized " + name[1:]
+
+
+def optimize_code(code: CodeType, flags: type = Flags) -> CodeType:
+    """
+    Optimize `code` and every code object nested in it.
+
+    Results are memoized by content, so identical code, or code that was
+    already optimized, is only optimized once per set of Flags and passes.
+    `flags` may be a subclass of `Flags` overriding some of them, their values
+    are read once so changing them meanwhile doesn't affect this call.
+    """
+    flags = snapshot(flags)
+    if flags.MEMO_SIZE <= 0:
+        return _optimize_code(code, flags)
+    code_flags = profile_flags(code, flags)
+    state = (flags_key(code_flags), tuple(pass_.name for pass_ in passes.active(code_flags)))
+    key = state + code_key(code)
+    result = memo.get(key)
+    if result is None:
+        result = _optimize_code(code, flags)
+        memo.put(key, result, flags.MEMO_SIZE)
+        memo.put(state + code_key(result), result, flags.MEMO_SIZE)
+    return restamp(result, code.co_filename, code.co_firstlineno, optimized_name(code.co_name),
+                   getattr(code, "co_qualname", None))
+
+
+def _optimize_code(code: CodeType, flags: type) -> CodeType:
     co_consts = tuple(
-        (const if not isinstance(const, CodeType) else optimize_code(const))
+        (const if not isinstance(const, CodeType) else optimize_code(const, flags))
         for const in code.co_consts)
     # We do this to optimize out all nested code consts first
-    code = CodeType(code.co_argcount, code.co_kwonlyargcount, code.co_nlocals,
-                    code.co_stacksize, code.co_flags, code.co_code, co_consts,
-                    code.co_names, code.co_varnames, code.co_filename,
-                    code.co_name, code.co_firstlineno, code.co_lnotab,
-                    code.co_freevars, code.co_cellvars)
-
-    if Flags.REMOVE_UNUSED_VARS:
-        opcodes = inline_single_use_variables(opcodes)
-        opcodes = remove_unused_variables(opcodes, code)
-        opcodes = clean_pop_top(opcodes)
-
-    if Flags.TAIL_CALL_OPTIMIZATION:
-        co_consts = nested_tco(opcodes, code)
-        code = CodeType(code.co_argcount, code.co_kwonlyargcount,
-                        code.co_nlocals, code.co_stacksize, code.co_flags,
-                        code.co_code, co_consts, code.co_names,
-                        code.co_varnames, code.co_filename, code.co_name,
-                        code.co_firstlineno, code.co_lnotab, code.co_freevars,
-                        code.co_cellvars)
-
-    if Flags.OPTIMIZE_ACCESSORS:
-        opcodes = optimize_accessors(opcodes)
-        opcodes, co_consts = fix_const_ops(opcodes, code)
-        opcodes = remove_after_return(opcodes)
-        code = CodeType(code.co_argcount, code.co_kwonlyargcount,
-                        code.co_nlocals, code.co_stacksize, code.co_flags,
-                        code.co_code, co_consts, code.co_names,
-                        code.co_varnames, code.co_filename, code.co_name,
-                        code.co_firstlineno, code.co_lnotab, code.co_freevars,
-                        code.co_cellvars)
-        opcodes = clean_pop_top(opcodes)
-
-    opcodes = fix_jumps(opcodes)
-
-    if Flags.OPTIMIZE_NAMES:
-        co_names, co_varnames, co_consts = optimize_names(opcodes, code)
-
-    co_stacksize = get_stack_size(opcodes)
-
-    co_code = b"".join(pack("BB", op[0], op[1]) for op in opcodes)
-    return CodeType(co_argcount or code.co_argcount, co_kwonlyargcount
-                    or code.co_kwonlyargcount, co_nlocals or code.co_nlocals,
-                    co_stacksize or code.co_stacksize, co_flags
-                    or code.co_flags, co_code or code.co_code, co_consts
-                    or code.co_consts, co_names or code.co_names, co_varnames
-                    or code.co_varnames, co_filename or code.co_filename,
-                    co_name or code.co_name, co_firstlineno
-                    or code.co_firstlineno, co_lnotab or code.co_lnotab,
-                    co_freevars or code.co_freevars, co_cellvars
-                    or code.co_cellvars)
+    code = replace(code, co_consts=co_consts)
+    flags = profile_flags(code, flags)
+    record = stats.code(code, original_name(
+        code.co_name)) if flags.COLLECT_STATS else None
+    start = perf_counter()
+    cfg = ControlFlowGraph.from_code(code)
+
+    passes.run(cfg, flags, flags.OPTIMIZE_ITERATIONS, record)
+
+    opcodes = fix_jumps(cfg)
+    handlers = fix_handlers(cfg)
+    co_names, co_varnames, co_consts = tuple(cfg.names), tuple(cfg.varnames), tuple(cfg.consts)
+    if flags.OPTIMIZE_NAMES:
+        co_names, co_varnames, co_consts = optimize_names(opcodes, replace(
+            code, co_names=co_names, co_varnames=co_varnames, co_nlocals=len(co_varnames),
+            co_consts=co_consts))
+
+    co_stacksize = max_stack_depth(cfg)
+
+    assembly = assemble(opcodes, handlers,
+                        cell_slots(co_varnames, code.co_cellvars, code.co_freevars))
+    if record is not None:
+        record.time += perf_counter() - start
+        record.ops_after = len(opcodes)
+        record.stack_after = co_stacksize
+    result = replace(code, co_code=assembly.code, co_consts=co_consts, co_names=co_names,
+                     co_varnames=co_varnames, co_nlocals=len(co_varnames),
+                     co_stacksize=co_stacksize,
+                     co_name=optimized_name(code.co_name),
+                     co_exceptiontable=assembly.exception_table,
+                     co_linetable=write_line_table(opcodes, assembly.offsets,
+                                                   len(assembly.code), code))
+    if flags.VERIFY:
+        try:
+            verify(result)
+        except VerificationError as e:
+            # A bug in a pass, running the code as compiled is always safe
+            warnings.warn(f"Not optimizing {code.co_filename}:{code.co_firstlineno}: {e}",
+                          RuntimeWarning)
+            return code
+    return result
+
+
+memo = CodeMemo()
+passes = PassManager()
+passes.register(inline_comprehensions, flags=("INLINE_COMPREHENSIONS", ))
+passes.register(inline_single_use_variables, flags=("REMOVE_UNUSED_VARS", ))
+passes.register(remove_unused_variables, flags=("REMOVE_UNUSED_VARS", ))
+passes.register(optimize_tail_calls, flags=("TAIL_CALL_OPTIMIZATION", ))
+passes.register(optimize_accessors, flags=("OPTIMIZE_ACCESSORS", ))
+passes.register(fix_const_ops, flags=("OPTIMIZE_ACCESSORS", ))
+passes.register(optimize_jumps, flags=("OPTIMIZE_JUMPS", ))
+passes.register(remove_after_return, flags=("OPTIMIZE_ACCESSORS", "OPTIMIZE_JUMPS"))
+passes.register(hoist_loads, flags=("HOIST_LOADS", ))
+passes.register(peephole, flags=("REMOVE_UNUSED_VARS", "OPTIMIZE_ACCESSORS", "OPTIMIZE_JUMPS"))
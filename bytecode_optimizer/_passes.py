@@ -0,0 +1,119 @@
+# Stdlib
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+# Project Internals
+from bytecode_optimizer._cfg import ControlFlowGraph, max_stack_depth
+from bytecode_optimizer._stats import CodeStats
+
+PassFunction = Callable[[ControlFlowGraph], int]
+
+
+class Pass(NamedTuple):
+    name: str
+    func: PassFunction
+    # The pass only runs while one of these Flags is set, or always if empty
+    flags: Sequence[str]
+
+
+class PassManager:
+    """
+    Runs passes over a control-flow graph until they stop changing it.
+
+    A pass takes the graph, rewrites it in place and returns the number of
+    rewrites it made. A pass that made no rewrites is skipped until another
+    pass changes the graph again.
+
+    Registering or disabling passes replaces the list and set instead of
+    changing them, so a run in another thread keeps the passes it started with.
+    """
+
+    def __init__(self):
+        self.passes = []  # type: List[Pass]
+        self.disabled = set()
+
+    def __iter__(self) -> Iterator[Pass]:
+        return iter(self.passes)
+
+    @property
+    def names(self) -> List[str]:
+        return [pass_.name for pass_ in self.passes]
+
+    def register(self, func: PassFunction, name: Optional[str] = None, *,
+                 before: Optional[str] = None, after: Optional[str] = None,
+                 flags: Sequence[str] = ()) -> PassFunction:
+        name = name or original_name(func.__name__)
+        if name in self.names:
+            raise ValueError(f"A pass named {name!r} is already registered")
+        if before is not None:
+            index = self.names.index(before)
+        elif after is not None:
+            index = self.names.index(after) + 1
+        else:
+            index = len(self.passes)
+        self.passes = self.passes[:index] + [Pass(name, func, tuple(flags))] + self.passes[index:]
+        return func
+
+    def unregister(self, name: str):
+        self.passes = [pass_ for pass_ in self.passes if pass_.name != name]
+        self.disabled = self.disabled - {name}
+
+    def enable(self, name: str):
+        self.disabled = self.disabled - {name}
+
+    def disable(self, name: str):
+        self.names.index(name)  # Raise for unknown passes
+        self.disabled = self.disabled | {name}
+
+    def active(self, flags: object) -> List[Pass]:
+        # `Flags.PASSES` narrows them down further, by name
+        names = getattr(flags, "PASSES", None)
+        disabled = self.disabled
+        return [
+            pass_ for pass_ in self.passes
+            if pass_.name not in disabled and (names is None or pass_.name in names) and (
+                not pass_.flags or any(getattr(flags, flag) for flag in pass_.flags))
+        ]
+
+    def run(self, cfg: ControlFlowGraph, flags: object, max_rounds: int,
+            record: Optional[CodeStats] = None) -> int:
+        # Passes can look at the flags they run with through the graph
+        cfg.flags = flags
+        passes = self.active(flags)
+        converged = {}  # type: Dict[str, int]
+        generation = 0
+        total = 0
+        for _ in range(max_rounds):
+            changed = False
+            for pass_ in passes:
+                if converged.get(pass_.name) == generation:
+                    # Nothing changed since this pass last found nothing to do
+                    continue
+                rewrites = run_pass(pass_, cfg, record)
+                if rewrites:
+                    total += rewrites
+                    generation += 1
+                    changed = True
+                else:
+                    converged[pass_.name] = generation
+            if not changed:
+                break
+        return total
+
+
+def original_name(name: str) -> str:
+    while name.startswith("<optimized"):
+        name = name[12:] if name.startswith("<optimized> ") else "<" + name[11:]
+    return name
+
+
+def run_pass(pass_: Pass, cfg: ControlFlowGraph, record: Optional[CodeStats]) -> int:
+    if record is None:
+        return pass_.func(cfg)
+    ops_before, stack_before = len(cfg.ops), max_stack_depth(cfg)
+    start = perf_counter()
+    rewrites = pass_.func(cfg)
+    elapsed = perf_counter() - start
+    record.record(pass_.name, elapsed, ops_before, len(cfg.ops), stack_before,
+                  max_stack_depth(cfg), rewrites)
+    return rewrites
@@ -0,0 +1,126 @@
+# Stdlib
+from collections import deque
+from dis import opmap
+from functools import lru_cache
+from itertools import product
+from typing import (Callable, Collection, Dict, Iterator, List, NamedTuple, Optional, Sequence,
+                    Tuple, Union)
+
+# Project Internals
+from bytecode_optimizer._cfg import ControlFlowGraph, Op
+
+# Takes the graph and the matched ops, returns the ops replacing them, or None to keep them
+Rewrite = Callable[[ControlFlowGraph, List[Op]], Optional[List[Op]]]
+
+
+class Rule(NamedTuple):
+    name: str
+    # An opcode or its name, or a collection of them, per instruction
+    pattern: Sequence[Union[str, int, Collection[Union[str, int]]]]
+    rewrite: Rewrite
+    # The rule only applies while one of these Flags is set, or always if empty
+    flags: Sequence[str] = ()
+
+
+def opcodes(element: Union[str, int, Collection[Union[str, int]]]) -> List[int]:
+    # Names missing from this version's opcodes match nothing
+    names = (element, ) if isinstance(element, (str, int)) else element
+    return sorted({opmap[name] if isinstance(name, str) else name
+                   for name in names if not isinstance(name, str) or name in opmap})
+
+
+def sequences(rule: Rule) -> Iterator[Tuple[int, ...]]:
+    return product(*(opcodes(element) for element in rule.pattern))
+
+
+class Automaton:
+    """
+    Matches every rule in one scan over a basic block.
+
+    The patterns are put in a trie, and every state links to the longest
+    proper suffix of its path that is also in the trie (Aho-Corasick), so
+    each instruction is looked at once however many rules there are. Where
+    several rules match, the first in the table that accepts the ops wins.
+    """
+
+    def __init__(self, rules: Sequence[Rule]):
+        self.rules = tuple(rules)
+        self.goto = [{}]  # type: List[Dict[int, int]]
+        self.fail = [0]
+        # Indices of the rules matching where each state ends
+        self.matches = [[]]  # type: List[List[int]]
+        for index, rule in enumerate(self.rules):
+            for sequence in sequences(rule):
+                state = 0
+                for opcode in sequence:
+                    if opcode not in self.goto[state]:
+                        self.goto[state][opcode] = len(self.goto)
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.matches.append([])
+                    state = self.goto[state][opcode]
+                self.matches[state].append(index)
+
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for opcode, target in self.goto[state].items():
+                pending.append(target)
+                self.fail[target] = self.step(self.fail[state], opcode)
+                self.matches[target] = sorted(
+                    set(self.matches[target] + self.matches[self.fail[target]]))
+
+    def step(self, state: int, opcode: int) -> int:
+        while state and opcode not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(opcode, 0)
+
+    def rewrite_block(self, cfg: ControlFlowGraph, ops: List[Op]) -> Tuple[List[Op], int]:
+        kept = []  # type: List[Op]
+        states = [0]
+        pending = ops[::-1]
+        rewrites = 0
+        while pending:
+            op = pending.pop()
+            kept.append(op)
+            states.append(self.step(states[-1], op[0]))
+            for index in self.matches[states[-1]]:
+                size = len(self.rules[index].pattern)
+                replacement = self.rules[index].rewrite(cfg, kept[-size:])
+                if replacement is None:
+                    continue
+                del kept[-size:]
+                del states[-size:]
+                rewrites += 1
+                if len(replacement) < size:
+                    # Shorter code may complete another pattern with what is before it
+                    pending += replacement[::-1]
+                else:
+                    # Matching it again could go on forever
+                    for new in replacement:
+                        kept.append(new)
+                        states.append(self.step(states[-1], new[0]))
+                break
+        return kept, rewrites
+
+    def rewrite(self, cfg: ControlFlowGraph) -> int:
+        rewrites = 0
+        for block in cfg:
+            block.ops, count = self.rewrite_block(cfg, block.ops)
+            rewrites += count
+        return rewrites
+
+
+@lru_cache(maxsize=32)
+def compile_rules(rules: Tuple[Rule, ...]) -> Automaton:
+    return Automaton(rules)
+
+
+def apply_rules(cfg: ControlFlowGraph, rules: Sequence[Rule]) -> int:
+    """
+    Apply the rules enabled by `cfg.flags` to every block of `cfg`, returning
+    the number of rewrites.
+    """
+    enabled = tuple(rule for rule in rules
+                    if not rule.flags or any(getattr(cfg.flags, flag) for flag in rule.flags))
+    return compile_rules(enabled).rewrite(cfg)
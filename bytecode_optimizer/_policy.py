@@ -0,0 +1,53 @@
+# Stdlib
+from fnmatch import fnmatchcase
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+# Project Internals
+from bytecode_optimizer._flags import Flags, snapshot
+
+
+def matches(module: str, pattern: str) -> bool:
+    # A pattern for a package covers its submodules too
+    return fnmatchcase(module, pattern) or fnmatchcase(module, pattern + ".*")
+
+
+class Policy:
+    """
+    Decides which modules `enable()` optimizes, and with which flags.
+
+    Modules matching a glob in `include` and none in `exclude` are optimized,
+    files marked with `# no-optimize` never are. `packages` maps globs to
+    flags overriding `Flags` for the modules they match, where longer globs
+    win over shorter ones, e.g. `{"numpy.*": {"OPTIMIZE_ITERATIONS": 1}}`.
+    """
+
+    def __init__(self, include: Iterable[str] = ("*", ),
+                 exclude: Iterable[str] = ("_*", "six"),
+                 packages: Optional[Mapping[str, Mapping[str, Any]]] = None):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.packages = {}  # type: Dict[str, Dict[str, Any]]
+        for pattern, overrides in (packages or {}).items():
+            for name in overrides:
+                if not name.isupper() or not hasattr(Flags, name):
+                    raise ValueError(f"Unknown flag {name!r} for {pattern!r}")
+            overrides = dict(overrides)
+            if overrides.get("PASSES") is not None:
+                # Hashable and in a stable order, it is part of the cache key
+                overrides["PASSES"] = tuple(sorted(overrides["PASSES"]))
+            self.packages[pattern] = overrides
+
+    def should_optimize(self, module: str, data: bytes = b"") -> bool:
+        return (b"# no-optimize" not in data
+                and any(matches(module, pattern) for pattern in self.include)
+                and not any(matches(module, pattern) for pattern in self.exclude))
+
+    def flags(self, module: str) -> type:
+        """
+        A snapshot of the flags to optimize `module` with.
+        """
+        overrides = {}
+        for pattern in sorted(self.packages, key=len):
+            if matches(module, pattern):
+                overrides.update(self.packages[pattern])
+        return snapshot(Flags, overrides)
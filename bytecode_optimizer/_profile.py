@@ -0,0 +1,142 @@
+# Stdlib
+from collections import Counter
+from functools import lru_cache
+from hashlib import sha1
+import json
+import sys
+import threading
+from types import CodeType
+from typing import Dict, Optional
+
+# Project Internals
+from bytecode_optimizer._flags import Flags
+from bytecode_optimizer._passes import original_name
+
+PROFILE_FORMAT = 1
+# Overrides for code a profile marks as hot or cold, hot code gets the
+# aggressive passes, cold code only a single round of the cheap ones
+HOT_FLAGS = {"HOIST_LOADS": True}
+COLD_FLAGS = {"REMOVE_UNUSED_VARS": False, "HOIST_LOADS": False, "OPTIMIZE_ITERATIONS": 1}
+
+monitoring = getattr(sys, "monitoring", None)
+
+
+def profile_key(code: CodeType) -> str:
+    # Stable across processes, and the same before and after optimizing
+    name = original_name(getattr(code, "co_qualname", code.co_name))
+    return f"{code.co_filename}:{code.co_firstlineno}:{name}"
+
+
+class Profile:
+    """
+    How often code objects ran during a training run, as calls plus loop iterations.
+    """
+
+    def __init__(self, counts: Dict[str, int]):
+        self.counts = counts
+        self.digest = sha1(repr(sorted(counts.items())).encode()).hexdigest()
+
+    def __repr__(self) -> str:
+        # Part of the cache key through the flags, so it must change with the counts
+        return f"<Profile {self.digest}>"
+
+    def count(self, code: CodeType) -> int:
+        return self.counts.get(profile_key(code), 0)
+
+    def is_hot(self, code: CodeType, flags: type = Flags) -> bool:
+        return self.count(code) >= flags.PROFILE_HOT_COUNT
+
+    @classmethod
+    def load(cls, path: str) -> "Profile":
+        with open(path) as fp:
+            data = json.load(fp)
+        if data.get("format") != PROFILE_FORMAT:
+            raise ValueError(f"{path} is not a profile written by this version")
+        return cls({key: entry["calls"] + entry["loops"]
+                    for key, entry in data["code"].items()})
+
+
+class Recorder:
+    """
+    Counts calls and loop iterations of every code object while active, and
+    writes them to `path` when used as a context manager.
+
+    Uses `sys.monitoring` since 3.12; before that `sys.setprofile`, which
+    only sees calls.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.calls = Counter()  # type: Counter
+        self.loops = Counter()  # type: Counter
+
+    def __enter__(self) -> "Recorder":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        if self.path is not None:
+            self.save(self.path)
+
+    def start(self):
+        if monitoring is not None:
+            tool = monitoring.PROFILER_ID
+            monitoring.use_tool_id(tool, "bytecode_optimizer")
+            monitoring.register_callback(tool, monitoring.events.PY_START, self._on_start)
+            monitoring.register_callback(tool, monitoring.events.JUMP, self._on_jump)
+            monitoring.set_events(tool, monitoring.events.PY_START | monitoring.events.JUMP)
+        else:
+            threading.setprofile(self._on_event)
+            sys.setprofile(self._on_event)
+
+    def stop(self):
+        if monitoring is not None:
+            tool = monitoring.PROFILER_ID
+            monitoring.set_events(tool, 0)
+            monitoring.register_callback(tool, monitoring.events.PY_START, None)
+            monitoring.register_callback(tool, monitoring.events.JUMP, None)
+            monitoring.free_tool_id(tool)
+        else:
+            sys.setprofile(None)
+            threading.setprofile(None)
+
+    def _on_start(self, code: CodeType, _):
+        self.calls[code] += 1
+
+    def _on_jump(self, code: CodeType, offset: int, destination: int):
+        if destination < offset:
+            self.loops[code] += 1
+
+    def _on_event(self, frame, event: str, _):
+        if event == "call":
+            self.calls[frame.f_code] += 1
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        code = {}
+        for counts, field in ((self.calls, "calls"), (self.loops, "loops")):
+            for code_object, count in counts.items():
+                entry = code.setdefault(profile_key(code_object), {"calls": 0, "loops": 0})
+                entry[field] += count
+        return code
+
+    def save(self, path: str):
+        with open(path, "w") as fp:
+            json.dump({"format": PROFILE_FORMAT, "code": self.as_dict()}, fp, indent=1,
+                      sort_keys=True)
+
+
+def use_profile(path: Optional[str]):
+    Flags.PROFILE = Profile.load(path) if path is not None else None
+
+
+def profile_flags(code: CodeType, flags: type) -> type:
+    # The flags to optimize `code` itself with, nested code is looked up separately
+    if flags.PROFILE is None:
+        return flags
+    return _derived_flags(flags, flags.PROFILE.is_hot(code, flags))
+
+
+@lru_cache(maxsize=64)
+def _derived_flags(flags: type, hot: bool) -> type:
+    return type("Flags", (flags, ), HOT_FLAGS if hot else COLD_FLAGS)
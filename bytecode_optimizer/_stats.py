@@ -0,0 +1,190 @@
+# Stdlib
+from contextlib import contextmanager
+import json
+import threading
+from types import CodeType
+from typing import Any, Dict, Iterator, Optional
+
+# Project Internals
+from bytecode_optimizer._bytecode import disassemble
+
+
+class PassStats:
+    """
+    Totals over every run of one pass.
+
+    Instruction counts and stack sizes are summed over the runs, so that
+    `ops_before - ops_after` is the number of instructions the pass removed.
+    """
+    __slots__ = ("runs", "time", "ops_before", "ops_after", "stack_before", "stack_after",
+                 "rewrites")
+
+    def __init__(self):
+        self.runs = 0
+        self.time = 0.0
+        self.ops_before = 0
+        self.ops_after = 0
+        self.stack_before = 0
+        self.stack_after = 0
+        self.rewrites = 0
+
+    def add(self, other: "PassStats"):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class CodeStats:
+    """
+    What optimizing a single code object did, across all optimizer iterations.
+    """
+    __slots__ = ("name", "filename", "firstlineno", "time", "ops_before", "ops_after",
+                 "stack_before", "stack_after", "passes")
+
+    def __init__(self, code: CodeType, name: str):
+        self.name = name
+        self.filename = code.co_filename
+        self.firstlineno = code.co_firstlineno
+        self.time = 0.0
+        self.ops_before = len(disassemble(code))
+        self.ops_after = self.ops_before
+        self.stack_before = code.co_stacksize
+        self.stack_after = self.stack_before
+        self.passes = {}
+
+    def record(self, name: str, time: float, ops_before: int, ops_after: int, stack_before: int,
+               stack_after: int, rewrites: int):
+        run = PassStats()
+        run.runs = 1
+        run.time = time
+        run.ops_before = ops_before
+        run.ops_after = ops_after
+        run.stack_before = stack_before
+        run.stack_after = stack_after
+        run.rewrites = rewrites
+        self.passes.setdefault(name, PassStats()).add(run)
+
+    def as_dict(self) -> Dict[str, Any]:
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data["passes"] = {name: stats.as_dict() for name, stats in self.passes.items()}
+        return data
+
+
+class OptimizerStats:
+    """
+    Statistics collected while `Flags.COLLECT_STATS` is set, grouped by module.
+
+    Code optimized outside of an import, e.g. through `optimized`, is grouped
+    under the module the function was defined in.
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self.tail_calls = {}
+        self.comprehensions = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def module(self, name: str) -> Iterator[None]:
+        previous = getattr(self._local, "module", None)
+        self._local.module = name
+        try:
+            yield
+        finally:
+            self._local.module = previous
+
+    def code(self, code: CodeType, name: str) -> CodeStats:
+        module = getattr(self._local, "module", None) or "<unknown>"
+        key = (code.co_filename, code.co_firstlineno, name)
+        with self._lock:
+            codes = self.modules.setdefault(module, {})
+            if key not in codes:
+                codes[key] = CodeStats(code, name)
+            return codes[key]
+
+    def tail_call(self, filename: str, function: str, line: int, target: str, status: str):
+        """
+        Record what became of a tail call, "converted" or why it was not.
+        """
+        module = getattr(self._local, "module", None) or "<unknown>"
+        with self._lock:
+            calls = self.tail_calls.setdefault(module, {})
+            calls[(filename, function, line, target)] = status
+
+    def comprehension(self, filename: str, function: str, line: int, kind: str, status: str):
+        """
+        Record whether a comprehension was inlined, "inlined" or why it was not.
+        """
+        module = getattr(self._local, "module", None) or "<unknown>"
+        with self._lock:
+            comprehensions = self.comprehensions.setdefault(module, {})
+            comprehensions[(filename, function, line, kind)] = status
+
+    def reset(self):
+        with self._lock:
+            self.modules = {}
+            self.tail_calls = {}
+            self.comprehensions = {}
+
+    def totals(self, module: Optional[str] = None) -> Dict[str, PassStats]:
+        totals = {}
+        with self._lock:
+            for name, codes in self.modules.items():
+                if module is not None and name != module:
+                    continue
+                for code in codes.values():
+                    for pass_name, stats in code.passes.items():
+                        totals.setdefault(pass_name, PassStats()).add(stats)
+        return totals
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            modules = {name: list(codes.values()) for name, codes in self.modules.items()}
+            tail_calls = {
+                name: [{
+                    "filename": filename,
+                    "function": function,
+                    "line": line,
+                    "target": target,
+                    "status": status,
+                } for (filename, function, line, target), status in calls.items()]
+                for name, calls in self.tail_calls.items()
+            }
+            comprehensions = {
+                name: [{
+                    "filename": filename,
+                    "function": function,
+                    "line": line,
+                    "kind": kind,
+                    "status": status,
+                } for (filename, function, line, kind), status in inlined.items()]
+                for name, inlined in self.comprehensions.items()
+            }
+        return {
+            "time": sum(code.time for codes in modules.values() for code in codes),
+            "passes": {name: stats.as_dict() for name, stats in self.totals().items()},
+            "modules": {
+                name: {
+                    "time": sum(code.time for code in codes),
+                    "ops_before": sum(code.ops_before for code in codes),
+                    "ops_after": sum(code.ops_after for code in codes),
+                    "passes": {
+                        pass_name: stats.as_dict()
+                        for pass_name, stats in self.totals(name).items()
+                    },
+                    "code": [code.as_dict() for code in codes],
+                    "tail_calls": tail_calls.get(name, []),
+                    "comprehensions": comprehensions.get(name, []),
+                }
+                for name, codes in modules.items()
+            },
+        }
+
+    def to_json(self, **kwargs: Any) -> str:
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+stats = OptimizerStats()
@@ -0,0 +1,482 @@
+# Stdlib
+from dis import findlinestarts, hasconst, haslocal, hasname, opmap
+from inspect import (CO_ASYNC_GENERATOR, CO_COROUTINE, CO_GENERATOR, CO_ITERABLE_COROUTINE,
+                     CO_OPTIMIZED, CO_VARARGS, CO_VARKEYWORDS)
+from types import CodeType
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+# Project Internals
+from bytecode_optimizer._bytecode import (CALL, JUMP, PRECALL, PUSH_NULL, RESUME, argument_count,
+                                          cell_slots, disassemble, exception_entries, replace,
+                                          write_line_table)
+from bytecode_optimizer._cfg import (EXCEPTION_SETUPS, LOCAL_LOADS, SETUP_LOOP, BasicBlock,
+                                     ControlFlowGraph, Op, assemble, fix_handlers, fix_jumps,
+                                     get_stack_effect, max_stack_depth, stack_depths)
+from bytecode_optimizer._stats import stats
+
+# Functions that can't simply restart with new arguments
+UNSUPPORTED_FLAGS = (CO_VARARGS | CO_VARKEYWORDS | CO_GENERATOR | CO_COROUTINE
+                     | CO_ITERABLE_COROUTINE | CO_ASYNC_GENERATOR)
+# Limit on the instructions copied into a function for mutual recursion
+MAX_INLINED_OPS = 1000
+
+MAKE_FUNCTION = opmap["MAKE_FUNCTION"]
+# Before 3.11 the qualified name is pushed after the code of a function
+CODE_OPERAND = 1 if RESUME is None else 0
+CALL_FUNCTION_KW = opmap.get("CALL_FUNCTION_KW")
+# Since 3.11 the function is called with a NULL below it, through [KW_NAMES] [PRECALL] CALL
+KW_NAMES = opmap.get("KW_NAMES")
+CALLEE_OPS = 1 if PUSH_NULL is None else 2
+# Set up the frame since 3.11, jumping back to the start must not run them again
+PROLOGUE_OPS = frozenset(opmap[name] for name in ("COPY_FREE_VARS", "MAKE_CELL", "RESUME")
+                         if name in opmap)
+RETURN_VALUE = opmap["RETURN_VALUE"]
+LOAD_CONST = opmap["LOAD_CONST"]
+STORE_FAST = opmap["STORE_FAST"]
+DELETE_FAST = opmap["DELETE_FAST"]
+
+
+class Function(NamedTuple):
+    name: str
+    index: int  # of its code in the enclosing constants
+    code: CodeType
+    # None when they are not constants, so calls must pass every argument
+    defaults: Optional[Tuple[Any, ...]]
+    kwdefaults: Optional[Dict[str, Any]]
+
+
+class Scope(NamedTuple):
+    """
+    How the functions of a module, or of an enclosing function, refer to each other.
+    """
+    store: Tuple[int, ...]  # instructions binding a name in the enclosing code
+    rebind: Tuple[int, ...]  # instructions rebinding it from nested code
+    load: int  # instruction loading it in the function itself
+    module: bool
+
+
+MODULE_SCOPE = Scope((opmap["STORE_NAME"], opmap["DELETE_NAME"], opmap["STORE_GLOBAL"],
+                      opmap["DELETE_GLOBAL"]),
+                     (opmap["STORE_GLOBAL"], opmap["DELETE_GLOBAL"]), opmap["LOAD_GLOBAL"], True)
+CLOSURE_SCOPE = Scope((opmap["STORE_DEREF"], opmap["DELETE_DEREF"]),
+                      (opmap["STORE_DEREF"], opmap["DELETE_DEREF"]), opmap["LOAD_DEREF"], False)
+
+
+class TailCall(NamedTuple):
+    block: BasicBlock
+    callee: int  # position of the instructions loading the called function
+    end: int  # of the instructions calling it
+    target: Function
+    positional: int
+    keywords: Tuple[str, ...]
+
+
+def operands(ops: List[Op], end: int, count: int) -> Optional[List[Tuple[int, int]]]:
+    # The ranges of instructions pushing the `count` topmost values before `end`, topmost first
+    ranges = []
+    stop = end
+    for _ in range(count):
+        needed = 1
+        start = stop
+        while needed > 0:
+            start -= 1
+            if start < 0:
+                return None
+            needed -= get_stack_effect(ops[start], jump=False)
+        if needed:
+            return None
+        ranges.append((start, stop))
+        stop = start
+    return ranges
+
+
+def constant(cfg: ControlFlowGraph, ops: List[Op]) -> Any:
+    # The value pushed by `ops`, if they only build a constant tuple or dict
+    if all(op[0] == LOAD_CONST for op in ops):
+        return cfg.consts[ops[-1][1]] if len(ops) == 1 else None
+    if ops[-1][0] == opmap["BUILD_CONST_KEY_MAP"] and all(op[0] == LOAD_CONST for op in ops[:-1]):
+        *values, keys = [cfg.consts[op[1]] for op in ops[:-1]]
+        return dict(zip(keys, values))
+    return None
+
+
+def nested_code(code: CodeType) -> Iterator[CodeType]:
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            yield const
+            yield from nested_code(const)
+
+
+def scope_names(code: CodeType, scope: Scope) -> Tuple[str, ...]:
+    return code.co_names if scope.module else code.co_cellvars + code.co_freevars
+
+
+def find_functions(cfg: ControlFlowGraph, scope: Scope) -> Dict[str, Function]:
+    """
+    Functions defined once in the code of `cfg` and bound to a name nothing rebinds.
+    """
+    names = scope_names(cfg.code, scope)
+    stores = {}
+    for op in cfg.ops:
+        if op[0] in scope.store:
+            stores[names[op[1]]] = stores.get(names[op[1]], 0) + 1
+    rebound = set()
+    for code in nested_code(cfg.code):
+        nested_names = scope_names(code, scope)
+        rebound.update(nested_names[op[1]] for op in disassemble(code) if op[0] in scope.rebind)
+
+    functions = {}
+    for block in cfg:
+        ops = block.ops
+        for i, op in enumerate(ops[:-1]):
+            # Decorated functions are bound to whatever the decorator returned
+            store = ops[i + 1]
+            if op[0] != MAKE_FUNCTION or store[0] != scope.store[0]:
+                continue
+            name = names[store[1]]
+            flags = [flag for flag in (8, 4, 2, 1) if op[1] & flag]
+            ranges = operands(ops, i, CODE_OPERAND + 1 + len(flags))
+            if stores[name] != 1 or name in rebound or ranges is None:
+                continue
+            start, stop = ranges[CODE_OPERAND]
+            if stop - start != 1 or not isinstance(cfg.consts[ops[start][1]], CodeType):
+                continue
+            index = ops[start][1]
+            # The remaining operands are, topmost first: closure, annotations,
+            # keyword-only defaults and defaults
+            optional = dict(zip(flags, ranges[CODE_OPERAND + 1:]))
+            defaults = kwdefaults = None
+            if 1 in optional:
+                defaults = constant(cfg, ops[slice(*optional[1])])
+            if 2 in optional:
+                kwdefaults = constant(cfg, ops[slice(*optional[2])])
+            functions[name] = Function(
+                name, index, cfg.consts[index],
+                defaults if isinstance(defaults, tuple) or 1 in optional else (),
+                kwdefaults if isinstance(kwdefaults, dict) or 2 in optional else {})
+    return functions
+
+
+def eligible(code: CodeType) -> bool:
+    # Restarting a function reuses its frame, cells would be shared between calls
+    return not code.co_flags & UNSUPPORTED_FLAGS and not code.co_cellvars
+
+
+def find_tail_calls(cfg: ControlFlowGraph, functions: Dict[str, Function], names: List[str],
+                    load: int) -> List[TailCall]:
+    calls = []
+    for block in cfg:
+        ops = block.ops
+        if len(ops) < 3 or ops[-1][0] != RETURN_VALUE or ops[-2][0] not in (CALL, CALL_FUNCTION_KW):
+            continue
+        end = len(ops) - 2
+        if PRECALL is not None:
+            end -= 1
+            if ops[end][0] != PRECALL:
+                continue
+        keywords = ()
+        if ops[-2][0] == CALL_FUNCTION_KW or KW_NAMES is not None and ops[end - 1][0] == KW_NAMES:
+            end -= 1
+            is_const = ops[end][0] in (LOAD_CONST, KW_NAMES)
+            keywords = cfg.consts[ops[end][1]] if is_const else None
+            if not isinstance(keywords, tuple):
+                continue
+        ranges = operands(ops, end, ops[-2][1] + 1)
+        if ranges is None:
+            continue
+        start, stop = ranges[-1]
+        if stop - start != 1 or ops[start][0] != load or names[ops[start][1]] not in functions:
+            continue
+        target = functions[names[ops[start][1]]]
+        if PUSH_NULL is not None:
+            if not start or ops[start - 1][0] != PUSH_NULL:
+                continue
+            start -= 1
+        calls.append(TailCall(block, start, end, target, ops[-2][1] - len(keywords), keywords))
+    return calls
+
+
+def bind(call: TailCall) -> Union[str, Tuple[List[int], List[Tuple[int, Any]]]]:
+    """
+    The parameters receiving the arguments of `call` in order, and the ones
+    set to their default, or why they can't be found ahead of time.
+    """
+    function = call.target
+    code = function.code
+    params = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+    if call.positional > code.co_argcount:
+        return "too many positional arguments"
+    assigned = list(range(call.positional))
+    for name in call.keywords:
+        if name not in params or params.index(name) < getattr(code, "co_posonlyargcount", 0):
+            return f"unexpected keyword argument {name!r}"
+        if params.index(name) in assigned:
+            return f"multiple values for argument {name!r}"
+        assigned.append(params.index(name))
+
+    missing = []
+    first_default = code.co_argcount - len(function.defaults or ())
+    for i, name in enumerate(params):
+        if i in assigned:
+            continue
+        if i < code.co_argcount:
+            if function.defaults is None:
+                return "defaults are not constant"
+            if i < first_default:
+                return f"missing argument {name!r}"
+            missing.append((i, function.defaults[i - first_default]))
+        else:
+            if function.kwdefaults is None:
+                return "keyword-only defaults are not constant"
+            if name not in function.kwdefaults:
+                return f"missing keyword-only argument {name!r}"
+            missing.append((i, function.kwdefaults[name]))
+    return assigned, missing
+
+
+def unassigned_reads(code: CodeType) -> Set[int]:
+    """
+    The locals other than parameters that `code` may read before assigning
+    them, which a call would find unbound.
+    """
+    cfg = ControlFlowGraph.from_code(code)
+    successors = cfg.successors()
+    handlers = cfg.handlers()
+    params = argument_count(code)
+    unassigned = {block.label: 0 for block in cfg}
+    unassigned[cfg.entry.label] = sum(1 << i for i in range(params, len(code.co_varnames)))
+    reads = set()
+    pending = list(reversed(cfg.blocks))
+    while pending:
+        block = pending.pop()
+        state = deleted = unassigned[block.label]
+        for op in block.ops:
+            if op[0] in LOCAL_LOADS and state & 1 << op[1]:
+                reads.add(op[1])
+            if op[0] == STORE_FAST:
+                state &= ~(1 << op[1])
+            elif op[0] == DELETE_FAST:
+                state |= 1 << op[1]
+                deleted |= 1 << op[1]
+        # A handler may run anywhere in the block
+        edges = [(following, state) for following in successors[block.label]]
+        edges += [(handler, deleted) for handler in handlers[block.label]]
+        for following, value in edges:
+            if value & ~unassigned[following.label]:
+                unassigned[following.label] |= value
+                pending.append(following)
+    return reads
+
+
+def protected_blocks(cfg: ControlFlowGraph) -> Set[int]:
+    # Blocks inside a loop, try or with statement, which returning has to unwind
+    positions = {block.label: i for i, block in enumerate(cfg.blocks)}
+    protected = set()
+    for i, block in enumerate(cfg.blocks):
+        jump = block.jump
+        if jump is not None and (jump[0] == SETUP_LOOP or jump[0] in EXCEPTION_SETUPS):
+            protected.update(inner.label for inner in cfg.blocks[i + 1:positions[jump[1]]])
+    if cfg.exceptions:
+        # Since 3.11 the exception table says what try and with statements cover
+        protected.update(label for label, handlers in cfg.handlers().items() if handlers)
+    return protected
+
+
+def inline(cfg: ControlFlowGraph, function: Function, offset: int) -> Tuple[int, List[int]]:
+    """
+    Append a copy of `function` to `cfg`, with locals of its own.
+
+    Returns the label the copy starts at and the locals of its parameters.
+    """
+    nested = ControlFlowGraph.from_code(function.code)
+    labels = {block.label: cfg.new_label() for block in nested}
+    slots = [cfg.add_local(f".{function.name}.{name}") for name in function.code.co_varnames]
+    for block in nested:
+        jump = block.jump
+        ops = []
+        for op in block.ops:
+            arg = op[1]
+            if op[0] in PROLOGUE_OPS:
+                continue
+            if op is jump:
+                arg = labels[arg]
+            elif op[0] in hasconst:
+                arg = cfg.add_const(nested.consts[arg])
+            elif op[0] in hasname:
+                arg = cfg.add_name(nested.names[arg])
+            elif op[0] in haslocal:
+                arg = slots[arg]
+            # Report errors in the copy at the call that led to it
+            ops.append((op[0], arg, offset))
+        cfg.insert(len(cfg.blocks), ops, labels[block.label])
+    return labels[nested.entry.label], slots
+
+
+def line_number(code: CodeType, offset: int) -> int:
+    line = code.co_firstlineno
+    for start, start_line in findlinestarts(code):
+        if start > offset:
+            break
+        line = start_line
+    return line
+
+
+def report(flags: type, function: Function, call: TailCall, offset: int, status: str):
+    line = line_number(function.code, offset)
+    if flags.DEBUG:
+        print(f"{function.code.co_filename}:{line}: tail call from {function.name} "
+              f"to {call.target.name}: {status}")
+    if flags.COLLECT_STATS:
+        stats.tail_call(function.code.co_filename, function.name, line, call.target.name,
+                        status)
+
+
+def convert(cfg: ControlFlowGraph, function: Function, members: Dict[str, Function],
+            load: int, names: List[str]) -> Tuple[CodeType, int]:
+    """
+    Turn the tail calls `function` makes to itself and to `members` into jumps.
+
+    Other members are copied into the function so it can jump to them.
+    """
+    code = function.code
+    entry = cfg.entry
+    prologue = 0
+    while prologue < len(entry.ops) and entry.ops[prologue][0] in PROLOGUE_OPS:
+        prologue += 1
+    if prologue:
+        # Jump past the frame setup, into a block of its own
+        start = cfg.insert(1, entry.ops[prologue:]) if prologue < len(entry.ops) else cfg.blocks[1]
+        entry.ops = entry.ops[:prologue]
+    else:
+        start = entry
+    entries = {function.name: (start.label, list(range(len(code.co_varnames))))}
+    inlined = []
+    offsets = {}
+    for call in find_tail_calls(cfg, members, names, load):
+        offsets.setdefault(call.target.name, call.block.ops[-2][2])
+    size = 0
+    for name, member in sorted(members.items()):
+        if name in entries:
+            continue
+        size += len(disassemble(member.code))
+        # Its exception table isn't copied with it
+        if (size > MAX_INLINED_OPS or not eligible(member.code) or member.code.co_freevars
+                or exception_entries(member.code)):
+            continue
+        entries[name] = inline(cfg, member, offsets.get(name, 0))
+        inlined.append(member)
+
+    depths = stack_depths(cfg)
+    protected = protected_blocks(cfg)
+    unbound = {}
+    converted = 0
+    for call in find_tail_calls(cfg, members, names, load):
+        ops = call.block.ops
+        offset = ops[-2][2]
+        depth = depths.get(call.block.label)
+        binding = bind(call)
+        if call.target.name not in entries:
+            status = "too large to copy into the function"
+        elif call.block.label in protected:
+            status = "inside a loop, try or with statement"
+        elif depth is None or depth + sum(get_stack_effect(op, jump=False)
+                                          for op in ops[:call.callee]):
+            status = "values are left on the stack"
+        elif isinstance(binding, str):
+            status = binding
+        else:
+            entry, slots = entries[call.target.name]
+            assigned, missing = binding
+            new_ops = ops[:call.callee] + ops[call.callee + CALLEE_OPS:call.end]
+            new_ops += [(STORE_FAST, slots[param], offset) for param in reversed(assigned)]
+            for param, value in missing:
+                new_ops += [(LOAD_CONST, cfg.add_const(value), offset),
+                            (STORE_FAST, slots[param], offset)]
+            if call.target.name not in unbound:
+                unbound[call.target.name] = sorted(unassigned_reads(call.target.code))
+            # The call would start with these unbound, DELETE_FAST alone raises if they are
+            for local in unbound[call.target.name]:
+                new_ops += [(LOAD_CONST, cfg.add_const(None), offset),
+                            (STORE_FAST, slots[local], offset),
+                            (DELETE_FAST, slots[local], offset)]
+            new_ops.append((JUMP, entry, offset))
+            call.block.ops = new_ops
+            converted += 1
+            status = "converted"
+        report(cfg.flags, function, call, offset, status)
+    if not converted:
+        return code, 0
+
+    reachable = cfg.reachable()
+    cfg.remove([block for block in cfg if block.label not in reachable])
+    ops = fix_jumps(cfg)
+    handlers = fix_handlers(cfg)
+    assembly = assemble(ops, handlers, cell_slots(cfg.varnames, code.co_cellvars, code.co_freevars))
+    return replace(code, co_code=assembly.code, co_consts=tuple(cfg.consts),
+                   co_names=tuple(cfg.names), co_varnames=tuple(cfg.varnames),
+                   co_nlocals=len(cfg.varnames),
+                   co_stacksize=max_stack_depth(cfg),
+                   co_linetable=write_line_table(ops, assembly.offsets, len(assembly.code), code),
+                   co_exceptiontable=assembly.exception_table), converted
+
+
+def reachable(start: str, graph: Dict[str, Set[str]]) -> Set[str]:
+    seen = set()
+    pending = [start]
+    while pending:
+        for name in graph[pending.pop()]:
+            if name not in seen:
+                seen.add(name)
+                pending.append(name)
+    return seen
+
+
+def optimize_tail_calls(cfg: ControlFlowGraph) -> int:
+    """
+    Turn tail calls between the functions defined in `cfg` into jumps.
+
+    Only functions bound once, to a name nothing else assigns, are considered,
+    and with `Flags.PROFILE` only hot ones.
+    Functions of a module calling each other in tail position are merged, so
+    each can jump into the others.
+    """
+    code = cfg.code
+    if code.co_flags & CO_OPTIMIZED:
+        scope = CLOSURE_SCOPE
+    elif code.co_name == "<module>":
+        scope = MODULE_SCOPE
+    else:
+        # Functions in class bodies can't refer to each other by name
+        return 0
+    functions = {
+        name: function
+        for name, function in find_functions(cfg, scope).items() if eligible(function.code)
+    }
+    graph = {}
+    for name, function in functions.items():
+        names = scope_names(function.code, scope)
+        calls = find_tail_calls(ControlFlowGraph.from_code(function.code), functions,
+                                list(names), scope.load)
+        graph[name] = {call.target.name for call in calls}
+
+    profile = cfg.flags.PROFILE
+    converted = 0
+    for name, function in functions.items():
+        cycle = reachable(name, graph)
+        if name not in cycle:
+            continue
+        if profile is not None and not profile.is_hot(function.code, cfg.flags):
+            # With a profile only hot functions are converted
+            continue
+        members = {
+            other: functions[other]
+            for other in cycle if scope.module and name in reachable(other, graph)
+        }
+        members[name] = function
+        function_cfg = ControlFlowGraph.from_code(function.code)
+        function_cfg.flags = cfg.flags
+        names = function_cfg.names if scope.module else list(scope_names(function.code, scope))
+        new_code, count = convert(function_cfg, function, members, scope.load, names)
+        cfg.consts[function.index] = new_code
+        converted += count
+    return converted
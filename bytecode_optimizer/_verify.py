@@ -0,0 +1,106 @@
+# Stdlib
+from dis import hasconst, hasfree, haslocal, hasname, opname
+import sys
+from types import CodeType
+from typing import List, Optional
+
+# Project Internals
+from bytecode_optimizer._bytecode import JUMP_OPS, Op, disassemble, exception_entries
+from bytecode_optimizer._cfg import CONTINUE_LOOP, branch_effect, falls_through
+
+# Before 3.9 finally and except blocks are entered with the block stack deciding
+# what to unwind, so paths meet with different depths and the largest one counts.
+# Jumping back doesn't raise the depth, like in the compiler, as before 3.8 only the
+# largest effects are known and they can add up around a loop
+EXACT_DEPTHS = sys.version_info >= (3, 9)
+
+
+class VerificationError(ValueError):
+    pass
+
+
+def verify(code: CodeType):
+    """
+    Check that `code` is safe to run, raising `VerificationError` if it isn't.
+
+    Every index must be in range, every jump and handler must land on an
+    instruction, and every instruction must be reached with the same stack
+    depth on every path, within `co_stacksize`. Nested code is not checked.
+    """
+    def fail(message: str, offset: Optional[int] = None):
+        where = "" if offset is None else f" at offset {offset}"
+        raise VerificationError(f"{code.co_name}: {message}{where}")
+
+    if code.co_nlocals != len(code.co_varnames):
+        fail(f"co_nlocals is {code.co_nlocals} for {len(code.co_varnames)} locals")
+    try:
+        ops = disassemble(code)
+    except (IndexError, KeyError):
+        fail("truncated instruction or cell index out of range")
+    if not ops:
+        fail("no instructions")
+
+    cells = len(code.co_cellvars) + len(code.co_freevars)
+    for op in ops:
+        for table, size, kind in ((hasconst, len(code.co_consts), "constant"),
+                                  (hasname, len(code.co_names), "name"),
+                                  (haslocal, len(code.co_varnames), "local"),
+                                  (hasfree, cells, "cell")):
+            if op[0] in table and op[1] >= size:
+                fail(f"{opname[op[0]]} uses {kind} {op[1]} of {size}", op[2])
+
+    # PUSH_NULL split off a LOAD_GLOBAL shares its offset
+    positions = {}
+    for i, op in enumerate(ops):
+        positions.setdefault(op[2], i)
+    for op in ops:
+        if op[0] in JUMP_OPS and op[1] not in positions:
+            fail(f"{opname[op[0]]} jumps to offset {op[1]}, which starts no instruction", op[2])
+    handlers = [None] * len(ops)
+    for entry in exception_entries(code):
+        if entry.target not in positions or entry.start not in positions or (
+                entry.end not in positions and entry.end != len(code.co_code)):
+            fail(f"exception table entry {tuple(entry)} doesn't match the instructions")
+        for i in range(positions[entry.start], len(ops)):
+            if ops[i][2] >= entry.end:
+                break
+            handlers[i] = entry
+
+    stack_depths(ops, positions, handlers, code.co_stacksize, fail)
+
+
+def stack_depths(ops: List[Op], positions: dict, handlers: list, limit: int, fail) -> List[int]:
+    # The stack depth before each instruction, -1 where it is never reached
+    depths = [-1] * len(ops)
+    depths[0] = 0
+    pending = [0]
+    current = 0
+
+    def reach(i: int, depth: int, source: Op):
+        if depth < 0:
+            fail(f"stack underflow after {opname[source[0]]}", source[2])
+        if depth > limit:
+            fail(f"stack depth {depth} exceeds co_stacksize {limit}", source[2])
+        if i == len(ops):
+            fail(f"{opname[source[0]]} falls off the end of the code", source[2])
+        if depths[i] == -1 or depths[i] < depth and not EXACT_DEPTHS and i > current:
+            depths[i] = depth
+            pending.append(i)
+        elif depths[i] != depth and EXACT_DEPTHS:
+            fail(f"reached with stack depths {depths[i]} and {depth}", ops[i][2])
+
+    while pending:
+        i = current = pending.pop()
+        op = ops[i]
+        depth = depths[i]
+        handler = handlers[i]
+        if handler is not None:
+            if handler.depth > depth:
+                fail(f"handler expects depth {handler.depth} but the stack has {depth}", op[2])
+            # The exception, and the offset it was raised at, are pushed for the handler
+            reach(positions[handler.target], handler.depth + handler.lasti + 1, op)
+        if op[0] in JUMP_OPS and op[0] != CONTINUE_LOOP:
+            reach(positions[op[1]], depth + branch_effect(op, True), op)
+        if falls_through(op):
+            reach(i + 1, depth + branch_effect(op, False), op)
+    return depths
@@ -0,0 +1,110 @@
+from dis import opmap
+import os
+import subprocess
+import sys
+
+from bytecode_optimizer import Flags, Policy
+from bytecode_optimizer._import_loader import ByteOptimizerLoader, CACHE_OPTIMIZATION, write_cache
+from importlib.util import cache_from_source
+
+SOURCE = """
+def main():
+    x = 10
+    y = 20
+    z = x + y
+    return z
+"""
+
+
+def load(path):
+    loader = ByteOptimizerLoader("cached_module", path)
+    return loader.get_code("cached_module")
+
+
+def test_cache_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    path = str(tmp_path / "cached_module.py")
+    with open(path, "w") as fp:
+        fp.write(SOURCE)
+    cached = cache_from_source(path, optimization=CACHE_OPTIMIZATION)
+    assert cached.endswith(".opt-bco.pyc")
+
+    code = load(path)
+    assert os.path.exists(cached)
+
+    # A warm load must not run the optimizer again
+    monkeypatch.setattr(ByteOptimizerLoader, "source_to_code", None)
+    assert load(path) == code
+
+
+def test_cache_fixes_filename(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    path = str(tmp_path / "cached_module.py")
+    with open(path, "w") as fp:
+        fp.write(SOURCE)
+    st = os.stat(path)
+    # As if written for the same file at another location
+    code = compile(SOURCE, os.path.join("elsewhere", "cached_module.py"), "exec")
+    write_cache(cache_from_source(path, optimization=CACHE_OPTIMIZATION), code,
+                int(st.st_mtime), st.st_size)
+    monkeypatch.setattr(ByteOptimizerLoader, "source_to_code", None)
+    code = load(path)
+    main = next(const for const in code.co_consts if hasattr(const, "co_code"))
+    assert code.co_filename == main.co_filename == path
+
+
+def test_cache_invalidated_by_flags(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    path = str(tmp_path / "cached_module.py")
+    with open(path, "w") as fp:
+        fp.write(SOURCE)
+    load(path)
+
+    monkeypatch.setattr(Flags, "OPTIMIZE_ACCESSORS", not Flags.OPTIMIZE_ACCESSORS)
+    calls = []
+    source_to_code = ByteOptimizerLoader.source_to_code
+
+    def counting(self, *args, **kwargs):
+        calls.append(args)
+        return source_to_code(self, *args, **kwargs)
+
+    monkeypatch.setattr(ByteOptimizerLoader, "source_to_code", counting)
+    load(path)
+    assert len(calls) == 1
+
+
+def test_cache_invalidated_by_policy(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    path = str(tmp_path / "cached_module.py")
+    with open(path, "w") as fp:
+        fp.write(SOURCE)
+
+    def stores(policy):
+        monkeypatch.setattr(ByteOptimizerLoader, "policy", policy)
+        main = next(const for const in load(path).co_consts if hasattr(const, "co_code"))
+        return opmap["STORE_FAST"] in main.co_code[::2]
+
+    # Whichever policy ran first, the module is optimized exactly when the current one says so
+    excluded = Policy(exclude=("cached_module", ))
+    assert stores(excluded)
+    assert not stores(Policy())
+    assert stores(excluded)
+
+
+def test_cache_per_optimization_level(tmp_path):
+    with open(str(tmp_path / "asserting.py"), "w") as fp:
+        fp.write("def check():\n    assert False\n    return 1\n")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmp_path)] + sys.path))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    script = ("from bytecode_optimizer import enable; enable()\n"
+              "import asserting\n"
+              "try:\n    print(asserting.check())\nexcept AssertionError:\n    print('assert')\n")
+
+    def run(*options):
+        return subprocess.run([sys.executable, *options, "-c", script], env=env, cwd=str(tmp_path),
+                              stdout=subprocess.PIPE, check=True).stdout.strip()
+
+    # Each level reads the cache the other one wrote, and must not use it
+    assert run("-O") == b"1"
+    assert run() == b"assert"
+    assert run("-O") == b"1"
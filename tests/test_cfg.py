@@ -0,0 +1,134 @@
+from dis import opmap
+
+from bytecode_optimizer import optimized
+from bytecode_optimizer._bytecode import POP_JUMP_IF_FALSE, disassemble, exception_table
+from bytecode_optimizer._cfg import ControlFlowGraph, max_stack_depth
+from bytecode_optimizer._optimizer import assemble, fix_handlers, fix_jumps, remove_unused_variables
+
+
+def branches(a, b):
+    total = 0
+    for i in range(a):
+        if i % 2:
+            continue
+        while b:
+            b -= 1
+            if b == 3:
+                break
+        total += i
+    try:
+        total //= b
+    except ZeroDivisionError:
+        total = -1
+    return total
+
+
+def test_roundtrip():
+    code = branches.__code__
+    cfg = ControlFlowGraph.from_code(code)
+    assembly = assemble(fix_jumps(cfg), fix_handlers(cfg))
+    assert assembly.code == code.co_code
+    assert assembly.exception_table == exception_table(code)
+
+
+def test_extended_args():
+    namespace = {}
+    exec("def long_jumps(a):\n    if a:\n" + "        a = a + 1\n" * 150 + "    return a\n",
+         namespace)
+    func = namespace["long_jumps"]
+    code = func.__code__
+    # The jump over the body needs an EXTENDED_ARG, which disassembling folds in
+    assert opmap["EXTENDED_ARG"] in code.co_code[::2]
+    assert opmap["EXTENDED_ARG"] not in [op[0] for op in disassemble(code)]
+    cfg = ControlFlowGraph.from_code(code)
+    assert assemble(fix_jumps(cfg)).code == code.co_code
+    assert optimized(func)(1) == 151
+
+
+def test_edges():
+    cfg = ControlFlowGraph.from_code(branches.__code__)
+    successors = cfg.successors()
+    predecessors = cfg.predecessors()
+    for block in cfg:
+        assert block.ops
+        for following in successors[block.label]:
+            assert block in predecessors[following.label]
+        jump = block.jump
+        if jump is not None:
+            # Jumps refer to labels and always end their block
+            assert jump[1] in cfg.labels
+            assert block.ops[-1] is jump
+
+
+def test_removed_jump_target():
+    code = (lambda c: 1 if c else 2).__code__
+    ops = [
+        (opmap["LOAD_FAST"], 0, 0),
+        (POP_JUMP_IF_FALSE, 8, 2),
+        (opmap["LOAD_CONST"], 0, 4),
+        (opmap["RETURN_VALUE"], 0, 6),
+        # The instruction at offset 8 was removed
+        (opmap["LOAD_CONST"], 1, 10),
+        (opmap["RETURN_VALUE"], 0, 12),
+    ]
+    cfg = ControlFlowGraph.from_ops(ops, code)
+    assert cfg.index[8] == cfg.index[10] == 4
+    assert cfg.entry.jump[1] == 10
+    assert [block.label for block in cfg] == [0, 4, 10]
+
+
+def overwritten(c):
+    x = 1
+    if c:
+        x = 2
+    else:
+        x = 3
+    try:
+        y = 4
+        y = 1 // c
+    except ZeroDivisionError:
+        return y
+    return x
+
+
+def test_max_stack_depth():
+    # Both sides of a branch push, only one of them runs
+    def pick(a):
+        return (a, a) if a else (a, a, a)
+
+    code = branches.__code__
+    assert max_stack_depth(ControlFlowGraph.from_code(code)) == code.co_stacksize
+    assert max_stack_depth(ControlFlowGraph.from_code(pick.__code__)) == pick.__code__.co_stacksize
+
+    def dead(a):
+        x = 0
+        if x:
+            return print(a, a, a, a, a, a)
+        return a
+
+    def retry(xs):
+        for x in xs:
+            try:
+                x = 1 // x
+            except ZeroDivisionError:
+                continue
+        return x
+
+    # Before 3.8 only the largest effects are known, more than the loop really pushes
+    assert 0 < max_stack_depth(ControlFlowGraph.from_code(retry.__code__)) \
+        <= retry.__code__.co_stacksize
+    assert optimized(retry)([0, 2]) == 0
+
+    size = dead.__code__.co_stacksize
+    # The call is folded away, and with it the stack it needed
+    assert optimized(dead).__code__.co_stacksize < size
+    assert dead(5) == 5
+
+
+def test_liveness():
+    code = overwritten.__code__
+    cfg = ControlFlowGraph.from_code(code)
+    assert remove_unused_variables(cfg) == 1
+    stores = [code.co_varnames[op[1]] for op in cfg.ops if op[0] == opmap["STORE_FAST"]]
+    # Only the first `x = 1` is dead, `y` is read by the handler
+    assert stores == ["x", "x", "y", "y"]
@@ -0,0 +1,58 @@
+import os
+
+from bytecode_optimizer._compile import compile_file, compile_paths, module_name
+from bytecode_optimizer._import_loader import CACHE_OPTIMIZATION, read_cache
+from importlib.util import cache_from_source
+
+
+def make_tree(root):
+    package = root / "app"
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    (package / "fast.py").write_text("def main():\n    x = 10\n    return x\n")
+    (package / "slow.py").write_text("# no-optimize\ndef main():\n    x = 10\n    return x\n")
+    return package
+
+
+def test_module_name(tmp_path):
+    package = make_tree(tmp_path)
+    assert module_name(str(package / "fast.py")) == "app.fast"
+    assert module_name(str(package / "__init__.py")) == "app"
+
+
+def test_compile_file(tmp_path):
+    package = make_tree(tmp_path)
+    assert compile_file(str(package / "fast.py"))[1] == "optimized"
+    assert compile_file(str(package / "fast.py"))[1] == "up to date"
+    assert compile_file(str(package / "slow.py"))[1] == "compiled"
+
+
+def test_compile_relative(tmp_path, monkeypatch):
+    package = make_tree(tmp_path)
+    monkeypatch.chdir(str(tmp_path))
+    assert compile_file(os.path.join("app", "fast.py"))[1] == "optimized"
+    path = str(package / "fast.py")
+    st = os.stat(path)
+    code = read_cache(cache_from_source(path, optimization=CACHE_OPTIMIZATION),
+                      int(st.st_mtime), st.st_size)
+    assert code.co_filename == path
+
+
+def test_compile_paths(tmp_path):
+    package = make_tree(tmp_path)
+    assert compile_paths([str(package)], workers=2, quiet=True)
+    for name in ("__init__.py", "fast.py", "slow.py"):
+        cached = cache_from_source(str(package / name), optimization=CACHE_OPTIMIZATION)
+        assert os.path.exists(cached)
+
+    (package / "broken.py").write_text("def main(:\n")
+    assert not compile_paths([str(package)], workers=2, quiet=True)
+
+
+def test_compile_with_profile(tmp_path):
+    package = make_tree(tmp_path)
+    profile = tmp_path / "app.profile"
+    profile.write_text('{"format": 1, "code": {}}')
+    assert compile_paths([str(package)], workers=2, quiet=True, profile=str(profile))
+    # A different profile makes for different caches
+    assert compile_file(str(package / "fast.py"))[1] == "optimized"
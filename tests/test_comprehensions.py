@@ -0,0 +1,73 @@
+from types import FunctionType
+
+from bytecode_optimizer import Flags, stats
+from bytecode_optimizer._flags import snapshot
+from bytecode_optimizer._optimizer import optimize_code
+
+INLINED = snapshot(Flags, {"INLINE_COMPREHENSIONS": True, "COLLECT_STATS": True, "MEMO_SIZE": 0})
+
+
+def run(function, *args):
+    code = optimize_code(function.__code__, INLINED)
+    optimized = FunctionType(code, function.__globals__, function.__name__,
+                             function.__defaults__, function.__closure__)
+    assert optimized(*args) == function(*args)
+    return code
+
+
+def statuses(function):
+    stats.reset()
+    optimize_code(function.__code__, INLINED)
+    return sorted(entry["status"] for module in stats.as_dict()["modules"].values()
+                  for entry in module["comprehensions"])
+
+
+def comprehensions(n):
+    squares = [x * x for x in range(n) if x % 2]
+    unique = {x // 2 for x in range(n)}
+    return squares, unique, {x: [y for y in range(x)] for x in range(n)}
+
+
+def closure(n):
+    return [x + n for x in range(3)]
+
+
+def nested(n):
+    return [lambda: x for x in range(n)]
+
+
+def maybe_unbound(n):
+    if n > 10:
+        limit = n
+    return [x for x in range(n) if x < limit]
+
+
+def rows(table):
+    out = []
+    for row in table:
+        out.append([str(y) for y in row])
+    return out
+
+
+def test_inlined():
+    code = run(comprehensions, 5)
+    assert not any(hasattr(const, "co_code") and const.co_name == "<listcomp>"
+                   for const in code.co_consts)
+    run(comprehensions, 0)
+    run(closure, 2)
+
+
+def test_skipped():
+    # Python 3.12 already inlines comprehensions itself
+    assert statuses(nested) in ([], ["has variables used by code nested in it"])
+    assert statuses(closure) in ([], ["inlined"])
+    # Inlined, reading `limit` would raise UnboundLocalError instead of NameError
+    assert statuses(maybe_unbound) in ([], ["uses a variable that may not be assigned yet"])
+
+
+def test_with_hoisting():
+    # Inlining adds names the loop hoisting has to find
+    flags = snapshot(INLINED, {"HOIST_LOADS": True})
+    code = optimize_code(rows.__code__, flags)
+    table = [[1, 2], [3]]
+    assert FunctionType(code, rows.__globals__)(table) == rows(table)
@@ -0,0 +1,49 @@
+from bytecode_optimizer import Flags
+from bytecode_optimizer._lazy import install, instrument
+
+SOURCE = '''
+def double(x):
+    y = x
+    return y * 2
+
+
+def decorate(func):
+    def wrapper(*args):
+        result = func(*args)
+        return result
+    return wrapper
+
+
+@decorate
+def triple(x):
+    while True:
+        return x * 3
+'''
+
+
+def lazy_module():
+    install()
+    namespace = {}
+    exec(instrument(compile(SOURCE, "<lazy>", "exec")), namespace)
+    return namespace
+
+
+def test_swap_after_calls(monkeypatch):
+    monkeypatch.setattr(Flags, "LAZY_CALLS", 3)
+    namespace = lazy_module()
+    double = namespace["double"]
+    assert [double(i) for i in range(2)] == [0, 2]
+    assert double.__code__.co_name == "double"
+    assert double(2) == 4
+    # The third call optimized it for the calls after it
+    assert double.__code__.co_name == "<optimized> double"
+    assert double(3) == 6
+
+
+def test_closures(monkeypatch):
+    monkeypatch.setattr(Flags, "LAZY_CALLS", 2)
+    triple = lazy_module()["triple"]
+    assert [triple(i) for i in range(5)] == [0, 3, 6, 9, 12]
+    # The wrapper is hot, the decorator only ran once
+    assert triple.__code__.co_name == "<optimized> wrapper"
+    assert triple.__closure__[0].cell_contents.__code__.co_name == "<optimized> triple"
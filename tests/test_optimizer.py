@@ -0,0 +1,306 @@
+import sys
+from dis import findlinestarts, opmap
+from types import CodeType
+
+import pytest
+
+from bytecode_optimizer import optimized, Flags
+
+
+def consts(func):
+    return optimized(func).__code__.co_consts
+
+
+def test_constant_propagation():
+    def func():
+        x = 3
+        y = x * 2
+        t = (x, -y, "a")
+        return t[1], y in (1, 6), not x
+
+    assert func() == (-6, True, False)
+    assert (-6, True, False) in consts(func)
+    assert func() == (-6, True, False)
+
+
+def test_constant_types_kept_apart():
+    def func():
+        a = 1
+        b = 1.0
+        c = -0.0
+        return a * 1, b * 1, c * 1, True
+
+    expected = func()
+    optimized(func)
+    result = func()
+    assert result == expected
+    assert [type(value) for value in result] == [type(value) for value in expected]
+    assert str(result[2]) == "-0.0"
+
+
+def test_folding_budget():
+    def func():
+        s = "a"
+        n = 10 ** 6
+        return s * n
+
+    assert all(len(value) < 1000 for value in consts(func) if isinstance(value, str))
+    assert len(func()) == 10 ** 6
+
+
+def test_docstring_kept():
+    def func():
+        """Docstring."""
+        x = "not it"
+        return x
+
+    assert optimized(func).__doc__ == "Docstring."
+    assert func() == "not it"
+
+
+def test_discarded_loads_still_raise():
+    def func():
+        missing  # pylint: disable=pointless-statement,undefined-variable
+        return 1
+
+    with pytest.raises(NameError):
+        optimized(func)()
+
+
+def test_memo(monkeypatch):
+    from bytecode_optimizer._optimizer import memo, optimize_code
+
+    memo.clear()
+    namespace = {}
+    exec("def make():\n    return lambda x: [y * 2 for y in x]\n\n\n"
+         "def other():\n    return lambda x: [y * 2 for y in x]\n", namespace)
+    first = optimize_code(namespace["make"].__code__)
+    # The input and output of `make`, the lambda and the comprehension, which 3.12 inlines
+    entries = 6 if sys.version_info < (3, 12) else 4
+    assert len(memo) == entries
+    second = optimize_code(namespace["other"].__code__)
+    # The comprehension is reused, the lambdas differ in their qualified names until 3.11, which
+    # keeps those on the code object instead of in the constants
+    assert len(memo) == (10 if sys.version_info < (3, 11) else entries)
+    assert second.co_name == "<optimized> other"
+    assert second.co_firstlineno == 5
+    lambda_code = [const for const in second.co_consts if isinstance(const, CodeType)][0]
+    assert lambda_code.co_firstlineno == 6
+    assert getattr(lambda_code, "co_qualname", "other.<locals>.<lambda>") == "other.<locals>.<lambda>"
+    assert optimize_code(first) is first
+
+    monkeypatch.setattr(Flags, "MEMO_SIZE", 2)
+    optimize_code(consts.__code__)
+    assert len(memo) == 2
+    memo.clear()
+
+
+def test_line_numbers():
+    def fails(a):
+        x = 2
+        y = x * 3
+
+        if a:
+            return y
+        raise ValueError(a)
+
+    first = fails.__code__.co_firstlineno
+    optimized(fails)
+    # The assignments are folded away, everything after them keeps its line
+    assert {line for _, line in findlinestarts(fails.__code__)} <= {first, first + 4, first + 5,
+                                                                    first + 6}
+    with pytest.raises(ValueError) as info:
+        fails(0)
+    assert info.traceback[-1].lineno + 1 == first + 6
+
+
+def test_jump_threading():
+    from bytecode_optimizer._bytecode import can_jump_backward
+    from bytecode_optimizer._cfg import ControlFlowGraph
+    from bytecode_optimizer._optimizer import PLAIN_JUMPS
+
+    def dispatch(ops):
+        acc = 0
+        for op in ops:
+            if op == 1:
+                if acc > 10:
+                    acc = 0
+                else:
+                    acc += 1
+            elif op == 2:
+                acc *= 2
+            else:
+                continue
+        if acc:
+            return acc
+        else:
+            return -1
+
+    expected = [dispatch(ops) for ops in ([], [1, 2, 3], [1] * 30, [2, 1, 1])]
+    optimized(dispatch)
+    assert [dispatch(ops) for ops in ([], [1, 2, 3], [1] * 30, [2, 1, 1])] == expected
+
+    cfg = ControlFlowGraph.from_code(dispatch.__code__)
+    predecessors = cfg.predecessors()
+    for block in cfg:
+        # Every block is reachable and no jump lands on another plain jump
+        assert block is cfg.entry or predecessors[block.label]
+        jump = block.jump
+        if jump is not None and jump[0] != opmap.get("SETUP_LOOP"):
+            target = cfg.labels[jump[1]].ops
+            # Since 3.12 conditional jumps only go forward, so can't skip a `continue`
+            assert not (len(target) == 1 and target[0][0] in PLAIN_JUMPS
+                        and (can_jump_backward(jump[0]) or target[0][1] > jump[1]))
+
+
+def test_hoist_loads():
+    def collect(items):
+        out = []
+        for item in items:
+            if isinstance(item, str):
+                item = len(item)
+            else:
+                item = str(item).upper()
+            out.append(item)
+        return out
+
+    def guarded(out, n):
+        for i in range(n):
+            if out is not None:
+                out.append(i)
+        return out
+
+    def rebinds(n):
+        global hoisted_global
+        total = 0
+        for i in range(n):
+            total += hoisted_global
+            hoisted_global = i
+        return total
+
+    items = ["ab", 3, "xyz", None]
+    expected = collect(items)
+    optimized(hoist_loads=True)(collect)
+    assert collect(items) == expected
+    code = collect.__code__
+    assert {".len", ".isinstance", ".str", ".out.append"} <= set(code.co_varnames)
+    assert code.co_nlocals == len(code.co_varnames)
+
+    # Only methods looked up on every iteration are hoisted
+    optimized(hoist_loads=True)(guarded)
+    assert guarded(None, 3) is None
+    assert guarded([], 3) == [0, 1, 2]
+
+    # Since 3.12 the handler jumps back from the end, which is no loop to hoist out of
+    def handled(a):
+        try:
+            r = 1 // a
+        except ZeroDivisionError:
+            r = sum([1 for _ in range(3)])
+        return len(str(r))
+
+    optimized(hoist_loads=True)(handled)
+    assert handled(0) == handled(1) == 1
+
+    global hoisted_global
+    hoisted_global = 10
+    optimized(hoist_loads=True)(rebinds)
+    assert rebinds(3) == 11
+    assert ".hoisted_global" not in rebinds.__code__.co_varnames
+
+
+TAIL_CALLS = '''
+def count(n, acc=0):
+    if n == 0:
+        return acc
+    return count(n - 1, acc=acc + 1)
+
+
+def even(n):
+    if n == 0:
+        return True
+    return odd(n - 1)
+
+
+def odd(n):
+    if n == 0:
+        return False
+    return even(n - 1)
+
+
+def guarded(n):
+    try:
+        if n == 0:
+            return 0
+        return guarded(n - 1)
+    finally:
+        pass
+
+
+def unbound(n, total=0):
+    if total:
+        return x + total
+    x = n
+    return unbound(n, x + x)
+
+
+def parse(n):
+    try:
+        n = int(n)
+    except ValueError:
+        return None
+    if n <= 0:
+        return n
+    return parse(str(n - 1))
+
+
+def spin():
+    # Never called, nothing but the jump is left of it
+    return spin()
+'''
+
+
+def tail_call_module():
+    from bytecode_optimizer import stats
+    from bytecode_optimizer._optimizer import memo, optimize_code
+
+    memo.clear()
+    stats.reset()
+    namespace = {"__name__": "tail_calls"}
+    with stats.module("tail_calls"):
+        exec(optimize_code(compile(TAIL_CALLS, "<tail_calls>", "exec")), namespace)
+    return namespace
+
+
+def test_tail_calls():
+    import sys
+
+    namespace = tail_call_module()
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(200)
+    try:
+        assert namespace["count"](1000) == 1000
+        assert namespace["even"](1001) is False
+        assert namespace["odd"](1001) is True
+        # Since 3.11 the try statement is in the exception table, the jump skips the frame setup
+        assert namespace["parse"]("1000") == 0
+        assert namespace["parse"]("x") is None
+    finally:
+        sys.setrecursionlimit(limit)
+    assert namespace["guarded"](10) == 0
+    # Locals that aren't parameters start unbound after the jump too
+    with pytest.raises(UnboundLocalError):
+        namespace["unbound"](5)
+
+
+def test_tail_call_reports(monkeypatch):
+    from bytecode_optimizer import stats
+
+    monkeypatch.setattr(Flags, "COLLECT_STATS", True)
+    tail_call_module()
+    reports = stats.as_dict()["modules"]["tail_calls"]["tail_calls"]
+    statuses = {(report["function"], report["target"]): report["status"] for report in reports}
+    assert statuses[("count", "count")] == statuses[("even", "odd")] == "converted"
+    assert statuses[("unbound", "unbound")] == statuses[("spin", "spin")] == "converted"
+    assert statuses.get(("guarded", "guarded")) != "converted"
+    stats.reset()
@@ -0,0 +1,51 @@
+from dis import opmap
+
+from bytecode_optimizer import Flags
+from bytecode_optimizer._cfg import ControlFlowGraph
+from bytecode_optimizer._passes import PassManager
+
+
+def example(a):
+    return a
+
+
+def test_fixed_point():
+    calls = []
+
+    def shrink(cfg):
+        calls.append("shrink")
+        block = cfg.entry
+        if len(block.ops) > size:
+            # Drop the leading NOP each round
+            del block.ops[0]
+            return 1
+        return 0
+
+    def count(cfg):
+        calls.append("count")
+        return 0
+
+    manager = PassManager()
+    manager.register(shrink)
+    manager.register(count, before="shrink")
+    assert manager.names == ["count", "shrink"]
+
+    cfg = ControlFlowGraph.from_code(example.__code__)
+    size = len(cfg.entry.ops)
+    cfg.entry.ops[:0] = [(opmap["NOP"], 0, 0)] * 2
+    assert manager.run(cfg, Flags, 10) == 2
+    # `count` only runs again when `shrink` changed something since
+    assert calls == ["count", "shrink", "count", "shrink", "count", "shrink"]
+
+
+def test_disable():
+    manager = PassManager()
+    manager.register(lambda cfg: 1, "always")
+    manager.register(lambda cfg: 1, "flagged", flags=("DEBUG", ))
+    assert [pass_.name for pass_ in manager.active(Flags)] == ["always"]
+    manager.disable("always")
+    assert manager.active(Flags) == []
+    cfg = ControlFlowGraph.from_code(example.__code__)
+    # Bounded by the number of rounds even if passes never settle
+    manager.enable("always")
+    assert manager.run(cfg, Flags, 3) == 3
@@ -0,0 +1,44 @@
+from dis import opmap
+from types import FunctionType
+
+from bytecode_optimizer._bytecode import DUP_TOP
+from bytecode_optimizer._cfg import ControlFlowGraph
+from bytecode_optimizer._optimizer import PEEPHOLE_RULES, optimize_code
+from bytecode_optimizer._patterns import Automaton, Rule
+
+LOAD_CONST, LOAD_FAST, POP_TOP = opmap["LOAD_CONST"], opmap["LOAD_FAST"], opmap["POP_TOP"]
+
+
+def ops(*opcodes):
+    return [(opcode, 0, i * 2) for i, opcode in enumerate(opcodes)]
+
+
+def square(x):
+    return x * x
+
+
+def test_rules_cascade():
+    cfg = ControlFlowGraph.from_code(square.__code__)
+    automaton = Automaton([
+        Rule("drop", ("LOAD_CONST", "POP_TOP"), lambda cfg, ops: []),
+        # Never applies, the rule before it wins
+        Rule("shadowed", ("LOAD_CONST", "POP_TOP"), lambda cfg, ops: ops[:1]),
+        Rule("missing", ("NOT_AN_OPCODE", "POP_TOP"), lambda cfg, ops: []),
+    ])
+    block = ops(LOAD_FAST, LOAD_CONST, LOAD_CONST, POP_TOP, POP_TOP, LOAD_CONST)
+    assert automaton.rewrite_block(cfg, block) == ([block[0], block[-1]], 2)
+
+
+def test_replacement_not_matched_again():
+    cfg = ControlFlowGraph.from_code(square.__code__)
+    automaton = Automaton([Rule("same", ("LOAD_FAST", ), lambda cfg, ops: ops)])
+    block = ops(LOAD_FAST, LOAD_FAST)
+    assert automaton.rewrite_block(cfg, block) == (block, 2)
+
+
+def test_peephole():
+    code = optimize_code(square.__code__)
+    assert list(code.co_code[::2]).count(LOAD_FAST) == 1
+    assert DUP_TOP[0] in code.co_code[::2]
+    assert FunctionType(code, {})(7) == 49
+    assert len({rule.name for rule in PEEPHOLE_RULES}) == len(PEEPHOLE_RULES)
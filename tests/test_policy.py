@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bytecode_optimizer import Flags, Policy
+from bytecode_optimizer._optimizer import memo, optimize_code, passes
+
+
+def add(x):
+    y = x
+    return y + 1
+
+
+def test_globs():
+    policy = Policy(include=("app", "lib*"), exclude=("app.vendored", ))
+    assert policy.should_optimize("app")
+    assert policy.should_optimize("app.models")
+    assert policy.should_optimize("library.core")
+    assert not policy.should_optimize("app.vendored.six")
+    assert not policy.should_optimize("other")
+    assert not policy.should_optimize("app", b"# no-optimize\n")
+
+    default = Policy()
+    assert default.should_optimize("app")
+    assert not default.should_optimize("_private")
+    assert not default.should_optimize("six")
+
+
+def test_package_flags(monkeypatch):
+    monkeypatch.setattr(Flags, "OPTIMIZE_ITERATIONS", 5)
+    policy = Policy(packages={
+        "app": {"OPTIMIZE_ITERATIONS": 2, "HOIST_LOADS": True},
+        "app.cold": {"OPTIMIZE_ITERATIONS": 1, "PASSES": ["optimize_jumps"]},
+    })
+    assert policy.flags("other").OPTIMIZE_ITERATIONS == 5
+    assert policy.flags("app.models").OPTIMIZE_ITERATIONS == 2
+    cold = policy.flags("app.cold.models")
+    assert (cold.OPTIMIZE_ITERATIONS, cold.HOIST_LOADS) == (1, True)
+    assert [pass_.name for pass_ in passes.active(cold)] == ["optimize_jumps"]
+    assert policy.flags("app") is policy.flags("app")
+
+    with pytest.raises(ValueError, match="FAST"):
+        Policy(packages={"app": {"FAST": True}})
+
+
+def test_snapshot_is_frozen(monkeypatch):
+    flags = Policy().flags("app")
+    with pytest.raises(AttributeError):
+        flags.DEBUG = True
+    monkeypatch.setattr(Flags, "DEBUG", not flags.DEBUG)
+    assert flags.DEBUG != Flags.DEBUG
+
+
+def test_concurrent_optimize(monkeypatch):
+    memo.clear()
+    expected = optimize_code(add.__code__).co_code
+
+    def work(i):
+        if i % 2:
+            # Another thread changing the flags only affects calls started after it
+            monkeypatch.setattr(Flags, "MEMO_SIZE", i % 3)
+        return optimize_code(add.__code__).co_code
+
+    with ThreadPoolExecutor(8) as executor:
+        assert set(executor.map(work, range(200))) == {expected}
+    memo.clear()
@@ -0,0 +1,39 @@
+import json
+import sys
+
+from bytecode_optimizer import Flags, Profile, Recorder
+from bytecode_optimizer._optimizer import optimize_code
+from bytecode_optimizer._profile import profile_key
+
+
+def work(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def test_recorder(tmp_path):
+    path = str(tmp_path / "app.profile")
+    with Recorder(path):
+        for _ in range(5):
+            work(10)
+    with open(path) as fp:
+        entry = json.load(fp)["code"][profile_key(work.__code__)]
+    assert entry["calls"] == 5
+    # Loop iterations are only seen through sys.monitoring
+    assert entry["loops"] == (50 if hasattr(sys, "monitoring") else 0)
+    assert Profile.load(path).count(work.__code__) == 5 + entry["loops"]
+
+
+def test_hot_and_cold(monkeypatch):
+    source = "def hot():\n    x = 1\n    return 2\n\n\ndef cold():\n    x = 1\n    return 2\n"
+    code = compile(source, "<profiled>", "exec")
+    functions = [const for const in code.co_consts if hasattr(const, "co_code")]
+    profile = Profile({profile_key(functions[0]): 1000})
+    monkeypatch.setattr(Flags, "PROFILE", profile)
+    hot, cold = [const for const in optimize_code(code).co_consts if hasattr(const, "co_code")]
+    # Cold code skips the liveness passes, so its dead store stays
+    assert "x" not in hot.co_varnames
+    assert "x" in cold.co_varnames
+    assert repr(Flags.PROFILE) == repr(Profile({profile_key(functions[0]): 1000}))
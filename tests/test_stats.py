@@ -0,0 +1,24 @@
+import json
+
+from bytecode_optimizer import optimized, stats, Flags
+from bytecode_optimizer._optimizer import memo
+
+
+def test_stats(monkeypatch):
+    monkeypatch.setattr(Flags, "COLLECT_STATS", True)
+    stats.reset()
+    # Code served from the memo is not optimized, nor recorded, again
+    memo.clear()
+
+    # Compiled here, as test modules may already be optimized on import
+    namespace = {"__name__": __name__}
+    exec("def main():\n    x = 10\n    y = 20\n    z = x + y\n    return z\n", namespace)
+    optimized(namespace["main"])
+    data = json.loads(stats.to_json())
+    module = data["modules"][__name__]
+    code, = module["code"]
+    assert code["name"] == "main"
+    assert code["ops_after"] < code["ops_before"]
+    assert module["passes"]["fix_const_ops"]["rewrites"] > 0
+    assert 0 < data["passes"]["peephole"]["runs"] <= Flags.OPTIMIZE_ITERATIONS
+    stats.reset()
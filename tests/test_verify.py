@@ -0,0 +1,61 @@
+from dis import opmap
+import warnings
+
+import pytest
+
+from bytecode_optimizer._bytecode import assemble, replace
+from bytecode_optimizer._fuzz import fuzz
+from bytecode_optimizer._optimizer import Flags, memo, optimize_code, passes
+from bytecode_optimizer._verify import VerificationError, verify
+
+
+def branches(a, b):
+    total = 0
+    for i in range(a):
+        try:
+            total += b // i
+        except ZeroDivisionError:
+            continue
+    return total
+
+
+def test_accepts_compiled_and_optimized():
+    verify(branches.__code__)
+    verify(optimize_code(branches.__code__))
+
+
+def test_rejects_broken_code():
+    code = branches.__code__
+    with pytest.raises(VerificationError, match="co_stacksize"):
+        verify(replace(code, co_stacksize=1))
+    with pytest.raises(VerificationError, match="constant"):
+        verify(replace(code, co_consts=()))
+    underflow = assemble([(opmap["POP_TOP"], 0, 0), (opmap["LOAD_CONST"], 0, 2),
+                          (opmap["RETURN_VALUE"], 0, 4)])
+    with pytest.raises(VerificationError, match="underflow"):
+        verify(replace(code, co_code=underflow.code, co_exceptiontable=b""))
+
+
+def test_broken_pass_keeps_original(monkeypatch):
+    def breaks(cfg):
+        if cfg.entry.ops[-1][0] != opmap["POP_TOP"]:
+            cfg.entry.ops.append((opmap["POP_TOP"], 0, cfg.entry.ops[-1][2]))
+            return 1
+        return 0
+
+    memo.clear()
+    passes.register(breaks)
+    monkeypatch.setattr(Flags, "OPTIMIZE_ITERATIONS", 1)
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            code = optimize_code(branches.__code__)
+    finally:
+        passes.unregister("breaks")
+        memo.clear()
+    assert "Not optimizing" in str(caught[0].message)
+    assert code.co_code == branches.__code__.co_code
+
+
+def test_fuzz():
+    assert fuzz(50) == []